@@ -0,0 +1,256 @@
+"""Асинхронные представления для чтения под ASGI.
+
+Повторяют ответы магазинов, справочников и подписок из views.py, но не
+занимают поток на время ожидания базы: запросы выполняются асинхронным
+API QuerySet, независимые запросы (товары и мессенджеры магазинов,
+избранное и подписки пользователя) запускаются вместе. Сериализаторы
+получают всё заранее загруженным и к базе не обращаются.
+"""
+import asyncio
+import functools
+from collections import defaultdict
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.conf import settings
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework.request import Request
+from rest_framework.utils.encoders import JSONEncoder
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from shops.models import FavoriteShop, Shop, ShopMessenger, ShopProduct
+from svoe_vkusnee.timing import timed
+from users.models import Follow
+
+from .authentication import CachedTokenAuthentication, get_token_user
+from .cache import (add_catalog_headers, catalog_cache_key,
+                    catalog_not_modified, get_catalog_version)
+from .filters import ShopFilter, search_queryset
+from .pagination import Pagination
+from .serializers import FollowSerializer, ShopSerializer
+from .utils import get_subscriptions_queryset
+from .views import (CategoryViewSet, MessengerViewSet, ProductViewSet,
+                    SubcategoryViewSet)
+
+# Справочники и синхронные представления, чьи фильтры и сортировка
+# повторяются.
+CATALOGS = {
+    'categorys': CategoryViewSet,
+    'subcategorys': SubcategoryViewSet,
+    'products': ProductViewSet,
+    'messengers': MessengerViewSet,
+}
+
+
+def json_response(data, status=200):
+    return JsonResponse(
+        data, status=status, safe=False, encoder=JSONEncoder,
+        json_dumps_params={'ensure_ascii': False},
+    )
+
+
+async def fetch(queryset):
+    return [obj async for obj in queryset]
+
+
+async def authenticate(request):
+    """Пользователь по заголовку Authorization: Token <key>.
+
+    Возвращает False, если токен передан, но недействителен. Слово Token
+    сравнивается без учёта регистра, как в TokenAuthentication.
+    """
+    request.user = AnonymousUser()
+    header = request.headers.get('Authorization', '').split()
+    keyword = CachedTokenAuthentication.keyword
+    if not header or header[0].lower() != keyword.lower():
+        return True
+    if len(header) != 2:
+        return False
+    user = await sync_to_async(get_token_user)(header[1])
+    if user is None:
+        return False
+    request.user = user
+    return True
+
+
+async def load_user_sets(request):
+    """Заполняет кэши запроса из utils.py: избранные магазины и
+    подписки."""
+    if request.user.is_anonymous:
+        return
+    favorited, following = await asyncio.gather(
+        fetch(FavoriteShop.objects.filter(
+            user=request.user).values_list('shop_id', flat=True)),
+        fetch(Follow.objects.filter(
+            user=request.user).values_list('owner_id', flat=True)),
+    )
+    request._favorited_shop_ids = frozenset(favorited)
+    request._following_ids = frozenset(following)
+
+
+async def attach_shop_relations(shops):
+    """Товары и мессенджеры магазинов двумя параллельными запросами,
+    как Prefetch в ShopViewSet.get_queryset."""
+    ids = [shop.id for shop in shops]
+    shop_products, shop_messengers = await asyncio.gather(
+        fetch(ShopProduct.objects.filter(
+            shop_id__in=ids).select_related('product')),
+        fetch(ShopMessenger.objects.filter(
+            shop_id__in=ids).select_related('messenger')),
+    )
+    products, messengers = defaultdict(list), defaultdict(list)
+    for shop_product in shop_products:
+        products[shop_product.shop_id].append(shop_product)
+    for shop_messenger in shop_messengers:
+        messengers[shop_messenger.shop_id].append(shop_messenger)
+    for shop in shops:
+        shop.shop_products = products[shop.id]
+        shop.shop_messengers = messengers[shop.id]
+
+
+async def paginate(request, queryset):
+    """Страница в формате Pagination: count, next, previous, results.
+
+    Возвращает None для несуществующей страницы.
+    """
+    try:
+        page = int(request.GET.get('page', 1))
+        size = int(request.GET.get(
+            Pagination.page_size_query_param, Pagination.page_size))
+    except ValueError:
+        return None
+    if page < 1 or size < 1:
+        return None
+    offset = (page - 1) * size
+    count, objects = await asyncio.gather(
+        queryset.acount(), fetch(queryset[offset:offset + size]))
+    if not objects and page != 1:
+        return None
+    url = request.build_absolute_uri()
+    previous = None
+    if page == 2:
+        previous = remove_query_param(url, 'page')
+    elif page > 2:
+        previous = replace_query_param(url, 'page', page - 1)
+    return {
+        'count': count,
+        'next': (replace_query_param(url, 'page', page + 1)
+                 if offset + size < count else None),
+        'previous': previous,
+        'results': objects,
+    }
+
+
+def filter_shops(request):
+    """Фильтры ShopViewSet. Выполняется в потоке: форма фильтра и
+    полнотекстовый поиск обращаются к базе синхронно."""
+    queryset = ShopFilter(
+        request.GET, Shop.objects.select_related('owner'), request=request
+    ).qs
+    query = request.GET.get('search', '').strip()
+    if query:
+        queryset = search_queryset(queryset, 'shop', query)
+    return queryset
+
+
+def filter_catalog(request, view_class):
+    """Фильтры, поиск и сортировка синхронного представления справочника:
+    ответы с общим ключом кэша должны совпадать. Выполняется в потоке."""
+    view = view_class(action='list', format_kwarg=None)
+    view.request = Request(request)
+    queryset = view.get_queryset()
+    for backend in view.filter_backends:
+        queryset = backend().filter_queryset(view.request, queryset, view)
+    return queryset
+
+
+def only_get(view):
+    """require_GET для асинхронных представлений: декораторы Django 4.1
+    оборачивают их синхронной функцией."""
+    @functools.wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method not in ('GET', 'HEAD'):
+            return HttpResponseNotAllowed(('GET', 'HEAD'))
+        return await view(request, *args, **kwargs)
+    return wrapper
+
+
+def not_found():
+    return json_response({'errors': 'Страница не найдена.'}, status=404)
+
+
+def unauthorized():
+    return json_response(
+        {'errors': 'Недопустимый токен или токен не передан.'}, status=401)
+
+
+@only_get
+async def shop_list(request):
+    if not await authenticate(request):
+        return unauthorized()
+    queryset = await sync_to_async(filter_shops)(request)
+    page, _ = await asyncio.gather(
+        paginate(request, queryset), load_user_sets(request))
+    if page is None:
+        return not_found()
+    await attach_shop_relations(page['results'])
+    with timed('serialize'):
+        page['results'] = ShopSerializer(
+            page['results'], many=True, context={'request': request}).data
+    return json_response(page)
+
+
+@only_get
+async def shop_detail(request, pk):
+    if not await authenticate(request):
+        return unauthorized()
+    shop, _ = await asyncio.gather(
+        Shop.objects.select_related('owner').filter(pk=pk).afirst(),
+        load_user_sets(request),
+    )
+    if shop is None:
+        return not_found()
+    await attach_shop_relations([shop])
+    with timed('serialize'):
+        data = ShopSerializer(shop, context={'request': request}).data
+    return json_response(data)
+
+
+@only_get
+async def catalog_list(request, catalog):
+    """Справочник с тем же кэшированием по версии, что и
+    CatalogCacheMixin."""
+    view_class = CATALOGS[catalog]
+    version = await sync_to_async(get_catalog_version)(
+        view_class.queryset.model)
+    response = catalog_not_modified(request, version)
+    if response is None:
+        key = catalog_cache_key(request, version)
+        data = await cache.aget(key)
+        if data is None:
+            queryset = await sync_to_async(filter_catalog)(
+                request, view_class)
+            objects = await fetch(queryset)
+            with timed('serialize'):
+                data = view_class.serializer_class(
+                    objects, many=True, context={'request': request}).data
+            await cache.aset(key, data, settings.CATALOG_CACHE_TIMEOUT)
+        response = json_response(data)
+    return add_catalog_headers(response, version)
+
+
+@only_get
+async def subscriptions(request):
+    if not await authenticate(request) or request.user.is_anonymous:
+        return unauthorized()
+    queryset = get_subscriptions_queryset(
+        request.user, request.GET.get('shops_limit'))
+    page, _ = await asyncio.gather(
+        paginate(request, queryset), load_user_sets(request))
+    if page is None:
+        return not_found()
+    with timed('serialize'):
+        page['results'] = FollowSerializer(
+            page['results'], many=True, context={'request': request}).data
+    return json_response(page)
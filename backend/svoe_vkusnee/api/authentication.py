@@ -0,0 +1,144 @@
+"""Аутентификация по токену без запроса к базе на каждый запрос.
+
+Токен с пользователем ищется сначала в LRU памяти процесса, затем в общем
+кэше и только потом в базе. Выход, смена пароля и любое изменение
+пользователя удаляют запись из общего кэша и из LRU своего процесса;
+другие процессы забывают её не позже AUTH_TOKEN_LOCAL_TTL секунд.
+
+В кэшах лежат только id пользователя и поля USER_FIELDS, без хэша пароля;
+остальные поля request.user загружаются из базы при первом обращении.
+"""
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import router
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from users.models import User
+
+# Поля пользователя, нужные аутентификации и проверкам прав, в порядке
+# полей модели: так их ждёт Model.from_db.
+USER_FIELDS = ('id', 'is_superuser', 'is_staff', 'is_active')
+
+
+def cache_key(key):
+    """Ключ общего кэша: сам токен в кэш не попадает."""
+    return f'auth-token:{hashlib.sha256(key.encode()).hexdigest()}'
+
+
+class TokenCache:
+    """LRU токенов процесса с временем жизни записей и счётчиками."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tokens = OrderedDict()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.stats = {'local_hits': 0, 'shared_hits': 0, 'misses': 0}
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        total = sum(stats.values())
+        stats['size'] = len(self._tokens)
+        stats['hit_ratio'] = round(
+            (stats['local_hits'] + stats['shared_hits']) / total, 4
+        ) if total else None
+        return stats
+
+    def _get_local(self, key):
+        with self._lock:
+            entry = self._tokens.get(key)
+            if entry is None:
+                return None
+            values, expires = entry
+            if expires < time.monotonic():
+                del self._tokens[key]
+                return None
+            self._tokens.move_to_end(key)
+            self.stats['local_hits'] += 1
+            return values
+
+    def _set_local(self, key, values):
+        with self._lock:
+            self._tokens[key] = (
+                values, time.monotonic() + settings.AUTH_TOKEN_LOCAL_TTL)
+            self._tokens.move_to_end(key)
+            while len(self._tokens) > settings.AUTH_TOKEN_CACHE_SIZE:
+                self._tokens.popitem(last=False)
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def get(self, key):
+        """Токен с пользователем или None, если токена нет.
+
+        Объекты строятся заново на каждый запрос, так что представления
+        могут менять request.user.
+        """
+        values = self._get_local(key)
+        if values is None:
+            values = self._load(key)
+        if values is None:
+            return None
+        db = router.db_for_write(Token)
+        user = User.from_db(db, USER_FIELDS, values)
+        token = Token.from_db(db, ('key', 'user_id'), (key, user.pk))
+        token.user = user
+        return token
+
+    def _load(self, key):
+        values = cache.get(cache_key(key))
+        if values is not None:
+            self._count('shared_hits')
+        else:
+            self._count('misses')
+            # Только что выданного токена на реплике может ещё не быть.
+            values = User.objects.using(router.db_for_write(Token)).filter(
+                auth_token__key=key).values_list(*USER_FIELDS).first()
+            if values is None:
+                return None
+            cache.set(cache_key(key), values,
+                      settings.AUTH_TOKEN_CACHE_TIMEOUT)
+        self._set_local(key, values)
+        return values
+
+    def invalidate(self, *keys):
+        with self._lock:
+            for key in keys:
+                self._tokens.pop(key, None)
+        cache.delete_many([cache_key(key) for key in keys])
+
+    def clear(self):
+        with self._lock:
+            self._tokens.clear()
+
+
+token_cache = TokenCache()
+
+
+def get_token_user(key):
+    """Активный пользователь токена или None."""
+    token = token_cache.get(key)
+    if token is None or not token.user.is_active:
+        return None
+    return token.user
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    """TokenAuthentication с кэшем токенов."""
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            raise AuthenticationFailed('Недопустимый токен.')
+        if not token.user.is_active:
+            raise AuthenticationFailed('Пользователь неактивен или удалён.')
+        return token.user, token
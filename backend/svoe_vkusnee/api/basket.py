@@ -0,0 +1,163 @@
+"""Подбор магазинов под корзину товаров.
+
+В памяти процесса хранится индекс: товар -> множество магазинов, где он в
+наличии, и координаты магазинов. Записи ShopProduct и Shop обновляют индекс
+через сигналы после фиксации транзакции, другие процессы перестраивают его
+не реже BASKET_INDEX_TTL.
+"""
+import heapq
+import threading
+import time
+from collections import defaultdict
+
+from django.conf import settings
+from django.db import transaction
+
+from shops import geo
+from shops.models import Shop, ShopProduct
+
+
+class AvailabilityIndex:
+    """Индекс наличия товаров по магазинам.
+
+    Перестройка читает базу без блокировки: пока она идёт, запросы
+    пользуются старым индексом, а записи попадают и в него, и в журнал,
+    который применяется к новому индексу перед заменой.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._build_lock = threading.Lock()
+        self._postings = None
+        self._locations = None
+        self._pending = None
+        self._built_at = 0
+
+    def _load(self):
+        postings = defaultdict(set)
+        available = ShopProduct.objects.filter(
+            availability=True).values_list('product_id', 'shop_id')
+        for product_id, shop_id in available.iterator(chunk_size=10000):
+            postings[product_id].add(shop_id)
+        locations = {
+            shop_id: (latitude, longitude)
+            for shop_id, latitude, longitude in Shop.objects.filter(
+                latitude__isnull=False
+            ).values_list('id', 'latitude', 'longitude').iterator(
+                chunk_size=10000)
+        }
+        return postings, locations
+
+    def _build(self):
+        with self._lock:
+            self._pending = []
+        try:
+            postings, locations = self._load()
+        except BaseException:
+            with self._lock:
+                self._pending = None
+            raise
+        with self._lock:
+            for change in self._pending:
+                change(postings, locations)
+            self._pending = None
+            self._postings, self._locations = postings, locations
+            self._built_at = time.monotonic()
+
+    def _expired(self):
+        return self._postings is None or (
+            time.monotonic() - self._built_at > settings.BASKET_INDEX_TTL)
+
+    def _ensure_built(self):
+        if not self._expired():
+            return
+        # Устаревший индекс перестраивает один запрос, остальные его не
+        # ждут; без индекса ждут все.
+        if not self._build_lock.acquire(blocking=self._postings is None):
+            return
+        try:
+            if self._expired():
+                self._build()
+        finally:
+            self._build_lock.release()
+
+    def clear(self):
+        with self._lock:
+            self._postings = self._locations = None
+
+    def _change(self, change):
+        """Применяет изменение после фиксации текущей транзакции: при её
+        откате индекс не должен показывать незаписанное наличие."""
+        transaction.on_commit(lambda: self._apply(change))
+
+    def _apply(self, change):
+        """Применяет изменение к индексу и записывает его в журнал идущей
+        перестройки."""
+        with self._lock:
+            if self._postings is not None:
+                change(self._postings, self._locations)
+            if self._pending is not None:
+                self._pending.append(change)
+
+    def set_availability(self, shop_id, product_id, available):
+        self.set_availabilities(shop_id, {product_id: available})
+
+    def set_availabilities(self, shop_id, availability):
+        """Наличие товаров магазина: {product_id: available}."""
+        availability = dict(availability)
+
+        def change(postings, locations):
+            for product_id, available in availability.items():
+                if available:
+                    postings[product_id].add(shop_id)
+                else:
+                    postings.get(product_id, set()).discard(shop_id)
+        self._change(change)
+
+    def set_location(self, shop_id, latitude, longitude):
+        def change(postings, locations):
+            if latitude is None or longitude is None:
+                locations.pop(shop_id, None)
+            else:
+                locations[shop_id] = (latitude, longitude)
+        self._change(change)
+
+    def match(self, product_ids, min_matched=1, latitude=None,
+              longitude=None, limit=None):
+        """Магазины с наибольшим покрытием корзины, при равном покрытии
+        ближайшие к точке.
+
+        Возвращает список (shop_id, matched, distance).
+        """
+        self._ensure_built()
+        matched = defaultdict(list)
+        with self._lock:
+            postings, locations = self._postings, self._locations
+            if postings is None:
+                return []
+            for product_id in product_ids:
+                for shop_id in postings.get(product_id, ()):
+                    matched[shop_id].append(product_id)
+        tiers = defaultdict(list)
+        for shop_id, products in matched.items():
+            if len(products) >= min_matched:
+                tiers[len(products)].append(shop_id)
+        found = []
+        for count in sorted(tiers, reverse=True):
+            # Расстояния нужны только магазинам попавших в выдачу уровней.
+            tier = []
+            for shop_id in tiers[count]:
+                location = locations.get(shop_id)
+                distance = None
+                if latitude is not None and location is not None:
+                    distance = geo.distance(latitude, longitude, *location)
+                tier.append((shop_id, matched[shop_id], distance))
+            need = limit - len(found) if limit else len(tier)
+            found.extend(heapq.nsmallest(need, tier, key=lambda item: (
+                item[2] is None, item[2] or 0, item[0])))
+            if limit and len(found) >= limit:
+                break
+        return found
+
+
+availability_index = AvailabilityIndex()
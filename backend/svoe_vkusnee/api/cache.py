@@ -0,0 +1,81 @@
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date, quote_etag
+from rest_framework.response import Response
+
+CATALOG_VERSION_KEY = 'catalog:version:{}'
+
+
+def get_catalog_version(model):
+    """Текущая версия справочника model: время последнего изменения в мс.
+
+    У каждого справочника своя версия: изменение товаров не сбрасывает
+    кэш категорий и мессенджеров.
+    """
+    key = CATALOG_VERSION_KEY.format(model._meta.label_lower)
+    version = cache.get(key)
+    if version is None:
+        version = int(time.time() * 1000)
+        cache.add(key, version, timeout=None)
+        version = cache.get(key, version)
+    return version
+
+
+def bump_catalog_version(model):
+    """Сдвигает версию справочника минимум на секунду вперёд,
+    чтобы Last-Modified тоже изменился."""
+    version = max(get_catalog_version(model) + 1000,
+                  int(time.time() * 1000))
+    cache.set(CATALOG_VERSION_KEY.format(model._meta.label_lower), version,
+              timeout=None)
+    return version
+
+
+def catalog_not_modified(request, version):
+    """Ответ 304 или 412 по условным заголовкам запроса, иначе None."""
+    return get_conditional_response(
+        request, etag=quote_etag(str(version)), last_modified=version // 1000)
+
+
+def catalog_cache_key(request, version):
+    """Ключ ответа: ответы содержат абсолютные ссылки на картинки, поэтому
+    зависят от схемы и хоста запроса."""
+    return f'catalog:{version}:{request.build_absolute_uri()}'
+
+
+def add_catalog_headers(response, version):
+    """ETag и Last-Modified версии справочника; кэши клиентов обязаны
+    перепроверять ответ."""
+    response['ETag'] = quote_etag(str(version))
+    response['Last-Modified'] = http_date(version // 1000)
+    patch_cache_control(response, no_cache=True)
+    return response
+
+
+class CatalogCacheMixin:
+    """Кэширование ответов справочника по его версии."""
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        version = get_catalog_version(self.queryset.model)
+        response = catalog_not_modified(request, version)
+        if response is None:
+            key = catalog_cache_key(request, version)
+            data = cache.get(key)
+            if data is None:
+                response = handler(request, *args, **kwargs)
+                if response.status_code != 200:
+                    return response
+                cache.set(key, response.data, settings.CATALOG_CACHE_TIMEOUT)
+            else:
+                response = Response(data)
+        return add_catalog_headers(response, version)
@@ -1,6 +1,7 @@
 import django_filters
-from rest_framework.filters import SearchFilter
+from rest_framework.filters import BaseFilterBackend, SearchFilter
 
+from shops import search
 from shops.models import Shop, Product, Category, Subcategory, Messenger
 
 
@@ -20,6 +21,22 @@ class MessengerFilter(SearchFilter):
         fields = ('name', )
 
 
+def search_queryset(queryset, kind, query):
+    """Объекты, найденные по индексу, в порядке релевантности."""
+    return search.rank(queryset, kind, query)
+
+
+class FullTextSearchFilter(BaseFilterBackend):
+    """Полнотекстовый поиск по индексу с сортировкой по релевантности."""
+    search_param = 'search'
+
+    def filter_queryset(self, request, queryset, view):
+        query = request.query_params.get(self.search_param, '').strip()
+        if not query:
+            return queryset
+        return search_queryset(queryset, view.search_kind, query)
+
+
 class ShopFilter(django_filters.FilterSet):
     # categorys = django_filters.ModelMultipleChoiceFilter(
     #     field_name='categorys__slug',
@@ -34,13 +51,19 @@ class ShopFilter(django_filters.FilterSet):
     is_favorited_shops = django_filters.NumberFilter(
         method='filter_is_favorited_shops',
     )
+    min_followers = django_filters.NumberFilter(
+        field_name='followers_count', lookup_expr='gte',
+    )
+    ordering = django_filters.OrderingFilter(
+        fields=(('followers_count', 'popularity'), ('name', 'name')),
+    )
     # is_favorited_products = django_filters.NumberFilter(
     #     method='filter_is_favorited_products',
     # )
 
     class Meta:
         model = Shop
-        fields = ('owner', 'is_favorited_shops', )
+        fields = ('owner', 'is_favorited_shops', 'min_followers', )
 
     def filter_is_favorited_shops(self, queryset, name, value):
         user = self.request.user
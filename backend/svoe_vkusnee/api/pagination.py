@@ -1,6 +1,80 @@
+from django.core.paginator import Paginator
+from django.utils.functional import cached_property
+from rest_framework import pagination
 from rest_framework.pagination import PageNumberPagination
 
+from shops.paginators import get_cached_count
+
+
+class CachedCountPaginator(Paginator):
+    """Пагинатор с кэшированным числом объектов."""
+
+    @cached_property
+    def count(self):
+        return get_cached_count(self.object_list)
+
+
+class CursorPagination(pagination.CursorPagination):
+    """Курсорная пагинация: без COUNT(*) и OFFSET на каждой странице."""
+
+    page_size = 6
+    page_size_query_param = 'limit'
+    ordering = ('name', 'id')
+    count_query_param = 'count'
+
+    def get_ordering(self, request, queryset, view):
+        return tuple(getattr(view, 'cursor_ordering', None) or self.ordering)
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) == 'cached':
+            self.count = get_cached_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = super().get_paginated_response(data)
+        if self.count is not None:
+            response.data['count'] = self.count
+            response.data.move_to_end('count', last=False)
+        return response
+
+    def _get_position_from_instance(self, instance, ordering):
+        value = instance
+        for attr in ordering[0].lstrip('-').split('__'):
+            value = getattr(value, attr)
+        return str(value)
+
 
 class Pagination(PageNumberPagination):
+    """Постраничная пагинация с курсорным режимом по запросу.
+
+    Курсорный режим включается параметром cursor (первая страница:
+    ?cursor=) на представлениях с атрибутом cursor_ordering.
+    ?count=cached берёт число объектов из кэша вместо COUNT(*).
+    """
+
     page_size = 6
     page_size_query_param = 'limit'
+    cursor_query_param = 'cursor'
+    count_query_param = 'count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        if (self.cursor_query_param in request.query_params
+                and getattr(view, 'cursor_ordering', None)):
+            self.cursor_paginator = CursorPagination()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view)
+        if request.query_params.get(self.count_query_param) == 'cached':
+            self.django_paginator_class = CachedCountPaginator
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def get_html_context(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_html_context()
+        return super().get_html_context()
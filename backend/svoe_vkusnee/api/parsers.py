@@ -0,0 +1,40 @@
+import json
+
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import BaseParser, FileUploadParser
+
+
+class JSONLinesParser(BaseParser):
+    """Разбор тела из JSON-объектов по одному на строку.
+
+    Тело читается построчно, без загрузки целиком в память.
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        items = []
+        for number, line in enumerate(stream, start=1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                items.append(json.loads(line.decode(encoding)))
+            except ValueError as error:
+                raise ParseError(f'Строка {number}: {error}')
+        return items
+
+
+class ImageUploadParser(FileUploadParser):
+    """Изображение в теле запроса целиком, например image/jpeg.
+
+    Тело пишется обработчиками загрузки Django во временный файл,
+    имя файла необязательно.
+    """
+    media_type = 'image/*'
+
+    def get_filename(self, stream, media_type, parser_context):
+        return super().get_filename(
+            stream, media_type, parser_context) or 'upload'
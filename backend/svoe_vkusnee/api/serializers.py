@@ -14,8 +14,17 @@ from shops.models import (Shop,
                           Messenger
 )
 
+from django.db import transaction
 from django.shortcuts import get_object_or_404
 from drf_extra_fields.fields import Base64ImageField
+from shops.signals import shops_bulk_created
+
+from .basket import availability_index
+from .thumbnails import ThumbnailField
+from .utils import get_favorited_shop_ids, get_following_ids
+
+# Сторона миниатюр в списках, полные изображения остаются в photo и logo.
+THUMBNAIL_SIZE = 320
 
 
 class UserCustomCreateSerializer(UserCreateSerializer):
@@ -54,14 +63,28 @@ class UserCustomSerializer(UserSerializer):
             'first_name',
             'last_name',
             'phone_number',
-            'is_subscribed'
+            'is_subscribed',
+            'followers_count',
+            'shops_count'
         )
-    
+
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return Follow.objects.filter(user=user, owner=obj).exists()
+        return obj.id in get_following_ids(self.context.get('request'))
+
+
+class ShopOwnerSerializer(UserCustomSerializer):
+    """Сериализатор для владельца магазина."""
+
+    class Meta(UserCustomSerializer.Meta):
+        fields = (
+            'id',
+            'email',
+            'username',
+            'first_name',
+            'last_name',
+            'phone_number',
+            'is_subscribed'
+        )
 
 
 class FollowSerializer(serializers.ModelSerializer):
@@ -74,6 +97,8 @@ class FollowSerializer(serializers.ModelSerializer):
     phone_number = serializers.CharField(source='owner.phone_number')
     is_subscribed = serializers.SerializerMethodField(read_only=True)
     shops = serializers.SerializerMethodField()
+    shops_count = serializers.IntegerField(
+        source='owner.shops_count', read_only=True)
 
     class Meta:
         model = Follow
@@ -85,31 +110,30 @@ class FollowSerializer(serializers.ModelSerializer):
             'last_name',
             'phone_number',
             'is_subscribed',
-            'shops'
+            'shops',
+            'shops_count'
         )
 
     def get_is_subscribed(self, obj):
-        user = self.context.get('request').user
-        owner = obj.owner
-        if user.is_authenticated:
-            return Follow.objects.filter(user=user, owner=owner).exists()
-        return False
+        request = self.context.get('request')
+        if request.user.is_authenticated and obj.user_id == request.user.id:
+            return True
+        return obj.owner_id in get_following_ids(request)
 
     def get_shops(self, obj):
         request = self.context.get('request')
-        shops = Shop.objects.filter(owner=obj.owner)
-        limit = request.GET.get('shops_limit')
-        if limit:
-            shops = shops[:int(limit)]
+        shops = getattr(obj.owner, 'limited_shops', None)
+        if shops is None:
+            shops = Shop.objects.filter(owner=obj.owner)
+            limit = request.GET.get('shops_limit')
+            if limit and limit.isdigit():
+                shops = shops[:int(limit)]
         return ShopFieldSerializer(
             shops,
             many=True,
             context={'request': request}
         ).data
 
-    def get_shops_count(self, obj):
-        return Shop.objects.filter(owner=obj.owner).count()
-
 
 class ProductSerializer(serializers.ModelSerializer):
     """Сериализатор для товаров."""
@@ -121,19 +145,24 @@ class ProductSerializer(serializers.ModelSerializer):
             'name',
             'photo',
             'description',
-            'subcategory'
+            'subcategory',
+            'favorites_count',
         )
 
 
 class MessengerSerializer(serializers.ModelSerializer):
     """Сериализатор для мессенджеров."""
 
+    logo_thumbnail = ThumbnailField(
+        source='logo', width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+
     class Meta:
         model = Messenger
         fields = (
             'id',
             'name',
             'logo',
+            'logo_thumbnail',
         )
 
 class SubcategorySerializer(serializers.ModelSerializer):
@@ -152,12 +181,16 @@ class SubcategorySerializer(serializers.ModelSerializer):
 class CategorySerializer(serializers.ModelSerializer):
     """Сериализатор для категории."""
 
+    photo_thumbnail = ThumbnailField(
+        source='photo', width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+
     class Meta:
         model = Category
         fields = (
             'id',
             'name',
             'photo',
+            'photo_thumbnail',
             'slug'
         )
 
@@ -177,10 +210,27 @@ class ShopProductSerializer(serializers.ModelSerializer):
         )
 
 
+class PreloadedPrimaryKeyRelatedField(serializers.PrimaryKeyRelatedField):
+    """Связь по id, которая берёт объекты из context['preloaded'],
+    если их загрузили заранее одним запросом."""
+
+    def to_internal_value(self, data):
+        preloaded = self.context.get('preloaded', {}).get(
+            self.get_queryset().model)
+        if preloaded is None:
+            return super().to_internal_value(data)
+        try:
+            return preloaded[int(data)]
+        except KeyError:
+            self.fail('does_not_exist', pk_value=data)
+        except (TypeError, ValueError):
+            self.fail('incorrect_type', data_type=type(data).__name__)
+
+
 class ProductFieldSerializer(serializers.ModelSerializer):
     """Сериализатор для введения полей продукта при создании магазина."""
 
-    id = serializers.PrimaryKeyRelatedField(
+    id = PreloadedPrimaryKeyRelatedField(
         queryset=Product.objects.all(),
     )
     availability = serializers.BooleanField()
@@ -208,7 +258,7 @@ class ShopMessengerSerializer(serializers.ModelSerializer):
 class MessengerFieldSerializer(serializers.ModelSerializer):
     """Сериализатор для введения полей мессенджера при создании магазина."""
 
-    id = serializers.PrimaryKeyRelatedField(
+    id = PreloadedPrimaryKeyRelatedField(
         queryset=Messenger.objects.all(),
     )
     search_information = serializers.CharField()
@@ -223,12 +273,16 @@ class ShopSerializer(serializers.ModelSerializer):
 
     # category = CategorySerializer(many=True, read_only=True)
     # subcategory = SubcategorySerializer(many=True, read_only=True)
-    owner = UserSerializer(read_only=True, many=False)
+    owner = ShopOwnerSerializer(read_only=True, many=False)
     products = serializers.SerializerMethodField()
     messengers = serializers.SerializerMethodField()
     is_favorited_shops = serializers.SerializerMethodField()
     # is_favorited_products = serializers.SerializerMethodField()
     photo = Base64ImageField()
+    photo_thumbnail = ThumbnailField(
+        source='photo', width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+    logo_thumbnail = ThumbnailField(
+        source='logo', width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
 
     class Meta:
         model = Shop
@@ -237,6 +291,7 @@ class ShopSerializer(serializers.ModelSerializer):
             'owner',
             'name',
             'photo',
+            'photo_thumbnail',
             'mainstream',
             'description',
             'region',
@@ -251,27 +306,32 @@ class ShopSerializer(serializers.ModelSerializer):
             'delivery',
             'contacts',
             'logo',
+            'logo_thumbnail',
             'products',
             # 'category',
             # 'subcategory',
             'is_favorited_shops',
+            'followers_count',
             # 'is_favorited_products',
             'messengers',
         )
 
     def get_products(self, obj):
-        products = ShopProduct.objects.filter(shop=obj)
+        products = getattr(obj, 'shop_products', None)
+        if products is None:
+            products = ShopProduct.objects.filter(
+                shop=obj).select_related('product')
         return ShopProductSerializer(products, many=True).data
 
     def get_messengers(self, obj):
-        messengers = ShopMessenger.objects.filter(shop=obj)
+        messengers = getattr(obj, 'shop_messengers', None)
+        if messengers is None:
+            messengers = ShopMessenger.objects.filter(
+                shop=obj).select_related('messenger')
         return ShopMessengerSerializer(messengers, many=True).data
 
     def get_is_favorited_shops(self, obj):
-        user = self.context.get('request').user
-        if user.is_anonymous:
-            return False
-        return user.favorite_shops.filter(shop=obj).exists()
+        return obj.id in get_favorited_shop_ids(self.context.get('request'))
 
     # def get_is_favorited_products(self, obj):
     #     user = self.context.get('request').user
@@ -292,7 +352,7 @@ class ShopCreateSerializer(serializers.ModelSerializer):
     products = ProductFieldSerializer(many=True)
     messengers = MessengerFieldSerializer(many=True)
     owner = UserCustomSerializer(read_only=True)
-    photo = Base64ImageField()
+    photo = Base64ImageField(required=False)
 
     class Meta:
         model = Shop
@@ -322,6 +382,8 @@ class ShopCreateSerializer(serializers.ModelSerializer):
     def validate(self, data):
         """Проверка наличия товаров, субкатегорий, категорий."""
         products = self.initial_data.get('products')
+        if products is None and self.partial:
+            return data
         if not products:
             raise serializers.ValidationError({
                 'products': 'Необходимо выбрать товар.'
@@ -348,24 +410,97 @@ class ShopCreateSerializer(serializers.ModelSerializer):
         return data
 
     def create_products(self, products, shop):
-        """Создание товара."""
-        for product in products:
-            product_id = product['id']
-            availability = product['availability']
-            ShopProduct.objects.create(
-                shop=shop, product=product_id, availability=availability
+        """Создание товаров магазина одним запросом."""
+        shop_products = ShopProduct.objects.bulk_create(
+            ShopProduct(
+                shop=shop,
+                product=product['id'],
+                availability=product['availability']
             )
+            for product in products
+        )
+        availability_index.set_availabilities(shop.id, {
+            shop_product.product_id: shop_product.availability
+            for shop_product in shop_products
+        })
 
     def create_messengers(self, messengers, shop):
-        """Создание мессенджера."""
-        for messenger in messengers:
-            messenger_id = messenger['id']
-            search_information = messenger['search_information']
-            ShopMessenger.objects.create(
+        """Создание мессенджеров магазина одним запросом."""
+        ShopMessenger.objects.bulk_create(
+            ShopMessenger(
                 shop=shop,
-                messenger=messenger_id,
-                search_information = search_information
+                messenger=messenger['id'],
+                search_information=messenger['search_information']
             )
+            for messenger in messengers
+        )
+
+    def update_products(self, products, shop):
+        """Изменение только добавленных, изменённых и удалённых товаров."""
+        existing = {
+            shop_product.product_id: shop_product
+            for shop_product in ShopProduct.objects.filter(shop=shop)
+        }
+        wanted = {
+            product['id'].id: product['availability'] for product in products
+        }
+        changed = {}
+        for product_id, availability in wanted.items():
+            shop_product = existing.get(product_id)
+            if shop_product and shop_product.availability != availability:
+                shop_product.availability = availability
+                changed[product_id] = shop_product
+        ShopProduct.objects.filter(id__in=[
+            shop_product.id for product_id, shop_product in existing.items()
+            if product_id not in wanted
+        ]).delete()
+        ShopProduct.objects.bulk_update(changed.values(), ('availability',))
+        ShopProduct.objects.bulk_create(
+            ShopProduct(
+                shop=shop, product_id=product_id, availability=availability)
+            for product_id, availability in wanted.items()
+            if product_id not in existing
+        )
+        availability_index.set_availabilities(shop.id, {
+            product_id: availability
+            for product_id, availability in wanted.items()
+            if product_id not in existing or product_id in changed
+        })
+
+    def update_messengers(self, messengers, shop):
+        """Изменение только добавленных, изменённых и удалённых
+        мессенджеров."""
+        existing = {
+            shop_messenger.messenger_id: shop_messenger
+            for shop_messenger in ShopMessenger.objects.filter(shop=shop)
+        }
+        wanted = {
+            messenger['id'].id: messenger['search_information']
+            for messenger in messengers
+        }
+        changed = []
+        for messenger_id, search_information in wanted.items():
+            shop_messenger = existing.get(messenger_id)
+            if (shop_messenger
+                    and shop_messenger.search_information
+                    != search_information):
+                shop_messenger.search_information = search_information
+                changed.append(shop_messenger)
+        ShopMessenger.objects.filter(id__in=[
+            shop_messenger.id
+            for messenger_id, shop_messenger in existing.items()
+            if messenger_id not in wanted
+        ]).delete()
+        ShopMessenger.objects.bulk_update(changed, ('search_information',))
+        ShopMessenger.objects.bulk_create(
+            ShopMessenger(
+                shop=shop,
+                messenger_id=messenger_id,
+                search_information=search_information
+            )
+            for messenger_id, search_information in wanted.items()
+            if messenger_id not in existing
+        )
 
     # def create_categorys(self, categorys, shop):
     #     """Создание категорий"""
@@ -384,39 +519,25 @@ class ShopCreateSerializer(serializers.ModelSerializer):
         # subcategorys = validated_data.pop('subcategorys')
         products = validated_data.pop('products')
         messengers = validated_data.pop('messengers')
-        shop = Shop.objects.create(owner=owner, **validated_data)
-        # self.create_categorys(categorys, shop)
-        # self.create_subcategorys(subcategorys, shop)
-        self.create_products(products, shop)
-        self.create_messengers(messengers, shop)
+        with transaction.atomic():
+            shop = Shop.objects.create(owner=owner, **validated_data)
+            # self.create_categorys(categorys, shop)
+            # self.create_subcategorys(subcategorys, shop)
+            self.create_products(products, shop)
+            self.create_messengers(messengers, shop)
         return shop
 
     def update(self, instance, validated_data):
-        """Обновление магазина."""
-        instance.photo = validated_data.get('photo', instance.photo)
-        instance.name = validated_data.get('name', instance.name)
-        instance.description = validated_data.get(
-            'description', instance.description)
-        instance.mainstream = validated_data.get(
-            'mainstream', instance.mainstream)
-        instance.region = validated_data.get('region', instance.region)
-        instance.city = validated_data.get('city', instance.city)
-        instance.street = validated_data.get('street', instance.street)
-        instance.house = validated_data.get('house', instance.house)
-        instance.history = validated_data.get('history', instance.history)
-        instance.coordinates = validated_data.get(
-            'coordinates', instance.coordinates)
-        instance.certificate = validated_data.get(
-            'certificate', instance.certificate)
-        instance.certificate_photo = validated_data.get(
-            'certificate_photo', instance.certificate_photo)
-        instance.presented = validated_data.get(
-            'presented', instance.presented)
-        instance.delivery = validated_data.get(
-            'delivery', instance.delivery)
-        instance.contacts = validated_data.get(
-            'contacts', instance.contacts)
-        instance.logo = validated_data.get('logo', instance.logo)
+        """Обновление магазина: сохраняются только изменённые поля,
+        не переданные товары и мессенджеры не затрагиваются."""
+        products = validated_data.pop('products', None)
+        messengers = validated_data.pop('messengers', None)
+        changed = [
+            field for field, value in validated_data.items()
+            if getattr(instance, field) != value
+        ]
+        for field in changed:
+            setattr(instance, field, validated_data[field])
 
         # instance.categorys.clear()
         # categorys = validated_data.get('categorys')
@@ -426,15 +547,13 @@ class ShopCreateSerializer(serializers.ModelSerializer):
         # subcategorys = validated_data.get('subcategorys')
         # self.create_subcategorys(subcategorys, instance)
 
-        ShopProduct.objects.filter(shop=instance).all().delete()
-        products = validated_data.get('products')
-        self.create_products(products, instance)
-
-        ShopMessenger.objects.filter(shop=instance).all().delete()
-        messengers = validated_data.get('messengers')
-        self.create_messengers(messengers, instance)
-
-        instance.save()
+        with transaction.atomic():
+            if changed:
+                instance.save(update_fields=changed)
+            if products is not None:
+                self.update_products(products, instance)
+            if messengers is not None:
+                self.update_messengers(messengers, instance)
         return instance
 
     def to_representation(self, instance):
@@ -444,15 +563,79 @@ class ShopCreateSerializer(serializers.ModelSerializer):
             instance, context=context).data
 
 
+class ShopBulkCreateSerializer(ShopCreateSerializer):
+    """Сериализатор магазина при массовом создании.
+
+    Занятые названия и логины проверяются по множествам из контекста,
+    загруженным одним запросом на весь список.
+    """
+
+    class Meta(ShopCreateSerializer.Meta):
+        extra_kwargs = {'name': {'validators': []}}
+
+    def validate_name(self, value):
+        if value in self.context['taken_names']:
+            raise serializers.ValidationError(
+                'Магазин с таким названием уже существует.')
+        return value
+
+    def validate_messengers(self, value):
+        taken = self.context['taken_logins'].intersection(
+            messenger['search_information'] for messenger in value)
+        if taken:
+            raise serializers.ValidationError(
+                f'Логины уже заняты: {", ".join(sorted(taken))}.')
+        return value
+
+    @staticmethod
+    def bulk_create(items, owner):
+        """Создание магазинов и их связей пакетными запросами."""
+        shops = []
+        for data in items:
+            shop = Shop(owner=owner, **{
+                field: value for field, value in data.items()
+                if field not in ('products', 'messengers')
+            })
+            shop.update_location()
+            shops.append(shop)
+        with transaction.atomic():
+            Shop.objects.bulk_create(shops)
+            shop_products = ShopProduct.objects.bulk_create([
+                ShopProduct(
+                    shop=shop,
+                    product=product['id'],
+                    availability=product['availability']
+                )
+                for shop, data in zip(shops, items)
+                for product in data['products']
+            ])
+            ShopMessenger.objects.bulk_create(
+                ShopMessenger(
+                    shop=shop,
+                    messenger=messenger['id'],
+                    search_information=messenger['search_information']
+                )
+                for shop, data in zip(shops, items)
+                for messenger in data['messengers']
+            )
+        shops_bulk_created.send(
+            sender=Shop, shops=shops, shop_products=shop_products)
+        return shops
+
+
 class ShopFieldSerializer(serializers.ModelSerializer):
     """Сериализатор для получения полей магазина."""
 
+    photo_thumbnail = ThumbnailField(
+        source='photo', width=THUMBNAIL_SIZE, height=THUMBNAIL_SIZE)
+
     class Meta:
         model = Shop
         fields = (
             'id',
             'name',
             'photo',
+            'photo_thumbnail',
             'mainstream',
             'products',
         )
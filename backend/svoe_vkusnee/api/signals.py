@@ -0,0 +1,133 @@
+from django.contrib.auth.signals import user_logged_in
+from django.db.models.signals import post_delete, post_save
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+
+from shops.signals import (SAVED_SHOP_FIELDS, catalog_imported,
+                           shops_bulk_created)
+from shops.models import (Category, FavoriteProduct, FavoriteShop, Messenger,
+                          Product, Shop, ShopProduct, Subcategory)
+from svoe_vkusnee.replicas import stick_to_primary
+from users.models import User
+
+from .authentication import token_cache
+from .basket import availability_index
+from .cache import bump_catalog_version
+from .tiles import invalidate_tiles
+
+# Справочники, которые загружает импорт, по виду строк.
+IMPORTED_CATALOGS = {
+    'categories': Category,
+    'subcategories': Subcategory,
+    'products': Product,
+    'messengers': Messenger,
+}
+
+
+def catalog_changed(sender, **kwargs):
+    """Изменение записи справочника делает устаревшими его ответы."""
+    bump_catalog_version(sender)
+
+
+def catalog_rows_imported(sender, kind, **kwargs):
+    bump_catalog_version(IMPORTED_CATALOGS[kind])
+
+
+for model in IMPORTED_CATALOGS.values():
+    post_save.connect(catalog_changed, sender=model)
+    post_delete.connect(catalog_changed, sender=model)
+catalog_imported.connect(catalog_rows_imported)
+
+
+def product_favorited(sender, instance, created=True, **kwargs):
+    """favorites_count есть только в ответах товаров и задаёт порядок
+    ?ordering=favorites_count, остальные справочники остаются в кэше."""
+    if created:
+        bump_catalog_version(Product)
+
+
+def shop_favorited(sender, instance, created=True, **kwargs):
+    """От followers_count зависят тайлы с фильтром min_followers."""
+    if created:
+        invalidate_tiles(Shop.objects.filter(pk=instance.shop_id).values_list(
+            'latitude', 'longitude').first() or (None, None))
+
+
+for signal in (post_save, post_delete):
+    signal.connect(product_favorited, sender=FavoriteProduct)
+    signal.connect(shop_favorited, sender=FavoriteShop)
+
+
+def shop_saved(sender, instance, created, **kwargs):
+    """Сбрасывает тайлы, если магазин появился, переехал или сменил
+    владельца. Прежние значения загружает remember_saved_shop."""
+    state = getattr(instance, '_saved_state', None)
+    before = state and tuple(state[field] for field in SAVED_SHOP_FIELDS)
+    after = tuple(getattr(instance, field) for field in SAVED_SHOP_FIELDS)
+    if created or (before is not None and before != after):
+        locations = [after[1:]]
+        if before is not None:
+            locations.append(before[1:])
+        invalidate_tiles(*locations)
+        availability_index.set_location(instance.pk, *after[1:])
+
+
+def shop_deleted(sender, instance, **kwargs):
+    invalidate_tiles((instance.latitude, instance.longitude))
+    availability_index.set_location(instance.pk, None, None)
+
+
+def shops_created(sender, shops, shop_products, **kwargs):
+    """Тайлы и индекс наличия для магазинов, созданных пакетно."""
+    invalidate_tiles(*((shop.latitude, shop.longitude) for shop in shops))
+    for shop in shops:
+        availability_index.set_location(
+            shop.pk, shop.latitude, shop.longitude)
+    for shop_product in shop_products:
+        availability_index.set_availability(
+            shop_product.shop_id, shop_product.product_id,
+            shop_product.availability)
+
+
+def shop_product_saved(sender, instance, **kwargs):
+    availability_index.set_availability(
+        instance.shop_id, instance.product_id, instance.availability)
+
+
+def shop_product_deleted(sender, instance, **kwargs):
+    availability_index.set_availability(
+        instance.shop_id, instance.product_id, False)
+
+
+post_save.connect(shop_saved, sender=Shop)
+post_delete.connect(shop_deleted, sender=Shop)
+shops_bulk_created.connect(shops_created)
+post_save.connect(shop_product_saved, sender=ShopProduct)
+post_delete.connect(shop_product_deleted, sender=ShopProduct)
+
+
+def token_deleted(sender, instance, **kwargs):
+    """Выход из системы и удаление пользователя."""
+    token_cache.invalidate(instance.key)
+
+
+def user_saved(sender, instance, created, **kwargs):
+    """Смена пароля, деактивация и любое другое изменение пользователя."""
+    if created:
+        return
+    keys = list(Token.objects.filter(
+        user=instance).values_list('key', flat=True))
+    if keys:
+        token_cache.invalidate(*keys)
+
+
+def user_logged_in_with_token(sender, request, user, **kwargs):
+    """Реплика может ещё не знать новый токен и пользователя."""
+    token = Token.objects.filter(user=user).first()
+    if token is not None:
+        stick_to_primary(f'{TokenAuthentication.keyword} {token.key}')
+
+
+post_delete.connect(token_deleted, sender=Token)
+post_save.connect(user_saved, sender=User)
+user_logged_in.connect(user_logged_in_with_token)
@@ -1,3 +1,1156 @@
-from django.test import TestCase
+import asyncio
+import base64
+import io
+import json
+import shutil
+import tempfile
+import threading
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import (DatabaseError, IntegrityError, connection, router,
+                       transaction)
+from django.db.models import QuerySet
+from django.http import HttpResponse
+from django.test import RequestFactory, SimpleTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from PIL import Image
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.serializers import ListSerializer, Serializer
+from rest_framework.test import APITestCase
+
+from api.authentication import cache_key, token_cache
+from api.basket import availability_index
+from api.thumbnails import disk_cache
+from api.uploads import SizeLimitUploadHandler, process_image_in_worker
+from shops.models import (FavoriteProduct, FavoriteShop, Messenger,
+                          Product, Shop, ShopMessenger, ShopProduct)
+from svoe_vkusnee.replicas import ReplicaMiddleware, client_key
+from svoe_vkusnee.timing import TimingMiddleware, timed
+from users.models import Follow, User
+
+MEDIA_ROOT = tempfile.mkdtemp()
+
+
+def image_bytes(size=(4, 4), image_format='PNG'):
+    buffer = io.BytesIO()
+    Image.new('RGB', size, 'green').save(buffer, format=image_format)
+    return buffer.getvalue()
+
+
+def image_base64(size=(4, 4)):
+    """Картинка PNG в формате, который принимает Base64ImageField."""
+    return ('data:image/png;base64,'
+            + base64.b64encode(image_bytes(size)).decode())
+
+
+class ShopListQueriesTest(APITestCase):
+    """Число запросов списка магазинов не зависит от размера страницы."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        cls.token = Token.objects.create(user=cls.user)
+        owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        products = Product.objects.bulk_create(
+            Product(name=f'product {i}', description='') for i in range(3))
+        messenger = Messenger.objects.create(name='telegram')
+        for i in range(10):
+            shop = Shop.objects.create(name=f'shop {i}', owner=owner)
+            for product in products:
+                ShopProduct.objects.create(
+                    shop=shop, product=product, availability=True)
+            ShopMessenger.objects.create(
+                shop=shop, messenger=messenger,
+                search_information=f'login {i}')
+            if i % 2:
+                FavoriteShop.objects.create(user=cls.user, shop=shop)
+
+    def setUp(self):
+        # The token is resolved from the token cache without queries.
+        token_cache.get(self.token.key)
+
+    def test_list_query_budget(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        url = reverse('api:shops-list')
+        # count, shops+owner, products, messengers, favorites, follows
+        for limit in (2, 10):
+            with self.assertNumQueries(6):
+                response = self.client.get(url, {'limit': limit})
+            self.assertEqual(len(response.data['results']), limit)
+        shop = response.data['results'][1]
+        self.assertTrue(shop['is_favorited_shops'])
+        self.assertEqual(len(shop['products']), 3)
+        self.assertEqual(shop['messengers'][0]['name'], 'telegram')
+
+    def test_anonymous_list_query_budget(self):
+        with self.assertNumQueries(4):
+            response = self.client.get(
+                reverse('api:shops-list'), {'limit': 10})
+        self.assertFalse(response.data['results'][0]['is_favorited_shops'])
+
+    def test_detail_query_budget(self):
+        shop = Shop.objects.get(name='shop 1')
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        with self.assertNumQueries(5):
+            response = self.client.get(
+                reverse('api:shops-detail', args=(shop.id,)))
+        self.assertTrue(response.data['is_favorited_shops'])
+
+
+class SubscriptionsQueriesTest(APITestCase):
+    """Подписки собираются за фиксированное число запросов."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        cls.token = Token.objects.create(user=cls.user)
+        product = Product.objects.create(name='milk', description='')
+        for i in range(5):
+            owner = User.objects.create_user(
+                email=f'owner{i}@example.com', username=f'owner{i}',
+                password='pass')
+            Follow.objects.create(user=cls.user, owner=owner)
+            for j in range(i + 1):
+                shop = Shop.objects.create(
+                    name=f'shop {i}-{j}', owner=owner)
+                shop.products.add(product, through_defaults={})
+
+    def setUp(self):
+        token_cache.get(self.token.key)
+
+    def test_subscriptions_query_budget(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        url = reverse('api:users-subscriptions')
+        # count, follows+owners, limited shops, shop products
+        for limit in (2, 5):
+            with self.assertNumQueries(4):
+                response = self.client.get(
+                    url, {'limit': limit, 'shops_limit': 2})
+            self.assertEqual(len(response.data['results']), limit)
+        for follow in response.data['results']:
+            self.assertTrue(follow['is_subscribed'])
+            self.assertEqual(
+                len(follow['shops']), min(follow['shops_count'], 2))
+        self.assertEqual(
+            sorted(f['shops_count'] for f in response.data['results']),
+            [1, 2, 3, 4, 5])
+
+    def test_subscriptions_cursor(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.get(
+            reverse('api:users-subscriptions'), {'cursor': '', 'limit': 3})
+        self.assertEqual(
+            [f['username'] for f in response.data['results']],
+            ['owner0', 'owner1', 'owner2'])
+        response = self.client.get(response.data['next'])
+        self.assertEqual(
+            [f['username'] for f in response.data['results']],
+            ['owner3', 'owner4'])
+
+
+class UserListQueriesTest(APITestCase):
+    """Подписка и счётчики пользователей без запросов на каждую строку."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        cls.token = Token.objects.create(user=cls.user)
+        for i in range(6):
+            owner = User.objects.create_user(
+                email=f'owner{i}@example.com', username=f'owner{i}',
+                password='pass')
+            Shop.objects.create(name=f'shop {i}', owner=owner)
+            if i % 2:
+                Follow.objects.create(user=cls.user, owner=owner)
+
+    def setUp(self):
+        token_cache.get(self.token.key)
+
+    def test_users_list_query_budget(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        # count, users, follows
+        with self.assertNumQueries(3):
+            response = self.client.get(
+                reverse('api:users-list'), {'limit': 7})
+        users = {user['username']: user for user in response.data['results']}
+        self.assertTrue(users['owner1']['is_subscribed'])
+        self.assertFalse(users['owner2']['is_subscribed'])
+        self.assertEqual(users['owner1']['followers_count'], 1)
+        self.assertEqual(users['owner1']['shops_count'], 1)
+        self.assertEqual(users['buyer']['shops_count'], 0)
+
+
+class CatalogCacheTest(APITestCase):
+    """Справочники отдаются из кэша до изменения любой их записи."""
+
+    def setUp(self):
+        cache.clear()
+        self.product = Product.objects.create(name='milk', description='')
+
+    def test_cached_until_catalog_changes(self):
+        url = reverse('api:products-list')
+        with self.assertNumQueries(1):
+            response = self.client.get(url)
+        etag = response['ETag']
+        with self.assertNumQueries(0):
+            cached = self.client.get(url)
+        self.assertEqual(cached.data, response.data)
+        self.assertEqual(cached['ETag'], etag)
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        self.product.name = 'kefir'
+        self.product.save()
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(response.data[0]['name'], 'kefir')
+
+    def test_favorites_change_cached_counts(self):
+        url = reverse('api:products-list')
+        self.assertEqual(self.client.get(url).data[0]['favorites_count'], 0)
+        user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        favorite = FavoriteProduct.objects.create(
+            user=user, product=self.product)
+        self.assertEqual(self.client.get(url).data[0]['favorites_count'], 1)
+        favorite.delete()
+        self.assertEqual(self.client.get(url).data[0]['favorites_count'], 0)
+
+    @override_settings(ALLOWED_HOSTS=['api.example.com', 'internal'])
+    def test_cached_per_host(self):
+        # Абсолютные ссылки ответа для одного хоста не отдаются другому.
+        url = reverse('api:products-list')
+        self.client.get(url, HTTP_HOST='api.example.com')
+        with self.assertNumQueries(1):
+            self.client.get(url, HTTP_HOST='internal')
+        with self.assertNumQueries(0):
+            self.client.get(url, HTTP_HOST='api.example.com')
+
+    def test_favorites_keep_other_catalogs_cached(self):
+        url = reverse('api:categorys-list')
+        etag = self.client.get(url)['ETag']
+        user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        FavoriteProduct.objects.create(user=user, product=self.product)
+        self.product.save()
+        with self.assertNumQueries(0):
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+
+class CursorPaginationTest(APITestCase):
+    """Курсорный режим не считает COUNT(*) и не использует OFFSET."""
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        for i in range(5):
+            Shop.objects.create(name=f'shop {i}', owner=owner)
+
+    def setUp(self):
+        cache.clear()
+
+    def test_cursor_pages(self):
+        url = reverse('api:shops-list')
+        names = []
+        params = {'cursor': '', 'limit': 2}
+        while True:
+            # shops+owner, products, messengers
+            with self.assertNumQueries(3):
+                response = self.client.get(url, params)
+            self.assertNotIn('count', response.data)
+            names += [shop['name'] for shop in response.data['results']]
+            if not response.data['next']:
+                break
+            url, params = response.data['next'], {}
+        self.assertEqual(names, [f'shop {i}' for i in range(5)])
+
+    def test_cached_count(self):
+        url = reverse('api:shops-list')
+        response = self.client.get(url, {'cursor': '', 'count': 'cached'})
+        self.assertEqual(response.data['count'], 5)
+        Shop.objects.create(name='shop 5')
+        response = self.client.get(url, {'count': 'cached'})
+        self.assertEqual(response.data['count'], 5)
+        response = self.client.get(url)
+        self.assertEqual(response.data['count'], 6)
+
+    def test_cached_count_without_matches(self):
+        url = reverse('api:shops-list')
+        for params in ({}, {'cursor': ''}):
+            response = self.client.get(
+                url, {**params, 'search': 'zzzz', 'count': 'cached'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.data['count'], 0)
+            self.assertEqual(response.data['results'], [])
+
+
+class FullTextSearchTest(APITestCase):
+
+    def test_shops_search(self):
+        Shop.objects.create(name='Сыроварня', description='Твёрдые сыры')
+        Shop.objects.create(name='Пасека', history='Начинали с сыров и мёда')
+        Shop.objects.create(name='Ферма', description='Молоко')
+        response = self.client.get(
+            reverse('api:shops-list'), {'search': 'сыр'})
+        self.assertEqual(
+            [shop['name'] for shop in response.data['results']],
+            ['Сыроварня', 'Пасека'])
+
+    @override_settings(SEARCH_MAX_RESULTS=1)
+    def test_search_is_not_capped_before_filters(self):
+        for i in range(3):
+            Shop.objects.create(name=f'Сыроварня {i}', description='Сыры')
+        Shop.objects.exclude(name='Сыроварня 0').update(followers_count=5)
+        response = self.client.get(
+            reverse('api:shops-list'), {'search': 'сыр', 'min_followers': 5})
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            {shop['name'] for shop in response.data['results']},
+            {'Сыроварня 1', 'Сыроварня 2'})
+
+
+class NearbyShopsTest(APITestCase):
+
+    def test_nearby(self):
+        Shop.objects.create(name='Близко', coordinates='55.7520, 37.6175')
+        Shop.objects.create(name='Далеко', coordinates='56.8587, 35.9176')
+        url = reverse('api:shops-nearby')
+        response = self.client.get(
+            url, {'lat': 55.7539, 'lon': 37.6208, 'radius': 50})
+        self.assertEqual([shop['name'] for shop in response.data], ['Близко'])
+        self.assertLess(response.data[0]['distance'], 1)
+        response = self.client.get(url, {'lat': 55.7539, 'lon': 37.6208})
+        self.assertEqual(
+            [shop['name'] for shop in response.data], ['Близко', 'Далеко'])
+        response = self.client.get(url, {'lat': 'север'})
+        self.assertEqual(response.status_code, 400)
+
+
+class ShopTilesTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+        Shop.objects.create(name='Кремль', coordinates='55.7520, 37.6175')
+        Shop.objects.create(name='Арбат', coordinates='55.7494, 37.5911')
+
+    def test_tile_clusters_are_cached_and_invalidated(self):
+        url = reverse('api:shops-tiles', args=(0, 0, 0))
+        response = self.client.get(url)
+        self.assertEqual(
+            [cluster['count'] for cluster in response.data['clusters']], [2])
+        with self.assertNumQueries(0):
+            self.client.get(url)
+
+        far_url = reverse('api:shops-tiles', args=(1, 0, 0))
+        self.client.get(far_url)
+        Shop.objects.create(name='Тверь', coordinates='56.8587, 35.9176')
+        response = self.client.get(url)
+        self.assertEqual(response.data['clusters'][0]['count'], 3)
+        with self.assertNumQueries(0):
+            self.client.get(far_url)
+
+        response = self.client.get(
+            reverse('api:shops-tiles', args=(18, 0, 0)))
+        self.assertEqual(response.data['clusters'], [])
+        response = self.client.get(
+            reverse('api:shops-tiles', args=(1, 2, 0)))
+        self.assertEqual(response.status_code, 404)
+
+    def test_popularity_filter_follows_favorites(self):
+        url = reverse('api:shops-tiles', args=(0, 0, 0))
+        self.assertEqual(
+            self.client.get(url, {'min_followers': 1}).data['clusters'], [])
+        user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        FavoriteShop.objects.create(
+            user=user, shop=Shop.objects.get(name='Арбат'))
+        clusters = self.client.get(url, {'min_followers': 1}).data['clusters']
+        self.assertEqual([cluster['count'] for cluster in clusters], [1])
+
+
+class BasketTest(APITestCase):
+
+    def setUp(self):
+        availability_index.clear()
+        self.products = Product.objects.bulk_create(
+            Product(name=name, description='')
+            for name in ('мёд', 'молоко', 'сыр'))
+        self.near = Shop.objects.create(
+            name='Рядом', coordinates='55.7520, 37.6175')
+        self.far = Shop.objects.create(
+            name='Далеко', coordinates='56.8587, 35.9176')
+        self.full = Shop.objects.create(name='Всё есть')
+        for shop, products in ((self.near, self.products[:2]),
+                               (self.far, self.products[:2]),
+                               (self.full, self.products)):
+            for product in products:
+                ShopProduct.objects.create(
+                    shop=shop, product=product, availability=True)
+
+    def basket(self, **params):
+        params['products'] = ','.join(str(p.id) for p in self.products)
+        response = self.client.get(reverse('api:shops-basket'), params)
+        return [shop['name'] for shop in response.data]
+
+    def test_ranked_by_coverage_then_distance(self):
+        self.assertEqual(
+            self.basket(lat=56.8, lon=35.9), ['Всё есть', 'Далеко', 'Рядом'])
+        self.assertEqual(
+            self.basket(lat=55.75, lon=37.6), ['Всё есть', 'Рядом', 'Далеко'])
+        self.assertEqual(self.basket(min_matched=3), ['Всё есть'])
+
+    def test_index_follows_writes(self):
+        self.assertEqual(self.basket(limit=1), ['Всё есть'])
+        with self.captureOnCommitCallbacks(execute=True):
+            ShopProduct.objects.filter(
+                shop=self.full, product=self.products[2]).get().delete()
+            shop_product = ShopProduct.objects.get(
+                shop=self.near, product=self.products[0])
+            shop_product.availability = False
+            shop_product.save()
+            # До фиксации индекс не меняется.
+            self.assertEqual(self.basket(limit=1), ['Всё есть'])
+        self.assertEqual(self.basket(), ['Далеко', 'Всё есть', 'Рядом'])
+        self.assertEqual(self.basket(min_matched=2), ['Далеко', 'Всё есть'])
+
+    def test_rolled_back_writes_are_not_indexed(self):
+        self.assertEqual(self.basket(min_matched=3), ['Всё есть'])
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            with self.assertRaises(IntegrityError), transaction.atomic():
+                ShopProduct.objects.filter(shop=self.full).update(
+                    availability=False)
+                availability_index.set_availabilities(
+                    self.full.id, {product.id: False
+                                   for product in self.products})
+                Shop.objects.create(name=None)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.basket(min_matched=3), ['Всё есть'])
+
+    def test_writes_do_not_wait_for_rebuild(self):
+        product_id = self.products[2].id
+        self.assertEqual(self.basket(min_matched=3), ['Всё есть'])
+        load = availability_index._load
+
+        def load_with_concurrent_write():
+            data = load()
+            writer = threading.Thread(
+                target=availability_index.set_availability,
+                args=(self.full.id, product_id, False))
+            writer.start()
+            writer.join(timeout=5)
+            self.assertFalse(writer.is_alive())
+            # The stale index is updated right away.
+            self.assertEqual(self.basket(min_matched=3), [])
+            return data
+
+        with override_settings(BASKET_INDEX_TTL=-1), mock.patch.object(
+                availability_index, '_load', load_with_concurrent_write):
+            availability_index.match([product_id])
+        # The rebuilt index got the write made while it was loaded.
+        self.assertEqual(availability_index.match([product_id]), [])
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class ShopWriteTest(APITestCase):
+    """Изменение магазина пишет только изменившиеся строки."""
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        cls.token = Token.objects.create(user=cls.owner)
+        cls.products = Product.objects.bulk_create(
+            Product(name=f'product {i}', description='') for i in range(4))
+        cls.messenger = Messenger.objects.create(name='telegram')
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        response = self.client.post(reverse('api:shops-list'), {
+            'name': 'Ферма',
+            'city': 'Тверь',
+            'photo': image_base64(),
+            'products': [
+                {'id': self.products[0].id, 'availability': True},
+                {'id': self.products[1].id, 'availability': False},
+                {'id': self.products[2].id, 'availability': True},
+            ],
+            'messengers': [
+                {'id': self.messenger.id, 'search_information': '@farm'},
+            ],
+        }, format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.shop = Shop.objects.get(name='Ферма')
+        self.url = reverse('api:shops-detail', args=(self.shop.id,))
+
+    def writes(self, queries, table):
+        return [
+            query['sql'] for query in queries
+            if table in query['sql'] and not query['sql'].startswith('SELECT')
+        ]
+
+    def test_patch_without_relations(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(
+                self.url, {'city': 'Торжок'}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(response.data['city'], 'Торжок')
+        self.assertEqual(len(response.data['products']), 3)
+        self.assertEqual(self.writes(queries, 'shopproduct'), [])
+        self.assertEqual(self.writes(queries, 'shopmessenger'), [])
+        [update] = self.writes(queries, 'shops_shop"')
+        self.assertIn('"city"', update)
+        self.assertNotIn('"name"', update)
+
+    def test_patch_products_diff(self):
+        kept = ShopProduct.objects.get(
+            shop=self.shop, product=self.products[0])
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(self.url, {'products': [
+                {'id': self.products[0].id, 'availability': True},
+                {'id': self.products[1].id, 'availability': True},
+                {'id': self.products[3].id, 'availability': False},
+            ]}, format='json')
+        self.assertEqual(response.status_code, 200, response.data)
+        self.assertEqual(
+            {(p['id'], p['availability']) for p in response.data['products']},
+            {(self.products[0].id, True), (self.products[1].id, True),
+             (self.products[3].id, False)})
+        self.assertTrue(ShopProduct.objects.filter(id=kept.id).exists())
+        self.assertEqual(
+            [sql.split()[0] for sql in self.writes(queries, 'shopproduct')],
+            ['DELETE', 'UPDATE', 'INSERT'])
+        self.assertEqual(self.writes(queries, 'shops_shop"'), [])
+
+
+class AvailabilitySyncTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        cls.token = Token.objects.create(user=cls.owner)
+        cls.shop = Shop.objects.create(name='Ферма', owner=cls.owner)
+        cls.products = Product.objects.bulk_create(
+            Product(name=f'product {i}', description='') for i in range(5))
+        ShopProduct.objects.bulk_create(
+            ShopProduct(shop=cls.shop, product=product, availability=False)
+            for product in cls.products[:4])
+        cls.url = reverse('api:shops-availability', args=(cls.shop.id,))
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def available(self):
+        return set(ShopProduct.objects.filter(
+            shop=self.shop, availability=True
+        ).values_list('product_id', flat=True))
+
+    def test_json(self):
+        ids = [product.id for product in self.products]
+        response = self.client.post(self.url, [
+            {'product_id': ids[0], 'availability': True},
+            {'product_id': ids[1], 'availability': True},
+            {'product_id': ids[2], 'availability': False},
+            {'product_id': ids[4], 'availability': True},
+            {'product_id': 'x', 'availability': True},
+        ], format='json')
+        self.assertEqual(response.data, {
+            'updated': 2, 'unchanged': 1, 'not_found': [ids[4]],
+            'errors': [{'index': 4, 'error': response.data['errors'][0][
+                'error']}],
+        })
+        self.assertEqual(self.available(), {ids[0], ids[1]})
+
+    def test_json_lines(self):
+        ids = [product.id for product in self.products]
+        body = '\n'.join(
+            f'{{"product_id": {id}, "availability": true}}' for id in ids[:3])
+        response = self.client.post(
+            self.url, body, content_type='application/x-ndjson')
+        self.assertEqual(response.data['updated'], 3)
+        self.assertEqual(self.available(), set(ids[:3]))
+
+    @mock.patch('api.views.AVAILABILITY_BATCH_SIZE', 2)
+    def test_failed_sync_leaves_index_unchanged(self):
+        availability_index.clear()
+        ids = [product.id for product in self.products[:4]]
+        self.assertEqual(availability_index.match(ids), [])
+        update = QuerySet.update
+        calls = []
+
+        def failing_update(queryset, **kwargs):
+            # Вторая пачка падает после записи первой.
+            calls.append(kwargs)
+            if len(calls) > 2:
+                raise DatabaseError('connection lost')
+            return update(queryset, **kwargs)
+
+        with self.captureOnCommitCallbacks(execute=True) as callbacks, \
+                mock.patch.object(QuerySet, 'update', failing_update), \
+                self.assertRaises(DatabaseError):
+            self.client.post(self.url, [
+                {'product_id': id, 'availability': True} for id in ids
+            ], format='json')
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.available(), set())
+        self.assertEqual(availability_index.match(ids), [])
+
+    def test_only_owner(self):
+        other = User.objects.create_user(
+            email='other@example.com', username='other', password='pass')
+        self.client.force_authenticate(other)
+        response = self.client.post(self.url, [], format='json')
+        self.assertEqual(response.status_code, 403)
+
+
+@override_settings(MEDIA_ROOT=MEDIA_ROOT)
+class BulkShopCreateTest(APITestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        cls.token = Token.objects.create(user=cls.owner)
+        cls.products = Product.objects.bulk_create(
+            Product(name=f'product {i}', description='') for i in range(3))
+        cls.messenger = Messenger.objects.create(name='telegram')
+        Shop.objects.create(name='Занято', owner=cls.owner)
+        cls.url = reverse('api:shops-bulk')
+
+    def setUp(self):
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        availability_index.clear()
+        token_cache.get(self.token.key)
+
+    def shop(self, name, login, products=None):
+        return {
+            'name': name,
+            'photo': image_base64(),
+            'coordinates': '56.85, 35.9',
+            'products': [
+                {'id': product.id, 'availability': True}
+                for product in products or self.products
+            ],
+            'messengers': [
+                {'id': self.messenger.id, 'search_information': login},
+            ],
+        }
+
+    def test_creates_in_constant_queries(self):
+        for count in (2, 6):
+            items = [self.shop(f'Ферма {count}-{i}', f'@{count}-{i}')
+                     for i in range(count)]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(self.url, items, format='json')
+            self.assertEqual(response.status_code, 201, response.data)
+            self.assertEqual(response.data['created'], count)
+            if count == 2:
+                expected = len(queries)
+        self.assertEqual(len(queries), expected)
+        shop = Shop.objects.get(id=response.data['results'][0]['id'])
+        self.assertEqual(shop.owner, self.owner)
+        self.assertIsNotNone(shop.geohash)
+        self.assertEqual(ShopProduct.objects.filter(shop=shop).count(), 3)
+
+    def test_per_item_errors(self):
+        response = self.client.post(self.url, [
+            self.shop('Новая', '@new', self.products[:1]),
+            self.shop('Занято', '@busy'),
+            self.shop('Новая', '@other'),
+            {'name': 'Без товаров', 'products': [{'id': 0}]},
+        ], format='json')
+        self.assertEqual(response.status_code, 201, response.data)
+        self.assertEqual(response.data['created'], 1)
+        results = response.data['results']
+        self.assertIn('id', results[0])
+        self.assertIn('name', results[1]['errors'])
+        self.assertIn('name', results[2]['errors'])
+        self.assertIn('products', results[3]['errors'])
+        self.assertEqual(
+            availability_index.match([self.products[0].id])[0][0],
+            results[0]['id'])
+
+
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT, IMAGE_WORKERS=0, IMAGE_MAX_SIDE=8,
+    IMAGE_UPLOAD_MAX_SIZE=10000,
+)
+class ImageUploadTest(APITestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        cls.shop = Shop.objects.create(name='Ферма', owner=cls.owner)
+
+    def setUp(self):
+        self.client.force_authenticate(self.owner)
+
+    def url(self, field):
+        return reverse('api:shops-images', args=(self.shop.id, field))
+
+    def test_multipart(self):
+        upload = SimpleUploadedFile('photo.jpg', image_bytes((32, 16), 'JPEG'))
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                self.url('photo'), {'file': upload}, format='multipart')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.assertEqual(
+            response.data, {'format': 'JPEG', 'width': 32, 'height': 16})
+        self.shop.refresh_from_db()
+        with Image.open(self.shop.photo) as image:
+            self.assertEqual(image.size, (8, 4))
+
+    def test_raw_body(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.put(
+                self.url('logo'), image_bytes(), content_type='image/png')
+        self.assertEqual(response.status_code, 202, response.data)
+        self.shop.refresh_from_db()
+        self.assertTrue(self.shop.logo.name.endswith('.png'))
+
+    def test_rejected(self):
+        for body, content_type in (
+                (b'not an image', 'image/png'),
+                (image_bytes((4, 4), 'GIF'), 'image/gif'),
+                (image_bytes((400, 400), 'BMP'), 'image/bmp')):
+            response = self.client.put(
+                self.url('photo'), body, content_type=content_type)
+            self.assertEqual(response.status_code, 400)
+        self.shop.refresh_from_db()
+        self.assertFalse(self.shop.photo)
+
+    def test_too_large_is_not_received(self):
+        # Under the Content-Length check, cut off by the upload handler.
+        body = b'\0' * 12000
+        for data, options in (
+                (body, {'content_type': 'image/png'}),
+                ({'file': SimpleUploadedFile('photo.png', body)},
+                 {'format': 'multipart'})):
+            response = self.client.put(self.url('photo'), data, **options)
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(
+                response.data, {'errors': 'Файл больше 10000 байт.'})
+        # Far over the limit: rejected by Content-Length before parsing.
+        with mock.patch.object(SizeLimitUploadHandler, 'receive_data_chunk',
+                               side_effect=AssertionError):
+            response = self.client.put(
+                self.url('photo'), b'\0' * 100000, content_type='image/png')
+        self.assertEqual(response.status_code, 400)
+
+    def test_worker_errors_are_logged(self):
+        with self.assertLogs('api.uploads', 'ERROR'):
+            process_image_in_worker(
+                Shop, self.shop.id, 'photo', '/nonexistent/upload', 'PNG')
+
+
+@override_settings(
+    MEDIA_ROOT=MEDIA_ROOT, THUMBNAIL_ROOT=f'{MEDIA_ROOT}/thumbnails',
+    THUMBNAIL_CACHE_SIZE=1000,
+)
+class ThumbnailTest(APITestCase):
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        shutil.rmtree(MEDIA_ROOT, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        cls.shop = Shop.objects.create(name='Ферма', owner=owner)
+
+    def setUp(self):
+        disk_cache.clear()
+        self.shop.photo.save(
+            'photo.png', ContentFile(image_bytes((64, 32))), save=True)
+
+    def test_serializer_url(self):
+        response = self.client.get(
+            reverse('api:shops-detail', args=(self.shop.id,)))
+        url = response.data['photo_thumbnail']
+        self.assertIn('w=320', url)
+        self.assertIsNone(response.data['logo_thumbnail'])
+        response = self.client.get(url, HTTP_ACCEPT='image/webp')
+        self.assertEqual(response['Content-Type'], 'image/webp')
+
+    def test_resize_and_cache(self):
+        params = {'path': self.shop.photo.name, 'w': 16, 'format': 'png'}
+        response = self.client.get(reverse('api:thumbnails'), params)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        with Image.open(io.BytesIO(content)) as image:
+            self.assertEqual(image.size, (16, 8))
+        response = self.client.get(
+            reverse('api:thumbnails'), params,
+            HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_evicts_least_recently_used(self):
+        url = reverse('api:thumbnails')
+        name = self.shop.photo.name
+        for width in range(8, 40, 2):
+            self.client.get(url, {'path': name, 'w': width, 'format': 'png'})
+        sizes = [size for _, size, _ in disk_cache.files()]
+        self.assertLessEqual(sum(sizes), 1000)
+        self.assertGreater(len(sizes), 0)
+
+    def test_rejected(self):
+        url = reverse('api:thumbnails')
+        for params, status in (
+                ({'path': '../settings.py', 'w': 10}, 400),
+                ({'path': self.shop.photo.name, 'w': 5000}, 400),
+                ({'path': self.shop.photo.name, 'w': 10, 'format': 'gif'},
+                 400),
+                ({'path': 'images/missing.png', 'w': 10}, 404)):
+            self.assertEqual(self.client.get(url, params).status_code, status)
+
+    def test_evicted_before_open_is_rebuilt(self):
+        params = {'path': self.shop.photo.name, 'w': 16, 'format': 'png'}
+        evicted = disk_cache.path('0' * 64, 'png')
+        with mock.patch.object(
+                disk_cache, 'get', side_effect=[evicted, None]):
+            response = self.client.get(reverse('api:thumbnails'), params)
+        self.assertEqual(response.status_code, 200)
+        content = b''.join(response.streaming_content)
+        with Image.open(io.BytesIO(content)) as image:
+            self.assertEqual(image.size, (16, 8))
+
+    def test_broken_and_oversized_images(self):
+        url = reverse('api:thumbnails')
+        params = {'path': self.shop.photo.name, 'w': 10}
+        with mock.patch.object(Image, 'MAX_IMAGE_PIXELS', 500):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        with self.settings(IMAGE_MAX_PIXELS=1000):
+            self.assertEqual(self.client.get(url, params).status_code, 400)
+        self.shop.photo.save(
+            'broken.png', ContentFile(image_bytes((64, 32))[:80]), save=True)
+        params['path'] = self.shop.photo.name
+        self.assertEqual(self.client.get(url, params).status_code, 400)
+
+
+class AsyncViewsTest(APITestCase):
+    """Асинхронные представления отвечают так же, как синхронные."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        cls.token = Token.objects.create(user=cls.user)
+        owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        Follow.objects.create(user=cls.user, owner=owner)
+        products = Product.objects.bulk_create(
+            Product(name=f'product {i}', description='') for i in range(3))
+        messenger = Messenger.objects.create(name='telegram')
+        for i in range(4):
+            shop = Shop.objects.create(name=f'shop {i}', owner=owner)
+            for product in products[:i]:
+                ShopProduct.objects.create(
+                    shop=shop, product=product, availability=True)
+            ShopMessenger.objects.create(
+                shop=shop, messenger=messenger,
+                search_information=f'login {i}')
+            if i % 2:
+                FavoriteShop.objects.create(user=cls.user, shop=shop)
+        cls.shop = shop
+
+    def setUp(self):
+        cache.clear()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def assertSameResponse(self, sync_url, async_url, params=None):
+        expected = self.client.get(sync_url, params).json()
+        response = self.client.get(async_url, params)
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        if isinstance(expected, dict) and 'results' in expected:
+            self.assertEqual(data['count'], expected['count'])
+            expected, data = expected['results'], data['results']
+        self.assertEqual(data, expected)
+
+    def test_shops(self):
+        self.assertSameResponse(
+            reverse('api:shops-list'), reverse('api:async-shops-list'),
+            {'limit': 3, 'page': 1})
+        self.assertSameResponse(
+            reverse('api:shops-detail', args=(self.shop.id,)),
+            reverse('api:async-shops-detail', args=(self.shop.id,)))
+
+    def test_catalogs_and_subscriptions(self):
+        self.assertSameResponse(
+            reverse('api:products-list'), reverse('api:async-products-list'),
+            {'name': 'product'})
+        self.assertSameResponse(
+            reverse('api:categorys-list'),
+            reverse('api:async-categorys-list'))
+        self.assertSameResponse(
+            reverse('api:users-subscriptions'),
+            reverse('api:async-users-subscriptions'), {'shops_limit': 2})
+
+    def test_catalog_ordering(self):
+        products = list(Product.objects.order_by('id'))
+        FavoriteProduct.objects.create(user=self.user, product=products[1])
+        for ordering in ('-favorites_count', '-name'):
+            params = {'ordering': ordering, 'name': 'product'}
+            expected = self.client.get(
+                reverse('api:products-list'), params).json()
+            # Ответ синхронного представления лежит в кэше под тем же
+            # ключом.
+            cache.clear()
+            data = self.client.get(
+                reverse('api:async-products-list'), params).json()
+            self.assertEqual(data, expected)
+            self.assertNotEqual(
+                [product['id'] for product in data],
+                [product.id for product in products])
+
+    def test_pagination_and_auth(self):
+        url = reverse('api:async-shops-list')
+        data = self.client.get(url, {'limit': 3}).json()
+        self.assertEqual(data['count'], 4)
+        self.assertEqual(len(self.client.get(data['next']).json()['results']),
+                         1)
+        self.assertEqual(self.client.get(url, {'page': 5}).status_code, 404)
+        self.client.credentials(HTTP_AUTHORIZATION='Token wrong')
+        self.assertEqual(self.client.get(url).status_code, 401)
+        self.client.credentials()
+        self.assertEqual(
+            self.client.get(
+                reverse('api:async-users-subscriptions')).status_code, 401)
+        # The keyword is case-insensitive, as in TokenAuthentication.
+        self.client.credentials(HTTP_AUTHORIZATION=f'token {self.token.key}')
+        for name in ('users-subscriptions', 'async-users-subscriptions'):
+            self.assertEqual(
+                self.client.get(reverse(f'api:{name}')).status_code, 200)
+
+
+@override_settings(DATABASE_REPLICAS=['replica0'], REPLICA_STICKY_SECONDS=10)
+class ReplicaRoutingTest(SimpleTestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.middleware = ReplicaMiddleware(self.view)
+
+    def view(self, request):
+        self.read_db = router.db_for_read(Shop)
+        self.write_db = router.db_for_write(Shop)
+        return HttpResponse(status=400 if 'fail' in request.path else 200)
+
+    def request(self, method, path='/api/shops/', token='first'):
+        request = getattr(self.factory, method)(
+            path, HTTP_AUTHORIZATION=f'Token {token}')
+        self.middleware(request)
+        return self.read_db, self.write_db
+
+    def test_reads_stick_to_primary_after_write(self):
+        self.assertEqual(self.request('get'), ('replica0', 'default'))
+        self.assertEqual(self.request('post', '/fail/'),
+                         ('default', 'default'))
+        self.assertEqual(self.request('get'), ('replica0', 'default'))
+        self.request('post')
+        self.assertEqual(self.request('get'), ('default', 'default'))
+        self.assertEqual(
+            self.request('get', token='second'), ('replica0', 'default'))
+        cache.clear()
+        self.assertEqual(self.request('get'), ('replica0', 'default'))
+
+    def test_outside_requests_reads_primary(self):
+        self.assertEqual(router.db_for_read(Shop), 'default')
+
+    @override_settings(DATABASE_REPLICAS=['replica0', 'replica1'])
+    def test_one_replica_per_request(self):
+        def view(request):
+            self.read_dbs = {router.db_for_read(Shop) for _ in range(20)}
+            return HttpResponse()
+        middleware = ReplicaMiddleware(view)
+        for _ in range(5):
+            middleware(self.factory.get('/api/shops/'))
+            self.assertEqual(len(self.read_dbs), 1)
+
+    def test_async_requests_stay_async(self):
+        async def view(request):
+            self.read_db = router.db_for_read(Shop)
+            return HttpResponse(status=201)
+        middleware = ReplicaMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        async_to_sync(middleware)(self.factory.get('/api/shops/'))
+        self.assertEqual(self.read_db, 'replica0')
+        request = self.factory.post(
+            '/api/shops/', HTTP_AUTHORIZATION='Token first')
+        async_to_sync(middleware)(request)
+        self.assertEqual(self.read_db, 'default')
+        self.assertEqual(self.request('get'), ('default', 'default'))
+        self.assertEqual(router.db_for_read(Shop), 'default')
+
+
+@override_settings(DATABASE_REPLICAS=['default'], REPLICA_STICKY_SECONDS=10)
+class ReplicaLoginTest(APITestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_new_token_reads_from_primary(self):
+        User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        response = self.client.post(
+            reverse('api:login'),
+            {'email': 'buyer@example.com', 'password': 'pass'})
+        self.assertEqual(response.status_code, 200)
+        request = RequestFactory().get(
+            '/api/users/me/',
+            HTTP_AUTHORIZATION=f'Token {response.data["auth_token"]}')
+        self.assertTrue(cache.get(client_key(request)))
+
+
+class CachedTokenAuthenticationTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user(
+            email='buyer@example.com', username='buyer', password='pass')
+        cls.admin = User.objects.create_superuser(
+            email='admin@example.com', username='admin', password='pass')
+
+    def setUp(self):
+        cache.clear()
+        token_cache.clear()
+        token_cache.reset_stats()
+        self.token = Token.objects.create(user=self.user)
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+        self.url = reverse('api:users-me')
+
+    def test_token_is_resolved_once(self):
+        # auth, the current user, follows
+        with self.assertNumQueries(3):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get(self.url).status_code, 200)
+        token_cache.clear()
+        with self.assertNumQueries(2):
+            self.client.get(self.url)
+        self.assertEqual(token_cache.get_stats()['misses'], 1)
+        self.assertEqual(token_cache.get_stats()['local_hits'], 1)
+        self.assertEqual(token_cache.get_stats()['shared_hits'], 1)
+
+    def test_logout_invalidates(self):
+        self.client.get(self.url)
+        response = self.client.post(reverse('api:logout'))
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+
+    def test_deactivation_invalidates(self):
+        self.client.get(self.url)
+        self.user.is_active = False
+        self.user.save()
+        self.assertEqual(self.client.get(self.url).status_code, 401)
+        # The deactivated user is now cached and rejected without queries.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.client.get(self.url).status_code, 401)
+        self.assertEqual(token_cache.get_stats()['local_hits'], 1)
+
+    def test_cache_holds_no_password(self):
+        self.client.get(self.url)
+        cached = cache.get(cache_key(self.token.key))
+        self.assertEqual(cached, (self.user.pk, False, False, True))
+
+    def test_password_change_reloads_user(self):
+        self.client.get(self.url)
+        response = self.client.post(reverse('api:users-set-password'), {
+            'current_password': 'pass', 'new_password': 'N3w-passw0rd!'})
+        self.assertEqual(response.status_code, 204)
+        token_cache.clear()
+        self.assertTrue(token_cache.get(
+            self.token.key).user.check_password('N3w-passw0rd!'))
+
+    def test_stats_for_admins(self):
+        self.client.get(self.url)
+        self.assertEqual(
+            self.client.get(reverse('api:auth-stats')).status_code, 403)
+        self.client.force_authenticate(self.admin)
+        response = self.client.get(reverse('api:auth-stats'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['misses'], 1)
+
+
+class TimingMiddlewareTest(APITestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        for i in range(3):
+            Shop.objects.create(name=f'shop {i}')
+
+    @override_settings(TIMING_SAMPLE_RATE=1, SLOW_REQUEST_MS=60000)
+    def test_server_timing_header(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('api:shops-list'))
+        timing = response['Server-Timing']
+        self.assertIn(f'desc="{len(queries)} queries"', timing)
+        for name in ('sql', 'serialize', 'render', 'total'):
+            self.assertRegex(timing, rf'\b{name};dur=\d+\.\d\d')
+
+    @override_settings(TIMING_SAMPLE_RATE=1, SLOW_REQUEST_MS=60000)
+    def test_async_requests_stay_async(self):
+        async def view(request):
+            with timed('serialize'):
+                pass
+            return HttpResponse()
+        middleware = TimingMiddleware(view)
+        self.assertTrue(asyncio.iscoroutinefunction(middleware))
+        response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertRegex(response['Server-Timing'], r'\bserialize;dur=')
+        self.assertRegex(
+            self.client.get(reverse('api:async-shops-list'))['Server-Timing'],
+            r'\bserialize;dur=')
+
+    def test_drf_serializers_are_not_patched(self):
+        for serializer_class in (Serializer, ListSerializer):
+            self.assertEqual(serializer_class.data.fget.__module__,
+                             'rest_framework.serializers')
+
+    @override_settings(TIMING_SAMPLE_RATE=0)
+    def test_unsampled_requests_have_no_header(self):
+        response = self.client.get(reverse('api:shops-list'))
+        self.assertFalse(response.has_header('Server-Timing'))
+
+    @override_settings(TIMING_SAMPLE_RATE=1, SLOW_REQUEST_MS=0,
+                       SLOW_REQUEST_EXPLAIN=True)
+    def test_slow_request_log(self):
+        with self.assertLogs('svoe_vkusnee.timing', 'WARNING') as logs:
+            self.client.get(reverse('api:shops-list'))
+        record = json.loads(logs.records[0].args[0])
+        self.assertEqual(record['path'], reverse('api:shops-list'))
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertIsInstance(record['duplicates'], list)
+        self.assertTrue(record['explain'][0]['plan'])
@@ -0,0 +1,236 @@
+"""Уменьшенные копии изображений по запросу.
+
+Копия строится Pillow один раз и хранится на диске в THUMBNAIL_ROOT под
+хэшем содержимого исходника и параметров, поэтому одинаковые картинки
+разных объектов делят одну копию. Каталог ограничен THUMBNAIL_CACHE_SIZE
+байт: при переполнении удаляются давно не читавшиеся копии.
+"""
+import hashlib
+import os
+import tempfile
+import threading
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.files.storage import default_storage
+from django.urls import reverse
+from PIL import Image, ImageOps
+from rest_framework import serializers
+from shops.storage import hash_of_name
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+    'png': ('PNG', 'image/png'),
+}
+CHUNK_SIZE = 64 * 1024
+
+
+class ThumbnailError(ValueError):
+    """Недопустимые параметры копии."""
+
+
+def parse_params(params, accept=''):
+    """Путь исходника, ширина, высота и формат из параметров запроса.
+
+    Формат по умолчанию webp, если клиент его принимает, иначе jpeg.
+    """
+    name = params.get('path', '')
+    if not name or name.startswith('/') or '..' in name.split('/'):
+        raise ThumbnailError('Недопустимый путь к изображению.')
+    try:
+        width = int(params.get('w', 0))
+        height = int(params.get('h', 0))
+    except ValueError:
+        raise ThumbnailError('Ширина и высота должны быть целыми.')
+    max_side = settings.THUMBNAIL_MAX_SIDE
+    if not (width or height) or not (
+            0 <= width <= max_side and 0 <= height <= max_side):
+        raise ThumbnailError(f'Укажите w или h от 1 до {max_side}.')
+    image_format = params.get('format')
+    if image_format is None:
+        image_format = 'webp' if 'image/webp' in accept else 'jpeg'
+    if image_format not in FORMATS:
+        raise ThumbnailError(f'Допустимые форматы: {", ".join(FORMATS)}.')
+    return name, width, height, image_format
+
+
+def source_hash(name):
+    """Хэш содержимого исходника, запомненный по времени изменения.
+
+    У файлов хранилища по содержимому хэш уже записан в имени.
+    """
+    digest = hash_of_name(name)
+    if digest is not None:
+        return digest
+    path = default_storage.path(name)
+    stat = os.stat(path)
+    key = f'thumbnails:source:{name}:{stat.st_mtime_ns}:{stat.st_size}'
+    digest = cache.get(key)
+    if digest is None:
+        sha = hashlib.sha256()
+        with open(path, 'rb') as file:
+            while chunk := file.read(CHUNK_SIZE):
+                sha.update(chunk)
+        digest = sha.hexdigest()
+        cache.set(key, digest, None)
+    return digest
+
+
+def render(source, width, height, image_format):
+    """Копия, вписанная в width x height, без увеличения."""
+    try:
+        image = Image.open(source)
+    except (OSError, Image.DecompressionBombError):
+        raise ThumbnailError('Файл не является изображением.')
+    with image:
+        if image.width * image.height > settings.IMAGE_MAX_PIXELS:
+            raise ThumbnailError(
+                f'Изображение больше {settings.IMAGE_MAX_PIXELS} пикселей.')
+        try:
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((width or image.width, height or image.height))
+            if image_format == 'JPEG' and image.mode != 'RGB':
+                image = image.convert('RGB')
+        except (OSError, ValueError, Image.DecompressionBombError):
+            # Повреждённый или обрезанный файл видно только при
+            # декодировании.
+            raise ThumbnailError('Файл не является изображением.')
+        temporary = tempfile.NamedTemporaryFile(
+            dir=settings.THUMBNAIL_ROOT, prefix='.tmp-', delete=False)
+        with temporary:
+            image.save(temporary, image_format, quality=80, optimize=True)
+    return temporary.name
+
+
+class DiskCache:
+    """Каталог копий с вытеснением давно не читавшихся.
+
+    Время чтения хранится в mtime файла. Общий размер считается обходом
+    каталога при первом обращении и при вытеснении, между ними ведётся
+    по записям этого процесса.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._size = None
+
+    @property
+    def root(self):
+        return settings.THUMBNAIL_ROOT
+
+    def path(self, key, extension):
+        return os.path.join(self.root, key[:2], f'{key}.{extension}')
+
+    def files(self):
+        for directory, _, names in os.walk(self.root):
+            for name in names:
+                if not name.startswith('.tmp-'):
+                    path = os.path.join(directory, name)
+                    try:
+                        stat = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield stat.st_mtime, stat.st_size, path
+
+    def get(self, key, extension):
+        path = self.path(key, extension)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        return path
+
+    def put(self, key, extension, temporary):
+        path = self.path(key, extension)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(temporary)
+        os.replace(temporary, path)
+        with self._lock:
+            if self._size is None:
+                self._size = sum(item[1] for item in self.files())
+            else:
+                self._size += size
+            if self._size > settings.THUMBNAIL_CACHE_SIZE:
+                self._evict()
+        return path
+
+    def _evict(self):
+        files = sorted(self.files())
+        size = sum(item[1] for item in files)
+        # Освобождаем с запасом, чтобы не чистить на каждой записи.
+        budget = settings.THUMBNAIL_CACHE_SIZE * 0.9
+        for _, file_size, path in files:
+            if size <= budget:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            size -= file_size
+        self._size = size
+
+    def clear(self):
+        with self._lock:
+            for _, _, path in self.files():
+                os.remove(path)
+            self._size = None
+
+
+disk_cache = DiskCache()
+
+
+def get_thumbnail(name, width, height, image_format):
+    """Путь к копии и её тип, копия строится при первом запросе."""
+    pillow_format, content_type = FORMATS[image_format]
+    key = hashlib.sha256(
+        f'{source_hash(name)}:{width}:{height}:{image_format}'.encode()
+    ).hexdigest()
+    path = disk_cache.get(key, image_format)
+    if path is None:
+        os.makedirs(settings.THUMBNAIL_ROOT, exist_ok=True)
+        temporary = render(
+            default_storage.path(name), width, height, pillow_format)
+        path = disk_cache.put(key, image_format, temporary)
+    return path, content_type, key
+
+
+def open_thumbnail(name, width, height, image_format):
+    """Открытый файл копии, её тип и ключ.
+
+    Другой процесс может вытеснить копию между проверкой и открытием,
+    тогда она строится заново.
+    """
+    for attempt in range(2):
+        path, content_type, key = get_thumbnail(
+            name, width, height, image_format)
+        try:
+            return open(path, 'rb'), content_type, key
+        except FileNotFoundError:
+            if attempt:
+                raise
+
+
+def thumbnail_url(name, width, height, image_format=None):
+    params = {'path': name, 'w': width, 'h': height}
+    if image_format:
+        params['format'] = image_format
+    return f'{reverse("api:thumbnails")}?{urlencode(params)}'
+
+
+class ThumbnailField(serializers.ReadOnlyField):
+    """Ссылка на уменьшенную копию изображения из поля source."""
+
+    def __init__(self, width=0, height=0, image_format=None, **kwargs):
+        self.width, self.height = width, height
+        self.image_format = image_format
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        url = thumbnail_url(
+            value.name, self.width, self.height, self.image_format)
+        request = self.context.get('request')
+        return request.build_absolute_uri(url) if request else url
@@ -0,0 +1,100 @@
+"""Тайлы карты магазинов с кластерами маркеров.
+
+Тайл z/x/y в проекции Web Mercator делится на сетку GRID x GRID, магазины
+каждой клетки сворачиваются в кластер (число и центр масс). Тайлы
+кэшируются с версией тайла: сохранение или удаление магазина увеличивает
+версии только тех тайлов, в которые магазин попадал и попадает.
+"""
+import math
+from collections import defaultdict
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import cache
+
+MAX_ZOOM = 18
+GRID = 8
+
+
+def tile_bounds(z, x, y):
+    """Границы тайла: (south, west, north, east)."""
+    n = 2 ** z
+
+    def latitude(row):
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * row / n))))
+
+    west, east = x / n * 360 - 180, (x + 1) / n * 360 - 180
+    return latitude(y + 1), west, latitude(y), east
+
+
+def tile_position(z, latitude, longitude):
+    """Дробные координаты точки в сетке тайлов уровня z."""
+    n = 2 ** z
+    latitude = max(min(latitude, 85.0511), -85.0511)
+    phi = math.radians(latitude)
+    column = (longitude + 180) / 360 * n
+    row = (1 - math.asinh(math.tan(phi)) / math.pi) / 2 * n
+    return min(column, n - 1e-9), min(row, n - 1e-9)
+
+
+def tiles_of_point(latitude, longitude):
+    """Тайлы всех уровней, в которые попадает точка."""
+    tiles = []
+    for z in range(MAX_ZOOM + 1):
+        column, row = tile_position(z, latitude, longitude)
+        tiles.append((z, int(column), int(row)))
+    return tiles
+
+
+def build_tile(queryset, z, x, y):
+    """Кластеры магазинов тайла."""
+    south, west, north, east = tile_bounds(z, x, y)
+    points = queryset.filter(
+        latitude__gte=south, latitude__lt=north,
+        longitude__gte=west, longitude__lt=east,
+    ).order_by().values_list('id', 'latitude', 'longitude')
+    cells = defaultdict(list)
+    for point in points:
+        column, row = tile_position(z, point[1], point[2])
+        cell = (int((column - x) * GRID), int((row - y) * GRID))
+        cells[cell].append(point)
+    clusters = []
+    for cell_points in cells.values():
+        count = len(cell_points)
+        clusters.append({
+            'latitude': sum(point[1] for point in cell_points) / count,
+            'longitude': sum(point[2] for point in cell_points) / count,
+            'count': count,
+            'shop': cell_points[0][0] if count == 1 else None,
+        })
+    return {'z': z, 'x': x, 'y': y, 'clusters': clusters}
+
+
+def version_key(z, x, y):
+    return f'shops:tile-version:{z}:{x}:{y}'
+
+
+def get_tile(queryset, z, x, y, params):
+    """Тайл из кэша или построенный заново."""
+    version = cache.get(version_key(z, x, y), 0)
+    key = f'shops:tile:{z}:{x}:{y}:{version}:{urlencode(sorted(params))}'
+    tile = cache.get(key)
+    if tile is None:
+        tile = build_tile(queryset, z, x, y)
+        cache.set(key, tile, settings.SHOP_TILE_CACHE_TIMEOUT)
+    return tile
+
+
+def invalidate_tiles(*locations):
+    """Увеличивает версии тайлов, содержащих точки (latitude, longitude)."""
+    keys = {
+        version_key(*tile)
+        for latitude, longitude in locations
+        if latitude is not None and longitude is not None
+        for tile in tiles_of_point(latitude, longitude)
+    }
+    if not keys:
+        return
+    versions = cache.get_many(keys)
+    cache.set_many(
+        {key: versions.get(key, 0) + 1 for key in keys}, timeout=None)
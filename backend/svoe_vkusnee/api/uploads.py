@@ -0,0 +1,169 @@
+"""Загрузка изображений без base64.
+
+Запрос только сохраняет поток во временный файл и читает заголовок
+изображения: формат и размеры. Тело больше IMAGE_UPLOAD_MAX_SIZE
+отклоняется по Content-Length или на первом лишнем блоке. Полное
+декодирование, уменьшение и перекодирование выполняет пул потоков
+IMAGE_WORKERS после фиксации транзакции, так что поток с картинками не
+занимает воркеры API.
+"""
+import io
+import logging
+import os
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.move import file_move_safe
+from django.core.files.uploadhandler import FileUploadHandler
+from django.db import close_old_connections, transaction
+from PIL import Image, ImageOps
+from rest_framework.exceptions import ValidationError
+
+FORMATS = {'JPEG': 'jpg', 'PNG': 'png', 'WEBP': 'webp'}
+CHUNK_SIZE = 64 * 1024
+# Запас на границы и заголовки multipart сверх размера файла.
+MULTIPART_OVERHEAD = 16 * 1024
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.IMAGE_WORKERS,
+                thread_name_prefix='images',
+            )
+    return _executor
+
+
+def too_large():
+    return ValidationError(
+        f'Файл больше {settings.IMAGE_UPLOAD_MAX_SIZE} байт.')
+
+
+class SizeLimitUploadHandler(FileUploadHandler):
+    """Прерывает приём файла, как только он превысит
+    IMAGE_UPLOAD_MAX_SIZE."""
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) > settings.IMAGE_UPLOAD_MAX_SIZE:
+            raise too_large()
+        return raw_data
+
+    def file_complete(self, file_size):
+        return None
+
+
+def limit_upload(request):
+    """Проверяет Content-Length и ограничивает приём тела запроса.
+
+    Вызывается до первого обращения к request.data.
+    """
+    try:
+        length = int(request.META.get('CONTENT_LENGTH') or 0)
+    except ValueError:
+        length = 0
+    if length > settings.IMAGE_UPLOAD_MAX_SIZE + MULTIPART_OVERHEAD:
+        raise too_large()
+    request.upload_handlers.insert(0, SizeLimitUploadHandler(request))
+
+
+def inspect_image(file):
+    """Формат и размеры изображения по заголовку, без декодирования."""
+    if file.size > settings.IMAGE_UPLOAD_MAX_SIZE:
+        raise too_large()
+    try:
+        with Image.open(file) as image:
+            image_format, (width, height) = image.format, image.size
+    except (OSError, Image.DecompressionBombError):
+        raise ValidationError('Файл не является изображением.')
+    finally:
+        file.seek(0)
+    if image_format not in FORMATS:
+        raise ValidationError(
+            f'Допустимые форматы: {", ".join(FORMATS)}.')
+    if width * height > settings.IMAGE_MAX_PIXELS:
+        raise ValidationError(
+            f'Изображение больше {settings.IMAGE_MAX_PIXELS} пикселей.')
+    return image_format, width, height
+
+
+def spool(file):
+    """Файл с загрузкой, который переживёт запрос.
+
+    Загрузку, которую Django уже записал на диск, файл не копирует, а
+    переносит.
+    """
+    temporary = tempfile.NamedTemporaryFile(
+        prefix='upload-', delete=False)
+    with temporary:
+        if hasattr(file, 'temporary_file_path'):
+            file_move_safe(file.temporary_file_path(), temporary.name,
+                           allow_overwrite=True)
+        else:
+            for chunk in file.chunks(CHUNK_SIZE):
+                temporary.write(chunk)
+    return temporary.name
+
+
+def reencode(path, image_format):
+    """Изображение без метаданных, повёрнутое и уменьшенное до
+    IMAGE_MAX_SIDE."""
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        image.thumbnail((settings.IMAGE_MAX_SIDE, settings.IMAGE_MAX_SIDE))
+        if image_format == 'JPEG' and image.mode != 'RGB':
+            image = image.convert('RGB')
+        content = io.BytesIO()
+        options = {'optimize': True}
+        if image_format in ('JPEG', 'WEBP'):
+            options['quality'] = 85
+        image.save(content, image_format, **options)
+    return content.getvalue()
+
+
+def process_image(model, pk, field, path, image_format):
+    try:
+        content = reencode(path, image_format)
+        instance = model.objects.filter(pk=pk).first()
+        if instance is None:
+            return
+        name = f'{model._meta.model_name}-{pk}.{FORMATS[image_format]}'
+        getattr(instance, field).save(name, ContentFile(content), save=False)
+        instance.save(update_fields=[field])
+    finally:
+        os.remove(path)
+
+
+def process_image_in_worker(*args):
+    # Результат задачи никто не ждёт: ошибки видны только в логе.
+    try:
+        process_image(*args)
+    except Exception:
+        logger.exception('image processing failed: %s %s %s', *args[:3])
+    finally:
+        close_old_connections()
+
+
+def schedule_image(instance, field, file):
+    """Проверяет заголовок изображения и ставит его обработку в очередь.
+
+    Возвращает формат и размеры исходного изображения.
+    """
+    image_format, width, height = inspect_image(file)
+    path = spool(file)
+    args = (type(instance), instance.pk, field, path, image_format)
+    if settings.IMAGE_WORKERS:
+        transaction.on_commit(
+            lambda: get_executor().submit(process_image_in_worker, *args))
+    else:
+        transaction.on_commit(lambda: process_image(*args))
+    return {'format': image_format, 'width': width, 'height': height}
@@ -1,12 +1,15 @@
 from django.urls import include, path
 from rest_framework.routers import DefaultRouter
 
+from . import async_views
 from .views import (
     UserCustomViewSet,
     ShopViewSet,
     ProductViewSet,
     CategoryViewSet,
-    SubcategoryViewSet
+    SubcategoryViewSet,
+    auth_stats,
+    thumbnail,
 )
 
 app_name = 'api'
@@ -18,9 +21,24 @@ router.register('products', ProductViewSet, basename='products')
 router.register('categorys', CategoryViewSet, basename='categorys')
 router.register('subcategorys', SubcategoryViewSet, basename='subcategorys')
 
+async_urlpatterns = [
+    path('shops/', async_views.shop_list, name='async-shops-list'),
+    path('shops/<int:pk>/', async_views.shop_detail,
+         name='async-shops-detail'),
+    path('users/subscriptions/', async_views.subscriptions,
+         name='async-users-subscriptions'),
+] + [
+    path(f'{catalog}/', async_views.catalog_list, {'catalog': catalog},
+         name=f'async-{catalog}-list')
+    for catalog in async_views.CATALOGS
+]
+
 
 urlpatterns = [
+    path('async/', include(async_urlpatterns)),
+    path('thumbnails/', thumbnail, name='thumbnails'),
     path('', include(router.urls)),
     path('', include('djoser.urls')),
+    path('auth/stats/', auth_stats, name='auth-stats'),
     path('auth/', include('djoser.urls.authtoken')),
 ]
@@ -0,0 +1,54 @@
+from django.db.models import OuterRef, Prefetch, Subquery
+
+from shops.models import FavoriteShop, Shop
+from users.models import Follow
+
+
+def get_favorited_shop_ids(request):
+    """Множество id избранных магазинов пользователя, один запрос на запрос."""
+    if request is None or request.user.is_anonymous:
+        return frozenset()
+    favorited = getattr(request, '_favorited_shop_ids', None)
+    if favorited is None:
+        favorited = frozenset(
+            FavoriteShop.objects.filter(
+                user=request.user
+            ).values_list('shop_id', flat=True)
+        )
+        request._favorited_shop_ids = favorited
+    return favorited
+
+
+def get_following_ids(request):
+    """Множество id производителей, на которых подписан пользователь."""
+    if request is None or request.user.is_anonymous:
+        return frozenset()
+    following = getattr(request, '_following_ids', None)
+    if following is None:
+        following = frozenset(
+            Follow.objects.filter(
+                user=request.user
+            ).values_list('owner_id', flat=True)
+        )
+        request._following_ids = following
+    return following
+
+
+def get_subscriptions_queryset(user, shops_limit=None):
+    """Подписки с магазинами производителей за фиксированное число
+    запросов: первые shops_limit магазинов каждого производителя
+    выбираются одним коррелированным подзапросом."""
+    shops = Shop.objects.prefetch_related('products')
+    if shops_limit and shops_limit.isdigit():
+        shops = shops.filter(id__in=Subquery(
+            Shop.objects.filter(
+                owner=OuterRef('owner')
+            ).values('id')[:int(shops_limit)]
+        ))
+    return Follow.objects.filter(
+        user=user
+    ).select_related('owner').order_by(
+        'owner__username', 'id'
+    ).prefetch_related(
+        Prefetch('owner__shops', queryset=shops, to_attr='limited_shops')
+    )
@@ -1,27 +1,50 @@
-from django.db import IntegrityError
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Prefetch
 from djoser.views import UserViewSet
 from django_filters.rest_framework import DjangoFilterBackend
 from rest_framework.permissions import (
     SAFE_METHODS,
+    IsAdminUser,
     IsAuthenticated,
     IsAuthenticatedOrReadOnly
 )
-from rest_framework.decorators import action
+from rest_framework.decorators import action, api_view, permission_classes
+from rest_framework.exceptions import ValidationError
+from rest_framework.filters import OrderingFilter
+from rest_framework.parsers import JSONParser, MultiPartParser
 from rest_framework import status, viewsets
 from rest_framework.response import Response
+from django.core.files.uploadedfile import UploadedFile
+from django.http import FileResponse, JsonResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.views.decorators.http import require_GET
 from django.shortcuts import get_object_or_404
 from users.models import Follow, User
+from shops import geo
 from shops.models import (
     Shop, Product, FavoriteProduct, FavoriteShop, Category, Subcategory,
-    Messenger
+    Messenger, ShopProduct, ShopMessenger
 )
+from svoe_vkusnee.timing import TimingMixin
+from .authentication import token_cache
+from .basket import availability_index
+from .cache import CatalogCacheMixin
 from .pagination import Pagination
-from .filters import ProductFilter, ShopFilter, MessengerFilter
+from .parsers import ImageUploadParser, JSONLinesParser
+from .filters import (
+    FullTextSearchFilter, ProductFilter, ShopFilter, MessengerFilter
+)
 from .permissions import IsAuthorOrReadOnly
+from .thumbnails import ThumbnailError, open_thumbnail, parse_params
+from .tiles import MAX_ZOOM, build_tile, get_tile
+from .uploads import limit_upload, schedule_image
+from .utils import get_subscriptions_queryset
 from .serializers import (
     UserCustomSerializer,
     FollowSerializer,
     ProductSerializer,
+    ShopBulkCreateSerializer,
     ShopCreateSerializer,
     ShopSerializer,
     ShopFieldSerializer,
@@ -30,14 +53,26 @@ from .serializers import (
     MessengerSerializer,
 )
 
+NEARBY_DEFAULT_K = 10
+NEARBY_MAX_K = 100
+BASKET_DEFAULT_LIMIT = 20
+BASKET_MAX_LIMIT = 100
+BASKET_MAX_PRODUCTS = 100
+AVAILABILITY_BATCH_SIZE = 1000
+BULK_MAX_SHOPS = 100
+
 
-class UserCustomViewSet(UserViewSet):
+class UserCustomViewSet(TimingMixin, UserViewSet):
     """Создание и получение данных пользователя"""
     queryset = User.objects.all()
     serializer_class = UserCustomSerializer
     pagination_class = Pagination
+    cursor_ordering = None
+
+    def get_instance(self):
+        # request.user может прийти из кэша токенов со старыми счётчиками.
+        return User.objects.get(pk=self.request.user.pk)
 
- 
     @action(
         detail=True,
         methods=('post', 'delete'),
@@ -78,11 +113,18 @@ class UserCustomViewSet(UserViewSet):
             status=status.HTTP_400_BAD_REQUEST
         )
 
-    @action(detail=False, permission_classes=(IsAuthenticated, ))
+    def get_subscriptions_queryset(self):
+        return get_subscriptions_queryset(
+            self.request.user, self.request.query_params.get('shops_limit'))
+
+    @action(
+        detail=False,
+        permission_classes=(IsAuthenticated, ),
+        cursor_ordering=('owner__username', 'id'),
+    )
     def subscriptions(self, request):
         """Получение списка подписок"""
-        user = request.user
-        queryset = Follow.objects.filter(user=user)
+        queryset = self.get_subscriptions_queryset()
         pages = self.paginate_queryset(queryset)
         serializer = FollowSerializer(
             pages, many=True, context={'request': request}
@@ -90,18 +132,22 @@ class UserCustomViewSet(UserViewSet):
         return self.get_paginated_response(serializer.data)
 
 
-class ProductViewSet(viewsets.ReadOnlyModelViewSet):
+class ProductViewSet(TimingMixin, CatalogCacheMixin,
+                     viewsets.ReadOnlyModelViewSet):
     """Получение списка товаров."""
 
     queryset = Product.objects.all()
     serializer_class = ProductSerializer
-    filter_backends = (ProductFilter,)
+    filter_backends = (ProductFilter, FullTextSearchFilter, OrderingFilter)
+    ordering_fields = ('favorites_count', 'name')
     pagination_class = None
     search_fields = ('^name', )
+    search_kind = 'product'
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
 
-class MessengerViewSet(viewsets.ReadOnlyModelViewSet):
+class MessengerViewSet(TimingMixin, CatalogCacheMixin,
+                       viewsets.ReadOnlyModelViewSet):
     """Получение списка мессенджеров."""
 
     queryset = Messenger.objects.all()
@@ -112,7 +158,8 @@ class MessengerViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
 
 
-class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class CategoryViewSet(TimingMixin, CatalogCacheMixin,
+                      viewsets.ReadOnlyModelViewSet):
     """Получение списка категорий."""
 
     queryset = Category.objects.all()
@@ -121,7 +168,8 @@ class CategoryViewSet(viewsets.ReadOnlyModelViewSet):
     pagination_class = None
 
 
-class SubcategoryViewSet(viewsets.ReadOnlyModelViewSet):
+class SubcategoryViewSet(TimingMixin, CatalogCacheMixin,
+                         viewsets.ReadOnlyModelViewSet):
     """Получение списка категорий."""
 
     queryset = Subcategory.objects.all()
@@ -129,15 +177,34 @@ class SubcategoryViewSet(viewsets.ReadOnlyModelViewSet):
     permission_classes = (IsAuthenticatedOrReadOnly,)
     pagination_class = None
 
-class ShopViewSet(viewsets.ModelViewSet):
+class ShopViewSet(TimingMixin, viewsets.ModelViewSet):
     """Все действия с магазинами."""
 
     queryset = Shop.objects.all()
-    filter_backends = (DjangoFilterBackend,)
+    filter_backends = (DjangoFilterBackend, FullTextSearchFilter)
     filterset_class = ShopFilter
+    search_kind = 'shop'
     pagination_class = Pagination
+    cursor_ordering = ('name', 'id')
     permission_classes = (IsAuthorOrReadOnly,)
 
+    def get_queryset(self):
+        queryset = super().get_queryset()
+        if self.request.method not in SAFE_METHODS:
+            return queryset
+        return queryset.select_related('owner').prefetch_related(
+            Prefetch(
+                'product',
+                queryset=ShopProduct.objects.select_related('product'),
+                to_attr='shop_products',
+            ),
+            Prefetch(
+                'related_to_messenger',
+                queryset=ShopMessenger.objects.select_related('messenger'),
+                to_attr='shop_messengers',
+            ),
+        )
+
     def update(self, request, *args, **kwargs):
         if kwargs['partial'] is False:
             return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
@@ -148,6 +215,294 @@ class ShopViewSet(viewsets.ModelViewSet):
             return ShopSerializer
         return ShopCreateSerializer
 
+    @action(detail=False)
+    def nearby(self, request):
+        """Магазины рядом с точкой: в радиусе radius км и/или k ближайших."""
+        params = request.query_params
+        try:
+            latitude = float(params['lat'])
+            longitude = float(params['lon'])
+            radius = float(params['radius']) if 'radius' in params else None
+            k = int(params.get('k', NEARBY_DEFAULT_K))
+        except (KeyError, ValueError):
+            return Response(
+                {'errors': 'Укажите числа lat, lon и, при желании, '
+                           'radius и k.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (-90 <= latitude <= 90 and -180 <= longitude <= 180
+                and (radius is None or radius > 0)
+                and 0 < k <= NEARBY_MAX_K):
+            return Response(
+                {'errors': 'Недопустимые координаты, радиус или k.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        queryset = self.filter_queryset(self.get_queryset())
+        found = geo.find_nearby(
+            queryset.order_by(), latitude, longitude, radius, k)
+        shops = queryset.in_bulk([id for id, distance in found])
+        serializer = self.get_serializer(
+            [shops[id] for id, distance in found], many=True)
+        data = serializer.data
+        for item, (id, distance) in zip(data, found):
+            item['distance'] = round(distance, 3)
+        return Response(data)
+
+    @action(
+        detail=True,
+        methods=('post',),
+        parser_classes=(JSONParser, JSONLinesParser),
+    )
+    def availability(self, request, pk=None):
+        """Массовое обновление наличия товаров магазина.
+
+        Принимает список {"product_id": 1, "availability": true} в JSON
+        или по объекту на строку (application/x-ndjson).
+        """
+        shop = self.get_object()
+        if not isinstance(request.data, list):
+            return Response(
+                {'errors': 'Ожидается список товаров.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        wanted, errors = {}, []
+        for index, item in enumerate(request.data):
+            if not (isinstance(item, dict)
+                    and type(item.get('product_id')) is int
+                    and type(item.get('availability')) is bool):
+                errors.append({
+                    'index': index,
+                    'error': 'Нужны целый product_id и логический '
+                             'availability.'
+                })
+                continue
+            wanted[item['product_id']] = item['availability']
+        updated, not_found, indexed = 0, [], {}
+        product_ids = list(wanted)
+        with transaction.atomic():
+            for start in range(0, len(product_ids), AVAILABILITY_BATCH_SIZE):
+                batch = product_ids[start:start + AVAILABILITY_BATCH_SIZE]
+                shop_products = ShopProduct.objects.filter(shop=shop)
+                existing = set(shop_products.filter(
+                    product_id__in=batch
+                ).values_list('product_id', flat=True))
+                not_found.extend(id for id in batch if id not in existing)
+                for value in (True, False):
+                    updated += shop_products.filter(
+                        product_id__in=[
+                            id for id in existing if wanted[id] is value],
+                        availability=not value,
+                    ).update(availability=value)
+                indexed.update((id, wanted[id]) for id in existing)
+            # Индекс видит наличие только после фиксации всех пачек.
+            transaction.on_commit(lambda: availability_index.set_availabilities(
+                shop.id, indexed))
+        return Response({
+            'updated': updated,
+            'unchanged': len(wanted) - updated - len(not_found),
+            'not_found': not_found,
+            'errors': errors,
+        })
+
+    @action(detail=False, methods=('post',))
+    def bulk(self, request):
+        """Создание нескольких магазинов одного владельца одним запросом.
+
+        Товары, мессенджеры, занятые названия и логины загружаются одним
+        запросом на весь список, магазины и их связи вставляются пакетно.
+        """
+        items = request.data
+        if not isinstance(items, list) or not items:
+            return Response(
+                {'errors': 'Ожидается список магазинов.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(items) > BULK_MAX_SHOPS:
+            return Response(
+                {'errors': f'Не больше {BULK_MAX_SHOPS} магазинов за раз.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        context = self.get_bulk_context(items)
+        results = [None] * len(items)
+        valid, seen_names, seen_logins = [], set(), set()
+        for index, item in enumerate(items):
+            serializer = ShopBulkCreateSerializer(data=item, context=context)
+            if not serializer.is_valid():
+                results[index] = {'errors': serializer.errors}
+                continue
+            data = serializer.validated_data
+            logins = {
+                messenger['search_information']
+                for messenger in data['messengers']
+            }
+            if data['name'] in seen_names or logins & seen_logins:
+                results[index] = {'errors': {
+                    'name': 'Название или логин повторяется в запросе.'}}
+                continue
+            seen_names.add(data['name'])
+            seen_logins |= logins
+            valid.append((index, data))
+        try:
+            shops = ShopBulkCreateSerializer.bulk_create(
+                [data for _, data in valid], request.user)
+            created = zip((index for index, _ in valid), shops)
+        except IntegrityError:
+            # Гонка с параллельной записью: создаём по одному.
+            created = []
+            for index, data in valid:
+                try:
+                    shop, = ShopBulkCreateSerializer.bulk_create(
+                        [data], request.user)
+                except IntegrityError:
+                    results[index] = {'errors': {
+                        'name': 'Название или логин уже заняты.'}}
+                else:
+                    created.append((index, shop))
+        for index, shop in created:
+            results[index] = {'id': shop.id}
+        failed = sum('errors' in result for result in results)
+        return Response(
+            {
+                'created': len(results) - failed,
+                'failed': failed,
+                'results': results,
+            },
+            status=(status.HTTP_201_CREATED if failed < len(results)
+                    else status.HTTP_400_BAD_REQUEST)
+        )
+
+    def get_bulk_context(self, items):
+        """Контекст сериализатора со всем, что нужно проверить в списке."""
+        product_ids, messenger_ids, names, logins = set(), set(), set(), set()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            names.add(str(item.get('name')))
+            for product in item.get('products') or ():
+                if isinstance(product, dict):
+                    product_ids.add(str(product.get('id')))
+            for messenger in item.get('messengers') or ():
+                if isinstance(messenger, dict):
+                    messenger_ids.add(str(messenger.get('id')))
+                    logins.add(str(messenger.get('search_information')))
+        return {
+            'request': self.request,
+            'preloaded': {
+                Product: Product.objects.in_bulk(
+                    [id for id in product_ids if id.isdigit()]),
+                Messenger: Messenger.objects.in_bulk(
+                    [id for id in messenger_ids if id.isdigit()]),
+            },
+            'taken_names': set(Shop.objects.filter(
+                name__in=names).values_list('name', flat=True)),
+            'taken_logins': set(ShopMessenger.objects.filter(
+                search_information__in=logins
+            ).values_list('search_information', flat=True)),
+        }
+
+    @action(detail=False)
+    def basket(self, request):
+        """Магазины, где есть товары корзины: сначала с наибольшим
+        покрытием, при равном покрытии ближайшие к lat, lon."""
+        params = request.query_params
+        try:
+            product_ids = list(dict.fromkeys(
+                int(id) for id in params.get('products', '').split(',') if id
+            ))
+            min_matched = int(params.get('min_matched', 1))
+            limit = int(params.get('limit', BASKET_DEFAULT_LIMIT))
+            latitude = longitude = None
+            if 'lat' in params or 'lon' in params:
+                latitude = float(params['lat'])
+                longitude = float(params['lon'])
+        except (KeyError, ValueError):
+            return Response(
+                {'errors': 'Укажите id товаров через запятую в products.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not (0 < len(product_ids) <= BASKET_MAX_PRODUCTS
+                and 0 < limit <= BASKET_MAX_LIMIT):
+            return Response(
+                {'errors': 'Недопустимое число товаров или limit.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        found = availability_index.match(
+            product_ids, min_matched, latitude, longitude, limit)
+        shops = Shop.objects.prefetch_related('products').in_bulk(
+            [shop_id for shop_id, matched, distance in found])
+        data = []
+        for shop_id, matched, distance in found:
+            if shop_id not in shops:
+                continue
+            item = ShopFieldSerializer(
+                shops[shop_id], context={'request': request}).data
+            item['matched'] = matched
+            item['missing'] = [
+                id for id in product_ids if id not in set(matched)]
+            item['coverage'] = round(len(matched) / len(product_ids), 3)
+            item['distance'] = (
+                round(distance, 3) if distance is not None else None)
+            data.append(item)
+        return Response(data)
+
+    @action(
+        detail=True,
+        methods=('put',),
+        url_path=r'images/(?P<field>photo|logo|certificate_photo)',
+        parser_classes=(MultiPartParser, ImageUploadParser),
+    )
+    def images(self, request, field, pk=None):
+        """Загрузка изображения магазина файлом вместо base64.
+
+        Принимает multipart с полем file или само изображение в теле.
+        Изображение обрабатывается в фоне, ответ 202.
+        """
+        shop = self.get_object()
+        try:
+            limit_upload(request)
+            upload = request.data.get('file')
+        except ValidationError as error:
+            return Response(
+                {'errors': error.detail[0]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if not isinstance(upload, UploadedFile):
+            return Response(
+                {'errors': 'Передайте изображение в поле file или в теле.'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            data = schedule_image(shop, field, upload)
+        except ValidationError as error:
+            return Response(
+                {'errors': error.detail[0]},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        return Response(data, status=status.HTTP_202_ACCEPTED)
+
+    @action(
+        detail=False,
+        url_path=r'tiles/(?P<z>\d+)/(?P<x>\d+)/(?P<y>\d+)',
+    )
+    def tiles(self, request, z, x, y):
+        """Кластеры магазинов тайла карты z/x/y."""
+        z, x, y = int(z), int(x), int(y)
+        if z > MAX_ZOOM or x >= 2 ** z or y >= 2 ** z:
+            return Response(
+                {'errors': 'Тайл не существует.'},
+                status=status.HTTP_404_NOT_FOUND
+            )
+        queryset = self.filter_queryset(Shop.objects.all())
+        params = request.query_params
+        if params.get('is_favorited_shops') and request.user.is_authenticated:
+            # Избранное у каждого пользователя своё, такие тайлы не кэшируются.
+            return Response(build_tile(queryset, z, x, y))
+        return Response(get_tile(
+            queryset, z, x, y,
+            [(key, value) for key, value in params.items()
+             if key != 'is_favorited_shops'],
+        ))
+
     def add_to(self, model, user, pk):
         if model.objects.filter(user=user, shop__id=pk).exists():
             return Response({'errors': 'Магазин уже был добавлен.'},
@@ -221,3 +576,36 @@ class ShopViewSet(viewsets.ModelViewSet):
     #     if request.method == 'DELETE':
     #         return self.delete_from(FavoriteProduct, request.user, product_id)
     #     return Response(status=status.HTTP_405_METHOD_NOT_ALLOWED)
+
+
+@require_GET
+def thumbnail(request):
+    """Уменьшенная копия изображения: path, w, h и format (webp, jpeg,
+    png)."""
+    try:
+        name, width, height, image_format = parse_params(
+            request.GET, request.headers.get('Accept', ''))
+        file, content_type, key = open_thumbnail(
+            name, width, height, image_format)
+    except ThumbnailError as error:
+        return JsonResponse({'errors': str(error)}, status=400)
+    except FileNotFoundError:
+        return JsonResponse({'errors': 'Изображение не найдено.'}, status=404)
+    etag = f'"{key}"'
+    response = get_conditional_response(request, etag=etag)
+    if response is None:
+        response = FileResponse(file, content_type=content_type)
+        response['ETag'] = etag
+    else:
+        file.close()
+    response['Vary'] = 'Accept'
+    patch_cache_control(
+        response, public=True, max_age=settings.THUMBNAIL_MAX_AGE)
+    return response
+
+
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def auth_stats(request):
+    """Попадания в кэш токенов этого процесса."""
+    return Response(token_cache.get_stats())
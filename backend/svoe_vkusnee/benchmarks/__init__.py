@@ -0,0 +1,2 @@
+"""Load and micro benchmarks, run from backend/svoe_vkusnee with
+``python -m benchmarks.<name> --help``."""
@@ -0,0 +1,110 @@
+"""Throughput and tail latency of the read endpoints: WSGI vs ASGI.
+
+Starts gunicorn with the sync DRF views and uvicorn with the async views
+from api/async_views.py on the same database, drives both with the same
+number of concurrent keep-alive connections and prints requests per
+second and latency percentiles per endpoint.
+
+    python -m benchmarks.asgi_vs_wsgi --concurrency 256 --duration 20 \\
+        --token <token of a user with subscriptions>
+
+Seed the database first.
+"""
+import argparse
+import asyncio
+import json
+import os
+import signal
+import subprocess
+import sys
+
+from .client import run_load, wait_until_ready
+
+ENDPOINTS = {
+    'shops': ('/api/shops/', '/api/async/shops/'),
+    'shop': ('/api/shops/{shop}/', '/api/async/shops/{shop}/'),
+    'categorys': ('/api/categorys/', '/api/async/categorys/'),
+    'products': ('/api/products/', '/api/async/products/'),
+    'subscriptions': (
+        '/api/users/subscriptions/', '/api/async/users/subscriptions/'),
+}
+
+
+def server_commands(args):
+    wsgi = [
+        sys.executable, '-m', 'gunicorn', 'svoe_vkusnee.wsgi',
+        '--workers', str(args.workers),
+        '--worker-class', 'gthread', '--threads', str(args.threads),
+        '--bind', f'{args.host}:{args.wsgi_port}',
+        '--log-level', 'warning',
+    ]
+    asgi = [
+        sys.executable, '-m', 'uvicorn', 'svoe_vkusnee.asgi:application',
+        '--workers', str(args.workers),
+        '--host', args.host, '--port', str(args.asgi_port),
+        '--log-level', 'warning', '--no-access-log',
+    ]
+    return {'wsgi': (wsgi, args.wsgi_port), 'asgi': (asgi, args.asgi_port)}
+
+
+async def measure(args, server, port):
+    base_url = f'http://{args.host}:{port}'
+    if not await wait_until_ready(base_url):
+        raise RuntimeError(f'{server} server did not start on {base_url}')
+    headers = {'Accept': 'application/json'}
+    if args.token:
+        headers['Authorization'] = f'Token {args.token}'
+    results = {}
+    for name in args.endpoints:
+        if name == 'subscriptions' and not args.token:
+            continue
+        path = ENDPOINTS[name][server == 'asgi'].format(shop=args.shop)
+        # Warm up caches and connections before measuring.
+        await run_load(base_url, [path], min(args.concurrency, 8), 1, headers)
+        result = await run_load(
+            base_url, [path], args.concurrency, args.duration, headers)
+        results[name] = result.summary()
+        print(f'{server:5} {name:14} {json.dumps(results[name])}')
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--concurrency', type=int, default=256)
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=8,
+                        help='threads per gunicorn worker')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--wsgi-port', type=int, default=8101)
+    parser.add_argument('--asgi-port', type=int, default=8102)
+    parser.add_argument('--token', help='auth token for subscriptions')
+    parser.add_argument('--shop', type=int, default=1,
+                        help='shop id for the detail endpoint')
+    parser.add_argument('--endpoints', nargs='+', default=list(ENDPOINTS),
+                        choices=list(ENDPOINTS))
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+
+    results = {}
+    for server, (command, port) in server_commands(args).items():
+        process = subprocess.Popen(command)
+        try:
+            results[server] = asyncio.run(measure(args, server, port))
+        finally:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+
+    print(f'\n{"endpoint":14} {"wsgi rps":>10} {"asgi rps":>10} '
+          f'{"wsgi p99":>10} {"asgi p99":>10}')
+    for name in results.get('wsgi', {}):
+        wsgi, asgi = results['wsgi'][name], results['asgi'].get(name, {})
+        print(f'{name:14} {wsgi["rps"]:>10} {asgi.get("rps", "-"):>10} '
+              f'{wsgi["p99_ms"]:>10} {asgi.get("p99_ms", "-"):>10}')
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,161 @@
+"""Minimal HTTP/1.1 load generator on asyncio streams.
+
+Each of ``concurrency`` workers keeps one keep-alive connection and sends
+requests back to back, so the number of in-flight requests is fixed and
+the server, not the client, is the bottleneck.
+"""
+import asyncio
+import itertools
+import statistics
+import time
+from dataclasses import dataclass, field
+from urllib.parse import urlsplit
+
+
+@dataclass
+class Result:
+    latencies: list = field(default_factory=list)
+    statuses: dict = field(default_factory=dict)
+    errors: int = 0
+    elapsed: float = 0
+    responses: list = field(default_factory=list)
+
+    def summary(self):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+
+        def percentile(value):
+            if not count:
+                return None
+            return round(latencies[min(count - 1, int(count * value))]
+                         * 1000, 2)
+
+        return {
+            'requests': count,
+            'errors': self.errors,
+            'statuses': self.statuses,
+            'rps': round(count / self.elapsed, 1) if self.elapsed else 0,
+            'mean_ms': (round(statistics.fmean(latencies) * 1000, 2)
+                        if count else None),
+            'p50_ms': percentile(0.5),
+            'p90_ms': percentile(0.9),
+            'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99),
+            'max_ms': percentile(1),
+        }
+
+
+class Connection:
+    """A keep-alive connection to one host."""
+
+    def __init__(self, host, port):
+        self.host, self.port = host, port
+        self.reader = self.writer = None
+
+    async def open(self):
+        self.reader, self.writer = await asyncio.open_connection(
+            self.host, self.port)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.writer = None
+
+    async def request(self, method, path, headers=None, body=b''):
+        """Status, headers and body of one response."""
+        if self.writer is None:
+            await self.open()
+        lines = [f'{method} {path} HTTP/1.1', f'Host: {self.host}']
+        lines += [f'{name}: {value}' for name, value in
+                  (headers or {}).items()]
+        if body:
+            lines.append(f'Content-Length: {len(body)}')
+        self.writer.write(('\r\n'.join(lines) + '\r\n\r\n').encode() + body)
+        await self.writer.drain()
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise ConnectionError('connection closed by the server')
+        status = int(status_line.split()[1])
+        response_headers = {}
+        while (line := await self.reader.readline()) not in (b'\r\n', b''):
+            name, _, value = line.decode('latin-1').partition(':')
+            response_headers[name.strip().lower()] = value.strip()
+        if 'content-length' in response_headers:
+            content = await self.reader.readexactly(
+                int(response_headers['content-length']))
+        elif response_headers.get('transfer-encoding') == 'chunked':
+            content = await self._read_chunked()
+        else:
+            content = await self.reader.read()
+        keep_alive = response_headers.get('connection', '').lower() != 'close'
+        if status_line.startswith(b'HTTP/1.0'):
+            keep_alive = (
+                response_headers.get('connection', '').lower()
+                == 'keep-alive')
+        if not keep_alive:
+            await self.close()
+        return status, response_headers, content
+
+    async def _read_chunked(self):
+        chunks = []
+        while True:
+            size = int((await self.reader.readline()).split(b';')[0], 16)
+            if not size:
+                await self.reader.readline()
+                return b''.join(chunks)
+            chunks.append(await self.reader.readexactly(size))
+            await self.reader.readline()
+
+
+async def run_load(base_url, paths, concurrency=64, duration=10,
+                   headers=None, keep_responses=False):
+    """Requests paths round-robin for duration seconds."""
+    url = urlsplit(base_url)
+    result = Result()
+    paths = itertools.cycle(paths)
+    deadline = time.monotonic() + duration
+
+    async def worker():
+        connection = Connection(url.hostname, url.port or 80)
+        try:
+            while time.monotonic() < deadline:
+                path = next(paths)
+                started = time.perf_counter()
+                try:
+                    status, response_headers, _ = await connection.request(
+                        'GET', path, headers)
+                except (OSError, ConnectionError, ValueError,
+                        asyncio.IncompleteReadError):
+                    result.errors += 1
+                    await connection.close()
+                    continue
+                result.latencies.append(time.perf_counter() - started)
+                result.statuses[status] = result.statuses.get(status, 0) + 1
+                if keep_responses:
+                    result.responses.append((path, status, response_headers))
+        finally:
+            await connection.close()
+
+    started = time.monotonic()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    result.elapsed = time.monotonic() - started
+    return result
+
+
+async def wait_until_ready(base_url, path='/api/', timeout=30):
+    url = urlsplit(base_url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        connection = Connection(url.hostname, url.port or 80)
+        try:
+            await connection.request('GET', path)
+            return True
+        except (OSError, ConnectionError, asyncio.IncompleteReadError):
+            await asyncio.sleep(0.2)
+        finally:
+            await connection.close()
+    return False
@@ -0,0 +1,271 @@
+"""Seeds the database with a synthetic dataset for load tests.
+
+Popularity is skewed the way real data is: product counts of shops
+follow a Pareto distribution, and follows and favorites pick owners,
+shops and products with Zipf weights, so a few of them collect most of
+the followers. Images are a handful of small placeholders stored once
+through the content-addressed storage. Rows are inserted with
+bulk_create, after which counters are reconciled, the search index is
+rebuilt, and the shared cache is told about the new rows: the catalog
+version is bumped and the tiles of the new shops are invalidated.
+
+    python -m benchmarks.dataset --users 10000 --shops 2000 \\
+        --products 5000 --tokens benchmarks/tokens.json
+
+Usernames start with --prefix, so a second run needs another prefix.
+Running servers refresh their in-process basket index only after
+BASKET_INDEX_TTL; restart them to measure with the new data at once.
+"""
+import argparse
+import io
+import itertools
+import json
+import os
+import random
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'svoe_vkusnee.settings')
+django.setup()
+
+from django.contrib.auth.hashers import make_password  # noqa
+from django.core.files.base import ContentFile  # noqa
+from django.db import transaction  # noqa
+from PIL import Image  # noqa
+from rest_framework.authtoken.models import Token  # noqa
+
+from api.tiles import invalidate_tiles  # noqa
+from shops import search  # noqa
+from shops.counters import reconcile  # noqa
+from shops.models import (Category, FavoriteProduct, FavoriteShop,  # noqa
+                          Messenger, Product, Shop, ShopMessenger,
+                          ShopProduct, Subcategory)
+from shops.signals import catalog_imported  # noqa
+from shops.storage import content_storage  # noqa
+from users.models import Follow, User  # noqa
+
+BATCH_SIZE = 1000
+MAX_RELATIONS = 200
+PASSWORD = 'benchmark-password'
+PLACEHOLDER_COLORS = (
+    '#e4572e', '#29335c', '#f3a712', '#a8c686', '#669bbc', '#8d6a9f')
+MESSENGERS = ('Telegram', 'WhatsApp', 'VK', 'Viber')
+CITIES = {
+    'Москва': (55.7558, 37.6173),
+    'Санкт-Петербург': (59.9343, 30.3351),
+    'Тверь': (56.8587, 35.9176),
+    'Казань': (55.7887, 49.1221),
+    'Новосибирск': (55.0084, 82.9357),
+}
+WORDS = (
+    'мёд', 'сыр', 'молоко', 'творог', 'хлеб', 'варенье', 'чай', 'кофе',
+    'колбаса', 'масло', 'яйца', 'овощи', 'ягоды', 'грибы', 'орехи',
+    'домашний', 'фермерский', 'свежий', 'натуральный', 'липовый',
+    'козий', 'копчёный', 'ржаной', 'лесной', 'сезонный',
+)
+
+
+def zipf_sampler(rng, population, exponent):
+    """Sampler of population items with weights 1 / rank ** exponent."""
+    population = list(population)
+    cum_weights = list(itertools.accumulate(
+        1 / (rank + 1) ** exponent for rank in range(len(population))))
+
+    def sample(k):
+        return rng.choices(population, cum_weights=cum_weights, k=k)
+    return sample
+
+
+def pareto_count(rng, alpha, minimum, maximum):
+    """Count with a heavy tail: at least minimum, mostly close to it."""
+    return min(int(minimum * rng.paretovariate(alpha)), maximum)
+
+
+def text(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words))
+
+
+def placeholders():
+    """Names of placeholder images, each stored once."""
+    names = []
+    for color in PLACEHOLDER_COLORS:
+        buffer = io.BytesIO()
+        Image.new('RGB', (64, 64), color).save(buffer, 'PNG')
+        names.append(content_storage.save(
+            'placeholder.png', ContentFile(buffer.getvalue())))
+    return names
+
+
+def insert(model, objects):
+    return model.objects.bulk_create(objects, batch_size=BATCH_SIZE)
+
+
+def seed_catalog(rng, args, images):
+    categories = insert(Category, [
+        Category(name=f'{args.prefix} категория {i}',
+                 slug=f'{args.prefix}-category-{i}',
+                 photo=rng.choice(images))
+        for i in range(args.categories)
+    ])
+    subcategories = insert(Subcategory, [
+        Subcategory(name=f'{category.name}.{j}',
+                    slug=f'{category.slug}-{j}', category=category)
+        for category in categories for j in range(args.subcategories)
+    ])
+    products = insert(Product, [
+        Product(name=f'{text(rng, 2)} {args.prefix}-{i}',
+                description=text(rng, 12), photo=rng.choice(images),
+                subcategory=rng.choice(subcategories))
+        for i in range(args.products)
+    ])
+    messengers = list(Messenger.objects.filter(name__in=MESSENGERS))
+    known = {messenger.name for messenger in messengers}
+    messengers += insert(Messenger, [
+        Messenger(name=name, logo=rng.choice(images))
+        for name in MESSENGERS if name not in known
+    ])
+    return products, messengers
+
+
+def seed_users(args):
+    password = make_password(PASSWORD)
+    return insert(User, [
+        User(email=f'{args.prefix}{i}@example.com',
+             username=f'{args.prefix}{i}', first_name='Тест',
+             last_name=f'Пользователь {i}', phone_number='+70000000000',
+             password=password)
+        for i in range(args.users)
+    ])
+
+
+def seed_shops(rng, args, users, products, messengers, images):
+    owners = users[:max(1, int(len(users) * args.owners_share))]
+    pick_owner = zipf_sampler(rng, owners, args.zipf)
+    pick_product = zipf_sampler(rng, products, args.zipf)
+    shops = []
+    for i, owner in enumerate(pick_owner(args.shops)):
+        city, (latitude, longitude) = rng.choice(list(CITIES.items()))
+        shop = Shop(
+            name=f'{text(rng, 2).capitalize()} {args.prefix}-{i}',
+            mainstream=rng.choice(Shop.MAINSTREAMS)[0],
+            description=text(rng, 20), history=text(rng, 30),
+            presented=text(rng, 5), city=city, owner=owner,
+            coordinates=(f'{latitude + rng.gauss(0, 0.1):.6f}, '
+                         f'{longitude + rng.gauss(0, 0.1):.6f}'),
+            delivery=rng.random() < 0.5,
+            photo=rng.choice(images), logo=rng.choice(images),
+        )
+        shop.update_location()
+        shops.append(shop)
+    shops = insert(Shop, shops)
+    shop_products, shop_messengers = [], []
+    for shop in shops:
+        count = pareto_count(
+            rng, args.pareto, args.min_products, args.max_products)
+        for product in set(pick_product(count)):
+            shop_products.append(ShopProduct(
+                shop=shop, product=product,
+                availability=rng.random() < 0.8))
+        for messenger in rng.sample(messengers, rng.randint(1, 2)):
+            shop_messengers.append(ShopMessenger(
+                shop=shop, messenger=messenger,
+                search_information=f'@{messenger.name}-{shop.pk}'.lower()))
+    insert(ShopProduct, shop_products)
+    insert(ShopMessenger, shop_messengers)
+    return shops, len(shop_products)
+
+
+def seed_relations(rng, args, users, shops, products):
+    """Follows, favorite shops and favorite products of every user."""
+    pick_owner = zipf_sampler(
+        rng, list({shop.owner_id: shop.owner for shop in shops}.values()),
+        args.zipf)
+    pick_shop = zipf_sampler(rng, shops, args.zipf)
+    pick_product = zipf_sampler(rng, products, args.zipf)
+
+    def relations_count():
+        # Most users follow nobody, a few follow hundreds.
+        return pareto_count(rng, args.pareto, 1, MAX_RELATIONS) - 1
+
+    follows, favorite_shops, favorite_products = [], [], []
+    for user in users:
+        owners = set(pick_owner(relations_count()))
+        follows += [Follow(user=user, owner=owner)
+                    for owner in owners if owner.pk != user.pk]
+        favorite_shops += [
+            FavoriteShop(user=user, shop=shop)
+            for shop in set(pick_shop(relations_count()))]
+        favorite_products += [
+            FavoriteProduct(user=user, product=product)
+            for product in set(pick_product(relations_count()))]
+    insert(Follow, follows)
+    insert(FavoriteShop, favorite_shops)
+    insert(FavoriteProduct, favorite_products)
+    return len(follows), len(favorite_shops), len(favorite_products)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--users', type=int, default=2000)
+    parser.add_argument('--shops', type=int, default=500)
+    parser.add_argument('--products', type=int, default=2000)
+    parser.add_argument('--categories', type=int, default=10)
+    parser.add_argument('--subcategories', type=int, default=5,
+                        help='subcategories per category')
+    parser.add_argument('--min-products', type=int, default=5,
+                        help='the smallest number of products of a shop')
+    parser.add_argument('--max-products', type=int, default=300,
+                        help='the largest number of products of a shop')
+    parser.add_argument('--owners-share', type=float, default=0.2,
+                        help='share of users that may own shops')
+    parser.add_argument('--zipf', type=float, default=1.1,
+                        help='exponent of popularity of shops and products')
+    parser.add_argument('--pareto', type=float, default=1.2,
+                        help='shape of per-shop and per-user counts')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--prefix', default='bench')
+    parser.add_argument('--tokens', help='write tokens of users as JSON')
+    parser.add_argument('--token-count', type=int, default=100)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    started = time.monotonic()
+    with transaction.atomic():
+        images = placeholders()
+        products, messengers = seed_catalog(rng, args, images)
+        users = seed_users(args)
+        shops, shop_products = seed_shops(
+            rng, args, users, products, messengers, images)
+        follows, favorite_shops, favorite_products = seed_relations(
+            rng, args, users, shops, products)
+        tokens = insert(Token, [
+            Token(key=Token.generate_key(), user=user)
+            for user in rng.sample(users, min(args.token_count, len(users)))
+        ])
+    reconcile()
+    for kind in sorted(search.FIELDS):
+        search.rebuild_index(kind)
+    # bulk_create sends no model signals: responses cached by servers
+    # that are already running are invalidated here.
+    for model, kind in ((Category, 'categories'),
+                        (Subcategory, 'subcategories'),
+                        (Product, 'products'), (Messenger, 'messengers')):
+        catalog_imported.send(sender=model, kind=kind)
+    invalidate_tiles(*((shop.latitude, shop.longitude) for shop in shops))
+
+    print(json.dumps({
+        'users': len(users), 'shops': len(shops),
+        'products': len(products),
+        'shop_products': shop_products,
+        'follows': follows, 'favorite_shops': favorite_shops,
+        'favorite_products': favorite_products,
+        'seconds': round(time.monotonic() - started, 1),
+    }, indent=2))
+    if args.tokens:
+        with open(args.tokens, 'w') as file:
+            json.dump([token.key for token in tokens], file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
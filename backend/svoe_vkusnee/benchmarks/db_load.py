@@ -0,0 +1,135 @@
+"""Concurrent read/write throughput of the configured database.
+
+Reader threads run the queries of the shop list page, writer threads
+toggle product availability and favorites in short transactions, all for
+the same duration. Prints operations per second, latency percentiles and
+the number of lock errors per kind of operation.
+
+    DB_ENGINE=sqlite python -m benchmarks.db_load --readers 8 --writers 2
+    SQLITE_TUNED=0 python -m benchmarks.db_load   # without the pragmas
+    DB_ENGINE=postgresql python -m benchmarks.db_load
+
+The database must hold shops with products, for example a copy of
+production data.
+"""
+import argparse
+import json
+import os
+import random
+import threading
+import time
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'svoe_vkusnee.settings')
+django.setup()
+
+from django.db import OperationalError, connection, transaction  # noqa
+from django.db.models import Prefetch  # noqa
+
+from shops.models import (FavoriteShop, Shop, ShopMessenger,  # noqa
+                          ShopProduct)
+from users.models import User  # noqa
+
+from .client import Result  # noqa
+
+
+def read(shop_ids, page_size=20):
+    """Queries of one shop list page."""
+    start = random.randrange(max(len(shop_ids) - page_size, 1))
+    ids = shop_ids[start:start + page_size]
+    Shop.objects.count()
+    list(Shop.objects.filter(id__in=ids).select_related(
+        'owner').prefetch_related(
+        Prefetch('product',
+                 queryset=ShopProduct.objects.select_related('product')),
+        Prefetch('related_to_messenger',
+                 queryset=ShopMessenger.objects.select_related('messenger')),
+    ))
+
+
+def write(shop_ids, user_ids):
+    """A short transaction: one availability flip and one favorite."""
+    shop_id = random.choice(shop_ids)
+    with transaction.atomic():
+        shop_product = ShopProduct.objects.filter(
+            shop_id=shop_id).order_by('?').first()
+        if shop_product is not None:
+            ShopProduct.objects.filter(pk=shop_product.pk).update(
+                availability=not shop_product.availability)
+        favorite, created = FavoriteShop.objects.get_or_create(
+            user_id=random.choice(user_ids), shop_id=shop_id)
+        if not created:
+            favorite.delete()
+
+
+def worker(operation, args, deadline, result, lock):
+    latencies, errors = [], 0
+    try:
+        while time.monotonic() < deadline:
+            started = time.perf_counter()
+            try:
+                operation(*args)
+            except OperationalError:
+                errors += 1
+                continue
+            latencies.append(time.perf_counter() - started)
+    finally:
+        connection.close()
+    with lock:
+        result.latencies.extend(latencies)
+        result.errors += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--writers', type=int, default=2)
+    parser.add_argument('--duration', type=float, default=15)
+    parser.add_argument('--output', help='write results as JSON')
+    args = parser.parse_args()
+
+    shop_ids = list(Shop.objects.order_by('id').values_list('id', flat=True))
+    user_ids = list(User.objects.values_list('id', flat=True)[:1000])
+    if not shop_ids or not user_ids:
+        parser.error('the database has no shops or users')
+    connection.close()
+
+    results = {'read': Result(), 'write': Result()}
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    threads = [
+        threading.Thread(target=worker, args=(
+            read, (shop_ids,), deadline, results['read'], lock))
+        for _ in range(args.readers)
+    ] + [
+        threading.Thread(target=worker, args=(
+            write, (shop_ids, user_ids), deadline, results['write'], lock))
+        for _ in range(args.writers)
+    ]
+    started = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - started
+
+    settings_dict = connection.settings_dict
+    summary = {
+        'engine': settings_dict['ENGINE'],
+        'pragmas': settings_dict.get('PRAGMAS', {}),
+        'readers': args.readers,
+        'writers': args.writers,
+    }
+    for kind, result in results.items():
+        result.elapsed = elapsed
+        summary[kind] = result.summary()
+        summary[kind].pop('statuses')
+    print(json.dumps(summary, indent=2))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(summary, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
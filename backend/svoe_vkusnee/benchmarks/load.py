@@ -0,0 +1,279 @@
+"""Load test of every readable API route against a running server.
+
+Each route from api/urls.py that answers GET is requested with the same
+number of concurrent keep-alive connections for the same duration. The
+report has requests per second, latency percentiles and SQL queries per
+request, read from the Server-Timing header of svoe_vkusnee/timing.py,
+so the server must run with TIMING_SAMPLE_RATE=1 (--start-server does
+that). Routes that only accept writes are listed as skipped.
+
+    python -m benchmarks.dataset --tokens benchmarks/tokens.json
+    python -m benchmarks.load --start-server --tokens benchmarks/tokens.json \\
+        --output before.json
+    ... change the code ...
+    python -m benchmarks.load --start-server --tokens benchmarks/tokens.json \\
+        --output after.json --compare before.json
+
+Object ids and query parameters are taken from the database the script
+is configured with, which must be the one the server uses.
+"""
+import argparse
+import asyncio
+import json
+import os
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import time
+from urllib.parse import urlencode
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'svoe_vkusnee.settings')
+django.setup()
+
+from django.urls import URLPattern, URLResolver, get_resolver  # noqa
+from django.urls import reverse  # noqa
+
+from api.tiles import tile_position  # noqa
+from shops.models import Category, Product, Shop, Subcategory  # noqa
+from users.models import User  # noqa
+
+from .client import run_load, wait_until_ready  # noqa
+
+SERVER_TIMING_SQL_RE = re.compile(r'sql;dur=([\d.]+);desc="(\d+) queries"')
+TILE_ZOOM = 12
+# Readable routes that are not load-tested, with the reason.
+SKIPPED = {
+    'auth-stats': 'admin only',
+}
+AUTHENTICATED = (
+    'users-me', 'users-subscriptions', 'async-users-subscriptions')
+
+
+def api_routes():
+    """{name: allowed methods} of the routes in api/urls.py."""
+    routes, seen = {}, set()
+
+    def walk(patterns, prefix):
+        for pattern in patterns:
+            route = prefix + str(pattern.pattern)
+            if isinstance(pattern, URLResolver):
+                walk(pattern.url_patterns, route)
+            elif isinstance(pattern, URLPattern) and pattern.name:
+                # Format suffixes and the routes djoser registers again
+                # under other names are unreachable duplicates.
+                if 'format' in route or route in seen:
+                    continue
+                seen.add(route)
+                routes[pattern.name] = methods(pattern.callback)
+
+    for pattern in get_resolver().url_patterns:
+        if getattr(pattern, 'namespace', None) == 'api':
+            walk(pattern.url_patterns, '')
+    return routes
+
+
+def methods(callback):
+    if getattr(callback, 'actions', None):
+        return {method.upper() for method in callback.actions}
+    view_class = getattr(callback, 'view_class', None) or getattr(
+        callback, 'cls', None)
+    if view_class is not None:
+        return {method.upper() for method in view_class.http_method_names
+                if hasattr(view_class, method)}
+    return {'GET'}
+
+
+def build_paths(authenticated):
+    """{route name: path with ids and query} for the seeded database."""
+    shop = Shop.objects.filter(latitude__isnull=False).order_by(
+        '-followers_count').first()
+    products = list(Product.objects.order_by('-favorites_count')[:5])
+    user = User.objects.order_by('-followers_count').first()
+    category = Category.objects.first()
+    subcategory = Subcategory.objects.first()
+    if None in (shop, user, category, subcategory) or not products:
+        raise SystemExit('The database is empty, run benchmarks.dataset.')
+    column, row = tile_position(TILE_ZOOM, shop.latitude, shop.longitude)
+
+    def url(name, *args, **query):
+        path = reverse(f'api:{name}', args=args)
+        return f'{path}?{urlencode(query)}' if query else path
+
+    paths = {
+        'api-root': url('api-root'),
+        'shops-list': url('shops-list'),
+        'shops-detail': url('shops-detail', shop.pk),
+        'shops-nearby': url(
+            'shops-nearby', lat=shop.latitude, lon=shop.longitude, k=10),
+        'shops-basket': url(
+            'shops-basket', products=','.join(str(p.pk) for p in products),
+            lat=shop.latitude, lon=shop.longitude),
+        'shops-tiles': url(
+            'shops-tiles', TILE_ZOOM, int(column), int(row)),
+        'products-list': url('products-list'),
+        'products-detail': url('products-detail', products[0].pk),
+        'categorys-list': url('categorys-list'),
+        'categorys-detail': url('categorys-detail', category.pk),
+        'subcategorys-list': url('subcategorys-list'),
+        'subcategorys-detail': url('subcategorys-detail', subcategory.pk),
+        'users-list': url('users-list'),
+        'users-detail': url('users-detail', user.pk),
+        'async-shops-list': url('async-shops-list'),
+        'async-shops-detail': url('async-shops-detail', shop.pk),
+        'async-categorys-list': url('async-categorys-list'),
+        'async-subcategorys-list': url('async-subcategorys-list'),
+        'async-products-list': url('async-products-list'),
+        'async-messengers-list': url('async-messengers-list'),
+        'thumbnails': url('thumbnails', path=shop.photo.name, w=320),
+    }
+    if authenticated:
+        paths.update({name: url(name) for name in AUTHENTICATED})
+    return paths
+
+
+def queries_summary(responses):
+    """Queries and SQL time per request from Server-Timing headers."""
+    counts, sql_ms = [], []
+    for _, _, headers in responses:
+        match = SERVER_TIMING_SQL_RE.search(headers.get('server-timing', ''))
+        if match:
+            sql_ms.append(float(match.group(1)))
+            counts.append(int(match.group(2)))
+    if not counts:
+        return {'queries_mean': None, 'queries_max': None, 'sql_ms_mean': None}
+    return {
+        'queries_mean': round(statistics.fmean(counts), 2),
+        'queries_max': max(counts),
+        'sql_ms_mean': round(statistics.fmean(sql_ms), 2),
+    }
+
+
+async def measure(args, paths, headers):
+    base_url = args.base_url.rstrip('/')
+    if not await wait_until_ready(base_url):
+        raise SystemExit(f'No server at {base_url}')
+    results = {}
+    for name, path in paths.items():
+        await run_load(base_url, [path], min(args.concurrency, 8), 1, headers)
+        result = await run_load(
+            base_url, [path], args.concurrency, args.duration, headers,
+            keep_responses=True)
+        results[name] = {
+            'path': path,
+            **result.summary(),
+            **queries_summary(result.responses),
+        }
+        print(f'{name:26} {json.dumps(results[name], ensure_ascii=False)}')
+    return results
+
+
+def compare(results, baseline):
+    print(f'\n{"endpoint":26} {"rps":>17} {"p99 ms":>17} {"queries":>13}')
+    for name, new in results.items():
+        old = baseline.get('endpoints', {}).get(name)
+        if old is None:
+            continue
+
+        def cell(key, width):
+            return f'{old.get(key)} -> {new.get(key)}'.rjust(width)
+        change = ''
+        if old.get('rps'):
+            change = f' {(new["rps"] - old["rps"]) / old["rps"]:+.0%}'
+        print(f'{name:26} {cell("rps", 17)} {cell("p99_ms", 17)} '
+              f'{cell("queries_mean", 13)}{change}')
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+            text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def start_server(args):
+    host, _, port = args.base_url.split('://')[-1].rstrip('/').partition(':')
+    command = [
+        sys.executable, '-m', 'gunicorn', 'svoe_vkusnee.wsgi',
+        '--workers', str(args.workers),
+        '--worker-class', 'gthread', '--threads', str(args.threads),
+        '--bind', f'{host}:{port or 80}', '--log-level', 'warning',
+    ]
+    return subprocess.Popen(
+        command, env={**os.environ, 'TIMING_SAMPLE_RATE': '1'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--base-url', default='http://127.0.0.1:8100')
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--token', help='auth token for all requests')
+    parser.add_argument('--tokens', help='JSON list of tokens, the first '
+                                         'one is used')
+    parser.add_argument('--routes', nargs='+', help='route names to test')
+    parser.add_argument('--start-server', action='store_true',
+                        help='run gunicorn with timing on --base-url')
+    parser.add_argument('--workers', type=int, default=os.cpu_count())
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    token = args.token
+    if token is None and args.tokens:
+        with open(args.tokens) as file:
+            token = json.load(file)[0]
+    headers = {'Accept': 'application/json'}
+    if token:
+        headers['Authorization'] = f'Token {token}'
+
+    paths = build_paths(authenticated=bool(token))
+    routes = api_routes()
+    readable = {name for name, allowed in routes.items() if 'GET' in allowed}
+    skipped = {name: 'writes only' for name in routes if name not in readable}
+    skipped.update({name: reason for name, reason in SKIPPED.items()
+                    if name in routes})
+    for name in readable - paths.keys() - skipped.keys():
+        skipped[name] = (
+            'needs --token' if name in AUTHENTICATED else 'no path in load.py')
+    if args.routes:
+        paths = {name: paths[name] for name in args.routes if name in paths}
+
+    process = start_server(args) if args.start_server else None
+    started = time.time()
+    try:
+        results = asyncio.run(measure(args, paths, headers))
+    finally:
+        if process is not None:
+            process.send_signal(signal.SIGTERM)
+            process.wait(timeout=30)
+
+    report = {
+        'commit': git_commit(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(started)),
+        'base_url': args.base_url,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'authenticated': bool(token),
+        'endpoints': results,
+        'skipped': skipped,
+    }
+    if skipped:
+        print('\nskipped: ' + ', '.join(
+            f'{name} ({reason})' for name, reason in sorted(skipped.items())))
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(report, file, indent=2, ensure_ascii=False)
+
+
+if __name__ == '__main__':
+    main()
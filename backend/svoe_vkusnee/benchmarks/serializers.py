@@ -0,0 +1,227 @@
+"""Micro-benchmarks of the API serializers on in-memory objects.
+
+Fixtures are unsaved model instances with relations attached the way the
+views prefetch them, and a request with the per-request favorite and
+follow sets already filled, so serializers run without the database: any
+query raises. For every serializer the report has time per object and
+memory per object: the peak allocated while serializing and what stays
+allocated in the result.
+
+    python -m benchmarks.serializers --objects 200 --output before.json
+    ... change a serializer ...
+    python -m benchmarks.serializers --objects 200 --compare before.json
+"""
+import argparse
+import json
+import os
+import statistics
+import timeit
+import tracemalloc
+
+import django
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'svoe_vkusnee.settings')
+django.setup()
+
+from django.db import connections  # noqa
+from django.test import RequestFactory  # noqa
+from django.test.utils import override_settings  # noqa
+
+from api.serializers import (CategorySerializer, FollowSerializer,  # noqa
+                             ProductSerializer, ShopMessengerSerializer,
+                             ShopOwnerSerializer, ShopProductSerializer,
+                             ShopSerializer, UserCustomSerializer)
+from shops.models import (Category, Messenger, Product, Shop,  # noqa
+                          ShopMessenger, ShopProduct, Subcategory)
+from users.models import Follow, User  # noqa
+
+IMAGE = 'cas/ab/' + 'ab' * 32 + '.png'
+
+
+class Fixtures:
+    """Related objects shared by all fixtures of one run."""
+
+    def __init__(self, args):
+        self.args = args
+        category = Category(pk=1, name='Молочные продукты', slug='milk',
+                            photo=IMAGE)
+        subcategory = Subcategory(pk=1, name='Сыры', slug='cheese',
+                                  category=category)
+        self.products = [
+            Product(pk=i, name=f'Сыр {i}', description='Выдержанный сыр ' * 8,
+                    photo=IMAGE, subcategory=subcategory,
+                    favorites_count=i)
+            for i in range(1, args.products + 1)
+        ]
+        self.messengers = [
+            Messenger(pk=i, name=name, logo=IMAGE)
+            for i, name in enumerate(('Telegram', 'WhatsApp'), 1)
+        ]
+        self.category = category
+        self.viewer = self.user(0)
+        self.request = RequestFactory().get('/api/shops/')
+        self.request.user = self.viewer
+        # Filled by get_favorited_shop_ids and get_following_ids in views.
+        self.request._favorited_shop_ids = frozenset(
+            range(0, args.objects, 2))
+        self.request._following_ids = frozenset(range(0, args.objects, 3))
+        self.context = {'request': self.request}
+
+    def user(self, pk):
+        return User(
+            pk=pk, email=f'user{pk}@example.com', username=f'user{pk}',
+            first_name='Иван', last_name='Петров',
+            phone_number='+79990000000', followers_count=pk,
+            shops_count=pk % 5)
+
+    def shop(self, pk, owner=None):
+        shop = Shop(
+            pk=pk, name=f'Сыроварня {pk}', mainstream='M_1',
+            description='Сыры из молока своих коз. ' * 10,
+            region='Тверская область', city='Тверь', street='Советская',
+            house='1', history='Начинали с одной козы. ' * 10,
+            coordinates='56.8587, 35.9176', latitude=56.8587,
+            longitude=35.9176, geohash='ucfv0j7qm', presented='ярмарки',
+            delivery=True, contacts='+79990000000', photo=IMAGE, logo=IMAGE,
+            owner=owner or self.user(pk), followers_count=pk)
+        shop.shop_products = [
+            ShopProduct(pk=pk * 1000 + product.pk, shop=shop,
+                        product=product, availability=bool(product.pk % 2))
+            for product in self.products
+        ]
+        shop.shop_messengers = [
+            ShopMessenger(pk=pk * 10 + messenger.pk, shop=shop,
+                          messenger=messenger,
+                          search_information=f'@shop{pk}-{messenger.pk}')
+            for messenger in self.messengers
+        ]
+        # Prefetched shop.products, as in get_subscriptions_queryset.
+        products = Product.objects.all()
+        products._result_cache = self.products
+        products._prefetch_done = True
+        shop._prefetched_objects_cache = {'products': products}
+        return shop
+
+    def follow(self, pk):
+        owner = self.user(pk)
+        owner.limited_shops = [
+            self.shop(pk * 10 + i, owner) for i in range(self.args.shops)]
+        return Follow(pk=pk, user=self.viewer, owner=owner)
+
+
+def cases(fixtures):
+    """{name: (serializer class, objects)}."""
+    count = fixtures.args.objects
+    shops = [fixtures.shop(pk) for pk in range(count)]
+    return {
+        'ShopSerializer': (ShopSerializer, shops),
+        'ShopOwnerSerializer': (
+            ShopOwnerSerializer, [shop.owner for shop in shops]),
+        'ShopProductSerializer': (
+            ShopProductSerializer,
+            [item for shop in shops for item in shop.shop_products][:count]),
+        'ShopMessengerSerializer': (
+            ShopMessengerSerializer,
+            [item for shop in shops for item in shop.shop_messengers][:count]),
+        'FollowSerializer': (
+            FollowSerializer, [fixtures.follow(pk) for pk in range(count)]),
+        'UserCustomSerializer': (
+            UserCustomSerializer, [fixtures.user(pk) for pk in range(count)]),
+        'ProductSerializer': (
+            ProductSerializer, (fixtures.products * count)[:count]),
+        'CategorySerializer': (
+            CategorySerializer, [fixtures.category] * count),
+    }
+
+
+def block_queries(execute, sql, params, many, context):
+    raise RuntimeError(f'Query during a serializer benchmark: {sql}')
+
+
+def measure(serializer_class, objects, context, repeat):
+    def run():
+        return serializer_class(objects, many=True, context=context).data
+
+    run()  # warm up field construction caches
+    timer = timeit.Timer(run)
+    number, _ = timer.autorange()
+    times = [seconds / number for seconds in timer.repeat(repeat, number)]
+
+    tracemalloc.start()
+    try:
+        baseline, _ = tracemalloc.get_traced_memory()
+        tracemalloc.reset_peak()
+        data = run()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del data
+    count = len(objects)
+    return {
+        'objects': count,
+        'us_per_object': round(min(times) / count * 1e6, 2),
+        'us_per_object_median': round(
+            statistics.median(times) / count * 1e6, 2),
+        'peak_bytes_per_object': round((peak - baseline) / count),
+        'retained_bytes_per_object': round((retained - baseline) / count),
+    }
+
+
+def compare(results, baseline):
+    print(f'\n{"serializer":24} {"us/object":>22} {"peak bytes/object":>24}')
+    for name, new in results.items():
+        old = baseline.get(name)
+        if old is None:
+            continue
+        change = (new['us_per_object'] - old['us_per_object']) / (
+            old['us_per_object'])
+        print(f'{name:24} '
+              f'{old["us_per_object"]:>9} -> {new["us_per_object"]:<9}'
+              f'{change:+.0%} '
+              f'{old["peak_bytes_per_object"]:>9} -> '
+              f'{new["peak_bytes_per_object"]}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--objects', type=int, default=100,
+                        help='objects per serializer call')
+    parser.add_argument('--products', type=int, default=10,
+                        help='products of every shop')
+    parser.add_argument('--shops', type=int, default=3,
+                        help='shops of every followed owner')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--serializers', nargs='+',
+                        help='names of serializers to run')
+    parser.add_argument('--output', help='write results as JSON')
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    args = parser.parse_args()
+
+    results = {}
+    with override_settings(ALLOWED_HOSTS=['testserver']):
+        fixtures = Fixtures(args)
+        wrappers = [connections[alias].execute_wrapper(block_queries)
+                    for alias in connections]
+        for wrapper in wrappers:
+            wrapper.__enter__()
+        try:
+            for name, (serializer_class, objects) in cases(fixtures).items():
+                if args.serializers and name not in args.serializers:
+                    continue
+                results[name] = measure(
+                    serializer_class, objects, fixtures.context, args.repeat)
+                print(f'{name:24} {json.dumps(results[name])}')
+        finally:
+            for wrapper in reversed(wrappers):
+                wrapper.__exit__(None, None, None)
+
+    if args.compare:
+        with open(args.compare) as file:
+            compare(results, json.load(file))
+    if args.output:
+        with open(args.output, 'w') as file:
+            json.dump(results, file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,19 @@
+from django import forms
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.core.exceptions import PermissionDenied
+from django.db.models import Q
+from django.forms.models import BaseInlineFormSet
+from django.shortcuts import redirect
+from django.template.response import TemplateResponse
+from django.urls import path
 import django.apps
 
+from . import search
+from .importers import FORMATS, KINDS, CatalogImporter, read_rows
 from .models import (Shop, ShopProduct, Product, Category, Subcategory,
                      FavoriteProduct, FavoriteShop, Messenger, ShopMessenger)
+from .paginators import EstimatedCountPaginator
 
 
 admin.site.index_title = 'Svoe vkusnee'
@@ -10,18 +21,69 @@ admin.site.site_header = 'SvoeVkusneeAdmin'
 admin.site.site_title = 'svoe_vkusnee_admin'
 
 
-class ProductInShopAdmin(admin.TabularInline):
-    model = ShopProduct
-    fields = ('product', 'availability')
+class PrefetchedAutocompleteSelect(AutocompleteSelect):
+    """Autocomplete that renders the selected object set by the formset
+    instead of querying it for every inline row."""
+
+    selected = None
+
+    def optgroups(self, name, value, attrs=None):
+        obj = self.selected
+        if obj is None or [str(v) for v in value] != [str(obj.pk)]:
+            return super().optgroups(name, value, attrs)
+        options = []
+        if not self.is_required:
+            options.append(self.create_option(name, '', '', False, 0))
+        options.append(self.create_option(
+            name, obj.pk, self.choices.field.label_from_instance(obj),
+            True, len(options)))
+        return [(None, options, 0)]
+
+
+class PrefetchedInlineFormSet(BaseInlineFormSet):
+    """Passes related objects loaded with select_related to the
+    autocomplete widgets of existing rows."""
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if form.instance.pk is None:
+            return form
+        for name, field in form.fields.items():
+            widget = getattr(field.widget, 'widget', field.widget)
+            if isinstance(widget, PrefetchedAutocompleteSelect):
+                widget.selected = getattr(form.instance, name)
+        return form
+
+
+class AutocompleteInline(admin.TabularInline):
+    """Inline whose foreign keys are autocompletes, rendered with a fixed
+    number of queries however many rows the shop has."""
+
+    formset = PrefetchedInlineFormSet
     classes = ('collapse',)
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related(
+            *self.autocomplete_fields)
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name in self.autocomplete_fields:
+            kwargs['widget'] = PrefetchedAutocompleteSelect(
+                db_field, self.admin_site, using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
+
+
+class ProductInShopAdmin(AutocompleteInline):
+    model = ShopProduct
+    fields = ('product', 'availability')
+    autocomplete_fields = ('product',)
+
 
-class MessengerInShopAdmin(admin.TabularInline):
+class MessengerInShopAdmin(AutocompleteInline):
     model = ShopMessenger
     fields = ('messenger', 'search_information')
-    classes = ('collapse',)
-    extra = 0
+    autocomplete_fields = ('messenger',)
 
 
 @admin.register(Shop)
@@ -68,22 +130,31 @@ class ShopAdmin(admin.ModelAdmin):
         'city',
         'mainstream',
     )
-    search_fields = (
-        'name',
-        'mainstream',
-        'city',
-        'categorys__name',
-        'subcategorys__name',
-        'products__name',
-    )
+    list_select_related = ('owner',)
+    # Searched through the full-text index, see get_search_results.
+    search_fields = ('name',)
+    search_help_text = 'name, description, history, fairs or exact city'
+    show_full_result_count = False
+    autocomplete_fields = ('owner',)
     inlines = (
         ProductInShopAdmin, MessengerInShopAdmin,)
     readonly_fields = ('count_followers',)
     empty_value_display = '-empty-'
 
-    @admin.display(description='owners')
+    def get_search_results(self, request, queryset, search_term):
+        search_term = search_term.strip()
+        if not search_term:
+            return queryset, False
+        ids = search.search('shop', search_term)
+        return queryset.filter(
+            Q(id__in=ids)
+            | Q(name__istartswith=search_term)
+            | Q(city__iexact=search_term)
+        ), False
+
+    @admin.display(description='owners', ordering='owner__username')
     def get_owner(self, obj):
-        return obj.owner.username
+        return obj.owner.username if obj.owner else None
 
     @admin.display(description='categories')
     def get_categories(self, obj):
@@ -100,17 +171,60 @@ class ShopAdmin(admin.ModelAdmin):
         return ', '.join([
             products.name for products in obj.products.all()])
 
-    @admin.display(description='amount of followers')
+    @admin.display(description='amount of followers',
+                   ordering='followers_count')
     def count_followers(self, obj):
-        return obj.followers.count()
+        return obj.followers_count
+
+
+class CatalogImportForm(forms.Form):
+    kind = forms.ChoiceField(choices=[(kind, kind) for kind in KINDS])
+    file = forms.FileField()
+    file_format = forms.ChoiceField(
+        choices=[(file_format, file_format) for file_format in FORMATS])
+    batch_size = forms.IntegerField(initial=1000, min_value=1)
 
 
 @admin.register(Product)
 class ProductAdmin(admin.ModelAdmin):
-    list_display = ('id', 'name',)
-    search_fields = ('name',)
+    list_display = ('id', 'name', 'favorites_count',)
+    search_fields = ('^name',)
     list_filter = ('subcategory',)
 
+    def get_urls(self):
+        return [
+            path(
+                'import/',
+                self.admin_site.admin_view(self.import_catalog),
+                name='shops_product_import',
+            ),
+        ] + super().get_urls()
+
+    def import_catalog(self, request):
+        """Upload of a CSV or JSONL catalog file."""
+        if not self.has_add_permission(request):
+            raise PermissionDenied
+        form = CatalogImportForm(request.POST or None, request.FILES or None)
+        if request.method == 'POST' and form.is_valid():
+            data = form.cleaned_data
+            importer = CatalogImporter(data['kind'], data['batch_size']).run(
+                read_rows(data['file'], data['file_format']))
+            self.message_user(
+                request,
+                f'{importer.imported} rows imported in '
+                f'{importer.seconds:.1f} s ({importer.rate:.0f} rows/s)')
+            for line, error in importer.errors[:20]:
+                self.message_user(
+                    request, f'line {line}: {error}', level='warning')
+            return redirect('admin:shops_product_changelist')
+        return TemplateResponse(
+            request, 'admin/shops/catalog_import.html', {
+                **self.admin_site.each_context(request),
+                'form': form,
+                'opts': self.model._meta,
+                'title': 'import catalog',
+            })
+
 
 @admin.register(Category)
 class CategoryAdmin(admin.ModelAdmin):
@@ -128,25 +242,37 @@ class SubcategoryAdmin(admin.ModelAdmin):
     prepopulated_fields = {"slug": ("name",)}
 
 
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist of a big link table: no full COUNT(*) and no filter
+    sidebars listing every user or shop."""
+
+    paginator = EstimatedCountPaginator
+    show_full_result_count = False
+
+
 @admin.register(FavoriteShop)
-class FavoriteShopAdmin(admin.ModelAdmin):
+class FavoriteShopAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'shop')
-    search_fields = ('user', 'shop')
-    list_filter = ('user', 'shop')
+    list_select_related = ('user', 'shop')
+    search_fields = ('^user__email', '^shop__name')
+    autocomplete_fields = ('user', 'shop')
 
 
 @admin.register(FavoriteProduct)
-class FavoriteProductAdmin(admin.ModelAdmin):
+class FavoriteProductAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'product')
-    search_fields = ('user', 'product')
-    list_filter = ('user', 'product')
+    list_select_related = ('user', 'product')
+    search_fields = ('^user__email', '^product__name')
+    autocomplete_fields = ('user', 'product')
 
 
 @admin.register(ShopProduct)
-class ShopProductAdmin(admin.ModelAdmin):
+class ShopProductAdmin(LargeTableAdmin):
     list_display = ('id', 'shop', 'product', 'availability')
-    search_fields = ('shop', 'product')
-    list_filter = ('shop', 'product')
+    list_select_related = ('shop', 'product')
+    search_fields = ('^shop__name', '^product__name')
+    list_filter = ('availability',)
+    autocomplete_fields = ('shop', 'product')
 
 
 @admin.register(Messenger)
@@ -156,10 +282,12 @@ class MessengerAdmin(admin.ModelAdmin):
 
 
 @admin.register(ShopMessenger)
-class ShopMessengerAdmin(admin.ModelAdmin):
+class ShopMessengerAdmin(LargeTableAdmin):
     list_display = ('id', 'shop', 'messenger', 'search_information',)
-    search_fields = ('shop', 'messenger')
-    list_filter = ('shop', 'messenger')
+    list_select_related = ('shop', 'messenger')
+    search_fields = ('^shop__name', 'search_information')
+    list_filter = ('messenger',)
+    autocomplete_fields = ('shop', 'messenger')
 
 
 def all_models_admin():
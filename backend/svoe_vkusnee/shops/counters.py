@@ -0,0 +1,77 @@
+"""Denormalized counters of followers, favorites and shops.
+
+Counter columns are changed only with UPDATE ... SET count = count + 1 from
+signal handlers, so concurrent writes never lose an increment, and are
+left out of ordinary saves so a stale instance does not overwrite them.
+reconcile() recounts them from the relation tables.
+"""
+from django.apps import apps
+from django.db.models import Count, F, OuterRef, Subquery, Value
+from django.db.models.functions import Coalesce
+
+BATCH_SIZE = 1000
+# (model, counter field, related model, foreign key of the related model)
+COUNTERS = (
+    ('shops.Shop', 'followers_count', 'shops.FavoriteShop', 'shop'),
+    ('shops.Product', 'favorites_count', 'shops.FavoriteProduct', 'product'),
+    ('users.User', 'followers_count', 'users.Follow', 'owner'),
+    ('users.User', 'shops_count', 'shops.Shop', 'owner'),
+)
+
+
+class CountersMixin:
+    """Keeps COUNTER_FIELDS out of saves of existing rows.
+
+    Deferred fields are left out too, as Model.save() does for instances
+    loaded with only(), instead of being loaded one query each.
+    """
+
+    COUNTER_FIELDS = ()
+
+    def save(self, *args, **kwargs):
+        if (kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')
+                and not self._state.adding):
+            deferred = self.get_deferred_fields()
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.COUNTER_FIELDS
+                and field.attname not in deferred
+            ]
+        super().save(*args, **kwargs)
+
+
+def change(model, pk, field, delta):
+    """Adds delta to the counter, never going below zero."""
+    if pk is None or not delta:
+        return
+    queryset = model.objects.filter(pk=pk)
+    if delta < 0:
+        queryset = queryset.filter(**{f'{field}__gte': -delta})
+    queryset.update(**{field: F(field) + delta})
+
+
+def reconcile(dry_run=False):
+    """Recounts every counter, returns {label: number of fixed rows}."""
+    fixed = {}
+    for model_label, field, related_label, foreign_key in COUNTERS:
+        model = apps.get_model(model_label)
+        related = apps.get_model(related_label)
+        actual = Coalesce(Subquery(
+            related.objects.filter(
+                **{foreign_key: OuterRef('pk')}
+            ).order_by().values(foreign_key).annotate(
+                count=Count('pk')
+            ).values('count')
+        ), Value(0))
+        drifted = model.objects.annotate(actual=actual).exclude(
+            **{field: F('actual')})
+        ids = list(drifted.values_list('pk', flat=True))
+        if not dry_run:
+            for start in range(0, len(ids), BATCH_SIZE):
+                model.objects.filter(
+                    pk__in=ids[start:start + BATCH_SIZE]
+                ).update(**{field: actual})
+        fixed[f'{model_label}.{field}'] = len(ids)
+    return fixed
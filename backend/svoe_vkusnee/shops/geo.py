@@ -0,0 +1,156 @@
+"""Shop locations: parsing, geohash grid and nearest neighbour search.
+
+Each shop stores the geohash of its coordinates. Cells of one geohash
+prefix are a contiguous range of the indexed column, so a search reads
+only the 3x3 block of cells around the point instead of the whole table.
+"""
+import math
+import re
+
+from django.db.models import Q
+
+BASE32 = '0123456789bcdefghjkmnpqrstuvwxyz'
+PRECISION = 9
+EARTH_RADIUS = 6371.0
+# Height and width at the equator of a geohash cell in km, by precision.
+CELL_SIZES = {
+    1: (4992.6, 5009.4),
+    2: (624.1, 1252.3),
+    3: (156.0, 156.5),
+    4: (19.5, 39.1),
+    5: (4.9, 4.9),
+    6: (0.61, 1.22),
+    7: (0.153, 0.153),
+    8: (0.019, 0.038),
+    9: (0.0048, 0.0048),
+}
+NUMBER_RE = re.compile(r'[-+]?\d+(?:\.\d+)?')
+
+
+def parse_coordinates(text):
+    """Latitude and longitude from a free-form string, None if invalid."""
+    numbers = NUMBER_RE.findall(text or '')
+    if len(numbers) != 2:
+        return None
+    latitude, longitude = map(float, numbers)
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):
+        return None
+    return latitude, longitude
+
+
+def encode(latitude, longitude, precision=PRECISION):
+    """Geohash of a point."""
+    ranges = [[-90.0, 90.0], [-180.0, 180.0]]
+    values = (latitude, longitude)
+    geohash, bits, char, even = [], 0, 0, True
+    while len(geohash) < precision:
+        low_high, value = ranges[even], values[even]
+        middle = (low_high[0] + low_high[1]) / 2
+        char <<= 1
+        if value >= middle:
+            char |= 1
+            low_high[0] = middle
+        else:
+            low_high[1] = middle
+        even = not even
+        bits += 1
+        if bits == 5:
+            geohash.append(BASE32[char])
+            bits, char = 0, 0
+    return ''.join(geohash)
+
+
+def decode_bbox(geohash):
+    """Bounding box (south, west, north, east) of a geohash cell."""
+    ranges = [[-90.0, 90.0], [-180.0, 180.0]]
+    even = True
+    for char in geohash:
+        value = BASE32.index(char)
+        for shift in range(4, -1, -1):
+            low_high = ranges[even]
+            middle = (low_high[0] + low_high[1]) / 2
+            if value >> shift & 1:
+                low_high[0] = middle
+            else:
+                low_high[1] = middle
+            even = not even
+    (south, north), (west, east) = ranges
+    return south, west, north, east
+
+
+def neighbours(geohash):
+    """The cell and the eight cells around it."""
+    south, west, north, east = decode_bbox(geohash)
+    height, width = north - south, east - west
+    latitude, longitude = (south + north) / 2, (west + east) / 2
+    cells = set()
+    for dlat in (-height, 0, height):
+        for dlon in (-width, 0, width):
+            cell_latitude = latitude + dlat
+            if not -90 <= cell_latitude <= 90:
+                continue
+            cell_longitude = (longitude + dlon + 180) % 360 - 180
+            cells.add(encode(cell_latitude, cell_longitude, len(geohash)))
+    return cells
+
+
+def distance(latitude1, longitude1, latitude2, longitude2):
+    """Great-circle distance between two points in km."""
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    dphi = phi2 - phi1
+    dlambda = math.radians(longitude2 - longitude1)
+    a = (math.sin(dphi / 2) ** 2
+         + math.cos(phi1) * math.cos(phi2) * math.sin(dlambda / 2) ** 2)
+    return 2 * EARTH_RADIUS * math.asin(math.sqrt(a))
+
+
+def coverage(precision, latitude):
+    """Radius in km surely covered by the 3x3 block of cells."""
+    height, width = CELL_SIZES[precision]
+    return min(height, width * math.cos(math.radians(latitude)))
+
+
+def precision_for_radius(radius, latitude):
+    """The finest precision whose 3x3 block covers the radius, 0 if none."""
+    for precision in range(PRECISION, 0, -1):
+        if coverage(precision, latitude) >= radius:
+            return precision
+    return 0
+
+
+def cells_filter(latitude, longitude, precision):
+    """Index-friendly range filter of the 3x3 block of cells."""
+    if not precision:
+        return Q(geohash__gt='')
+    condition = Q()
+    for cell in neighbours(encode(latitude, longitude, precision)):
+        condition |= Q(geohash__gte=cell, geohash__lt=cell + '~')
+    return condition
+
+
+def find_nearby(queryset, latitude, longitude, radius=None, k=None):
+    """Ids of shops and distances to them, the nearest first.
+
+    With a radius only shops within it are returned. Without a radius the
+    block of cells grows until it surely holds the k nearest shops.
+    """
+    if radius is not None:
+        precisions = [precision_for_radius(radius, latitude)]
+    else:
+        precisions = range(PRECISION, -1, -1)
+    for precision in precisions:
+        points = queryset.filter(
+            cells_filter(latitude, longitude, precision)
+        ).values_list('id', 'latitude', 'longitude')
+        found = sorted(
+            (distance(latitude, longitude, shop_latitude, shop_longitude), id)
+            for id, shop_latitude, shop_longitude in points
+        )
+        if radius is not None:
+            found = [item for item in found if item[0] <= radius]
+        elif precision and k and not (
+                len(found) >= k
+                and found[k - 1][0] <= coverage(precision, latitude)):
+            continue
+        return [(id, shop_distance) for shop_distance, id in found[:k]]
+    return []
@@ -0,0 +1,171 @@
+"""Streaming import of categories, subcategories and products.
+
+Rows are read lazily from CSV or JSONL and upserted in batches, so memory
+use does not depend on the size of the file. Category and subcategory
+slugs are resolved through an in-memory slug -> id map.
+"""
+import csv
+import io
+import json
+import time
+from itertools import islice
+
+from django.core.management.color import no_style
+from django.db import connection, transaction
+
+from . import search
+from .models import Category, Product, Subcategory
+from .signals import catalog_imported
+
+FORMATS = ('csv', 'jsonl')
+KINDS = ('categories', 'subcategories', 'products')
+
+
+class RowError(ValueError):
+    """Invalid row of an imported file."""
+
+
+def read_rows(file, file_format):
+    """Pairs (line number, row as a dict) of a binary or text file.
+
+    A line that cannot be parsed comes as (line number, RowError), so the
+    importer reports it with the other invalid rows and goes on.
+    """
+    if isinstance(file.read(0), bytes):
+        file = io.TextIOWrapper(file, encoding='utf-8-sig')
+    if file_format == 'csv':
+        yield from read_csv(file)
+        return
+    for line, text in enumerate(file, start=1):
+        if not text.strip():
+            continue
+        try:
+            row = json.loads(text)
+        except ValueError as error:
+            yield line, RowError(f'invalid JSON: {error}')
+            continue
+        if not isinstance(row, dict):
+            yield line, RowError('a JSON object expected')
+            continue
+        yield line, row
+
+
+def read_csv(file):
+    reader = csv.DictReader(file)
+    while True:
+        try:
+            row = next(reader)
+        except StopIteration:
+            return
+        except csv.Error as error:
+            # DictReader.line_num is updated only for rows read without
+            # errors.
+            yield reader.reader.line_num, RowError(f'invalid CSV: {error}')
+            continue
+        # The last line of the row: blank lines before it are counted.
+        yield reader.line_num, row
+
+
+def batched(rows, size):
+    rows = iter(rows)
+    while batch := list(islice(rows, size)):
+        yield batch
+
+
+class CatalogImporter:
+    """Upserts rows of one kind in batches and collects statistics."""
+
+    def __init__(self, kind, batch_size=1000, progress=None):
+        self.kind = kind
+        self.batch_size = batch_size
+        self.progress = progress
+        self.imported = 0
+        self.errors = []
+        self.seconds = 0
+        self.explicit_ids = False
+        self.slugs = {}
+        if kind == 'subcategories':
+            self.slugs = dict(Category.objects.values_list('slug', 'id'))
+        elif kind == 'products':
+            self.slugs = dict(Subcategory.objects.values_list('slug', 'id'))
+
+    @property
+    def rate(self):
+        return self.imported / self.seconds if self.seconds else 0
+
+    def run(self, rows):
+        started = time.monotonic()
+        for batch in batched(rows, self.batch_size):
+            objects = []
+            for line, row in batch:
+                try:
+                    if isinstance(row, RowError):
+                        raise row
+                    objects.append(self.build(row))
+                except (KeyError, ValueError) as error:
+                    self.errors.append((line, str(error)))
+            with transaction.atomic():
+                self.save(objects)
+            self.imported += len(objects)
+            self.seconds = time.monotonic() - started
+            if self.progress:
+                self.progress(self)
+        if self.explicit_ids:
+            self.reset_sequences()
+        catalog_imported.send(sender=type(self), kind=self.kind)
+        return self
+
+    def resolve(self, slug):
+        if not slug:
+            return None
+        if slug not in self.slugs:
+            raise RowError(f'unknown slug {slug!r}')
+        return self.slugs[slug]
+
+    def build(self, row):
+        if self.kind == 'categories':
+            return Category(name=row['name'], slug=row['slug'])
+        if self.kind == 'subcategories':
+            return Subcategory(
+                name=row['name'],
+                slug=row['slug'],
+                category_id=self.resolve(row.get('category')),
+            )
+        return Product(
+            id=int(row['id']) if row.get('id') else None,
+            name=row['name'],
+            description=row.get('description') or '',
+            subcategory_id=self.resolve(row.get('subcategory')),
+        )
+
+    def save(self, objects):
+        if self.kind == 'categories':
+            self.upsert(Category, objects, 'slug', ('name',))
+        elif self.kind == 'subcategories':
+            self.upsert(Subcategory, objects, 'slug', ('name', 'category'))
+        else:
+            fields = ('name', 'description', 'subcategory')
+            updated = self.upsert(
+                Product, [obj for obj in objects if obj.id], 'id', fields)
+            created = Product.objects.bulk_create(
+                [obj for obj in objects if not obj.id])
+            self.explicit_ids = self.explicit_ids or bool(updated)
+            search.index_objects('product', updated + created)
+
+    def upsert(self, model, objects, key, fields):
+        # A key may occur only once per statement, the last row wins.
+        unique = list({getattr(obj, key): obj for obj in objects}.values())
+        model.objects.bulk_create(
+            unique,
+            update_conflicts=True,
+            unique_fields=(key,),
+            update_fields=fields,
+        )
+        return unique
+
+    def reset_sequences(self):
+        """Moves the id sequence past explicitly imported ids."""
+        statements = connection.ops.sequence_reset_sql(no_style(), [Product])
+        with connection.cursor() as cursor:
+            for sql in statements:
+                cursor.execute(sql)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from shops.models import Shop
+
+
+class Command(BaseCommand):
+    help = 'Fills latitude, longitude and geohash of shops from coordinates.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        queryset = Shop.objects.only('pk', 'coordinates').order_by('pk')
+        count, last_pk = 0, 0
+        while True:
+            batch = list(
+                queryset.filter(pk__gt=last_pk)[:options['batch_size']])
+            if not batch:
+                break
+            for shop in batch:
+                shop.update_location()
+            Shop.objects.bulk_update(batch, Shop.LOCATION_FIELDS)
+            count += len(batch)
+            last_pk = batch[-1].pk
+        self.stdout.write(f'{count} shops updated')
@@ -0,0 +1,37 @@
+from django.core.management.base import BaseCommand
+
+from shops.importers import FORMATS, KINDS, CatalogImporter, read_rows
+
+
+class Command(BaseCommand):
+    help = 'Imports categories, subcategories or products from CSV or JSONL.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('kind', choices=KINDS)
+        parser.add_argument('path')
+        parser.add_argument(
+            '--format',
+            choices=FORMATS,
+            help='file format, guessed from the extension by default',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        self.verbosity = options['verbosity']
+        path = options['path']
+        file_format = options['format'] or (
+            'jsonl' if path.endswith(('.jsonl', '.ndjson')) else 'csv')
+        with open(path, encoding='utf-8-sig', newline='') as file:
+            importer = CatalogImporter(
+                options['kind'], options['batch_size'], self.progress)
+            importer.run(read_rows(file, file_format))
+        for line, error in importer.errors:
+            self.stderr.write(f'line {line}: {error}')
+        self.stdout.write(
+            f'{importer.imported} rows imported in {importer.seconds:.1f} s '
+            f'({importer.rate:.0f} rows/s), {len(importer.errors)} skipped')
+
+    def progress(self, importer):
+        if self.verbosity > 1:
+            self.stdout.write(
+                f'{importer.imported} rows, {importer.rate:.0f} rows/s')
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+
+from shops import search
+
+
+class Command(BaseCommand):
+    help = 'Rebuilds the full-text search index of products and shops.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'kinds',
+            nargs='*',
+            choices=sorted(search.FIELDS),
+            help='kinds of documents to reindex, all by default',
+        )
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        for kind in options['kinds'] or sorted(search.FIELDS):
+            count = search.rebuild_index(kind, options['batch_size'])
+            self.stdout.write(f'{kind}: {count} documents indexed')
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from shops.counters import reconcile
+
+
+class Command(BaseCommand):
+    help = 'Recounts follower, favorite and shop counters that drifted.'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='only report the number of drifted rows',
+        )
+
+    def handle(self, *args, **options):
+        fixed = reconcile(dry_run=options['dry_run'])
+        verb = 'drifted' if options['dry_run'] else 'fixed'
+        for counter, count in fixed.items():
+            self.stdout.write(f'{counter}: {count} rows {verb}')
@@ -1,6 +1,10 @@
 from django.db import models
 from django.contrib.auth import get_user_model
 
+from . import geo
+from .counters import CountersMixin
+from .storage import content_storage
+
 User = get_user_model()
 
 
@@ -16,6 +20,8 @@ class Category(models.Model):
         help_text='enter slug'
     )
     photo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         upload_to='images/categories/',
         blank=True,
         help_text='download photo'
@@ -58,13 +64,17 @@ class Subcategory(models.Model):
         return self.name
 
 
-class Product(models.Model):
+class Product(CountersMixin, models.Model):
     """Products."""
+    COUNTER_FIELDS = ('favorites_count',)
+
     name = models.CharField(
         max_length=200,
         help_text='enter product name'
     )
     photo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         upload_to='images/products/',
         blank=True,
         help_text='download photo'
@@ -79,6 +89,12 @@ class Product(models.Model):
         related_name='products',
         help_text='choose subcategory'
     )
+    favorites_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        db_index=True,
+        help_text='number of users who favorited the product',
+    )
 
     class Meta:
         ordering = ('name',)
@@ -96,6 +112,8 @@ class Messenger(models.Model):
         unique=True,
     )
     logo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         upload_to='images/messengers/',
         blank=True,
     )
@@ -107,7 +125,7 @@ class Messenger(models.Model):
         return self.name
 
 
-class Shop(models.Model):
+class Shop(CountersMixin, models.Model):
     """Shops."""
 
     MAINSTREAMS = [
@@ -117,6 +135,8 @@ class Shop(models.Model):
         ('M_4', 'MAINSTREAM_4'),
         ('M_5', 'MAINSTREAM_5'),
     ]
+    LOCATION_FIELDS = ('latitude', 'longitude', 'geohash')
+    COUNTER_FIELDS = ('followers_count',)
 
     name = models.CharField(
         max_length=200,
@@ -171,11 +191,38 @@ class Shop(models.Model):
         help_text='enter coordinates of shop',
         blank=True,
     )
+    latitude = models.FloatField(
+        help_text='latitude parsed from coordinates',
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    longitude = models.FloatField(
+        help_text='longitude parsed from coordinates',
+        blank=True,
+        null=True,
+        editable=False,
+    )
+    geohash = models.CharField(
+        max_length=12,
+        help_text='geohash of coordinates',
+        blank=True,
+        db_index=True,
+        editable=False,
+    )
+    followers_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        db_index=True,
+        help_text='number of users who favorited the shop',
+    )
     certificate = models.BooleanField(
         default=False,
         help_text='availability of a certificate',
     )
     certificate_photo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         verbose_name='certificate photo',
         upload_to='images/certificates/',
         blank=True,
@@ -194,11 +241,15 @@ class Shop(models.Model):
         blank=True,
     )
     photo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         upload_to='images/shops/',
         help_text='choose a photo of the product',
         blank=True,
     )
     logo = models.ImageField(
+        storage=content_storage,
+        db_index=True,
         upload_to='images/shops_logos/',
         help_text='choose a logo',
         blank=True,
@@ -223,10 +274,35 @@ class Shop(models.Model):
     class Meta:
         ordering = ('name',)
         verbose_name_plural = 'shops'
+        indexes = [
+            models.Index(
+                fields=['latitude', 'longitude'],
+                name='shop_location'
+            ),
+        ]
 
     def __str__(self):
         return self.name
 
+    def save(self, *args, **kwargs):
+        update_fields = kwargs.get('update_fields')
+        if update_fields is None or 'coordinates' in update_fields:
+            self.update_location()
+            if update_fields is not None:
+                kwargs['update_fields'] = {
+                    *update_fields, *self.LOCATION_FIELDS}
+        super().save(*args, **kwargs)
+
+    def update_location(self):
+        """Fills numeric coordinates and geohash from coordinates."""
+        location = geo.parse_coordinates(self.coordinates)
+        if location is None:
+            self.latitude = self.longitude = None
+            self.geohash = ''
+        else:
+            self.latitude, self.longitude = location
+            self.geohash = geo.encode(*location)
+
 
 class ShopMessenger(models.Model):
     """Shop' messengers."""
@@ -342,3 +418,68 @@ class FavoriteProduct(models.Model):
 
     def __str__(self) -> str:
         return f'{self.user} - {self.product}'
+
+
+class SearchDocument(models.Model):
+    """Indexed document of full-text search."""
+    KINDS = [
+        ('product', 'product'),
+        ('shop', 'shop'),
+    ]
+
+    kind = models.CharField(
+        max_length=10,
+        choices=KINDS,
+    )
+    object_id = models.PositiveBigIntegerField()
+    length = models.PositiveIntegerField(
+        help_text='weighted number of terms',
+    )
+
+    class Meta:
+        verbose_name = 'search document'
+        verbose_name_plural = 'search documents'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['kind', 'object_id'],
+                name='unique_search_document'
+            )
+        ]
+
+    def __str__(self):
+        return f'{self.kind} {self.object_id}'
+
+
+class SearchPosting(models.Model):
+    """Posting of inverted index: term occurrences in a document."""
+    kind = models.CharField(
+        max_length=10,
+        choices=SearchDocument.KINDS,
+    )
+    term = models.CharField(
+        max_length=50,
+    )
+    object_id = models.PositiveBigIntegerField()
+    frequency = models.PositiveIntegerField(
+        help_text='weighted term frequency',
+    )
+    length = models.PositiveIntegerField(
+        help_text='weighted number of terms in the document',
+    )
+
+    class Meta:
+        verbose_name = 'search posting'
+        verbose_name_plural = 'search postings'
+        indexes = [
+            models.Index(
+                fields=['kind', 'term'],
+                name='search_posting_term'
+            ),
+            models.Index(
+                fields=['kind', 'object_id'],
+                name='search_posting_document'
+            ),
+        ]
+
+    def __str__(self):
+        return f'{self.term} in {self.kind} {self.object_id}'
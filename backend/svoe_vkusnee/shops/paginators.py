@@ -0,0 +1,61 @@
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import EmptyResultSet
+from django.core.paginator import Paginator
+from django.db import connections
+from django.utils.functional import cached_property
+
+# Tables smaller than this are counted exactly.
+ESTIMATE_THRESHOLD = 10000
+
+
+def get_cached_count(queryset):
+    """Count of the queryset, cached for PAGINATION_COUNT_CACHE_TIMEOUT
+    seconds by its SQL text."""
+    try:
+        sql = str(queryset.query).encode()
+    except EmptyResultSet:
+        # The queryset cannot match anything and has no SQL.
+        return 0
+    key = f'count:{hashlib.md5(sql).hexdigest()}'
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, settings.PAGINATION_COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def estimate_rows(queryset):
+    """Planner estimate of rows in the table, None when unavailable."""
+    connection = connections[queryset.db]
+    if connection.vendor != 'postgresql':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+            [queryset.model._meta.db_table],
+        )
+        row = cursor.fetchone()
+    if row is None or row[0] < 0:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator for big admin changelists.
+
+    An unfiltered changelist of a large table takes its count from the
+    PostgreSQL planner statistics. Other counts are exact but cached for
+    PAGINATION_COUNT_CACHE_TIMEOUT seconds, keyed by the SQL text.
+    """
+
+    @cached_property
+    def count(self):
+        queryset = self.object_list
+        if not queryset.query.where:
+            estimate = estimate_rows(queryset)
+            if estimate is not None and estimate >= ESTIMATE_THRESHOLD:
+                return estimate
+        return get_cached_count(queryset)
@@ -0,0 +1,217 @@
+"""Full-text search over products and shops.
+
+Texts are normalized (case folding, ё -> е, light Russian stemming) and
+stored in an inverted index of SearchPosting rows, so a query reads only
+postings of its own terms. Documents are ranked with BM25, computed by
+the database: postings never leave it, only ids of the best documents or
+the page of a ranked queryset do.
+"""
+import math
+import re
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.db.models import (Avg, Case, Count, FloatField, OuterRef,
+                              Subquery, Sum, Value, When)
+from django.db.models.functions import Cast
+
+from .models import Product, SearchDocument, SearchPosting, Shop
+
+# Indexed fields and their weights per kind of document.
+FIELDS = {
+    'product': {'name': 3, 'description': 1},
+    'shop': {'name': 3, 'description': 1, 'history': 1, 'presented': 1},
+}
+MODELS = {'product': Product, 'shop': Shop}
+
+BM25_K1 = 1.2
+BM25_B = 0.75
+STATS_TIMEOUT = 60
+
+TOKEN_RE = re.compile(r'\w+')
+VOWELS = set('аеиоуыэюя')
+REFLEXIVE_ENDINGS = ('ся', 'сь')
+ENDINGS = sorted((
+    # adjectives and participles
+    'ее', 'ие', 'ые', 'ое', 'ими', 'ыми', 'ей', 'ий', 'ый', 'ой', 'ем',
+    'им', 'ым', 'ом', 'его', 'ого', 'ему', 'ому', 'их', 'ых', 'ую', 'юю',
+    'ая', 'яя', 'ою', 'ею',
+    # verbs
+    'ила', 'ыла', 'ена', 'ейте', 'уйте', 'ите', 'или', 'ыли', 'ил', 'ыл',
+    'ило', 'ыло', 'ено', 'ят', 'ует', 'уют', 'ит', 'ыт', 'ены', 'ить',
+    'ыть', 'ишь', 'ла', 'на', 'ете', 'йте', 'ли', 'ло', 'но', 'ет', 'ют',
+    'ны', 'ть', 'ешь',
+    # nouns
+    'а', 'ев', 'ов', 'ье', 'е', 'иями', 'ями', 'ами', 'еи', 'ии', 'и',
+    'ией', 'ью', 'ьи', 'ы', 'ь', 'ию', 'ю', 'ия', 'ья', 'я', 'иям', 'ям',
+    'ием', 'ам', 'о', 'у', 'ах', 'иях', 'ях', 'й',
+), key=len, reverse=True)
+MIN_STEM = 2
+
+
+def stem(word):
+    """Strips the inflectional ending of a Russian word."""
+    start = next(
+        (i + 1 for i, char in enumerate(word) if char in VOWELS), None)
+    if start is None:
+        return word
+    for endings in (REFLEXIVE_ENDINGS, ENDINGS):
+        for ending in endings:
+            if (word.endswith(ending)
+                    and len(word) - len(ending) >= max(start, MIN_STEM)):
+                word = word[:-len(ending)]
+                break
+    return word
+
+
+def analyze(text):
+    """Splits text into normalized terms."""
+    text = text.casefold().replace('ё', 'е')
+    return [
+        stem(token)[:50] for token in TOKEN_RE.findall(text)
+        if len(token) > 1 or token.isdigit()
+    ]
+
+
+def get_terms(kind, obj):
+    """Weighted term frequencies of an object."""
+    terms = Counter()
+    for field, weight in FIELDS[kind].items():
+        for term in analyze(getattr(obj, field) or ''):
+            terms[term] += weight
+    return terms
+
+
+def index_objects(kind, objects):
+    """Adds objects to the index or refreshes their postings."""
+    documents, postings = [], []
+    for obj in objects:
+        terms = get_terms(kind, obj)
+        length = sum(terms.values())
+        documents.append(
+            SearchDocument(kind=kind, object_id=obj.pk, length=length))
+        postings.extend(
+            SearchPosting(
+                kind=kind, term=term, object_id=obj.pk,
+                frequency=frequency, length=length,
+            )
+            for term, frequency in terms.items()
+        )
+    ids = [document.object_id for document in documents]
+    with transaction.atomic():
+        SearchPosting.objects.filter(kind=kind, object_id__in=ids).delete()
+        SearchDocument.objects.filter(kind=kind, object_id__in=ids).delete()
+        SearchDocument.objects.bulk_create(documents)
+        SearchPosting.objects.bulk_create(postings, batch_size=1000)
+
+
+def remove_objects(kind, ids):
+    """Removes objects from the index."""
+    with transaction.atomic():
+        SearchPosting.objects.filter(kind=kind, object_id__in=ids).delete()
+        SearchDocument.objects.filter(kind=kind, object_id__in=ids).delete()
+
+
+def rebuild_index(kind, batch_size=1000):
+    """Reindexes every object of a kind, returns their number.
+
+    Runs in one transaction, so searches keep seeing the old index until
+    the new one is complete.
+    """
+    queryset = MODELS[kind].objects.only('pk', *FIELDS[kind]).order_by('pk')
+    count, last_pk = 0, 0
+    with transaction.atomic():
+        SearchPosting.objects.filter(kind=kind).delete()
+        SearchDocument.objects.filter(kind=kind).delete()
+        while True:
+            batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+            if not batch:
+                break
+            index_objects(kind, batch)
+            count += len(batch)
+            last_pk = batch[-1].pk
+    cache.delete(f'search:stats:{kind}')
+    return count
+
+
+def get_stats(kind):
+    """Number of documents and their average length, cached briefly."""
+    key = f'search:stats:{kind}'
+    stats = cache.get(key)
+    if stats is None:
+        stats = SearchDocument.objects.filter(kind=kind).aggregate(
+            count=Count('id'), avg_length=Avg('length'))
+        cache.set(key, stats, STATS_TIMEOUT)
+    return stats['count'], stats['avg_length'] or 1
+
+
+def get_document_frequencies(kind, terms):
+    """{term: number of documents with it} of the terms in the index,
+    cached briefly."""
+    keys = {f'search:df:{kind}:{term}': term for term in terms}
+    cached = cache.get_many(keys)
+    frequencies = {keys[key]: value for key, value in cached.items()}
+    missing = set(terms) - frequencies.keys()
+    if missing:
+        counted = dict(SearchPosting.objects.filter(
+            kind=kind, term__in=missing).values_list('term').annotate(
+                Count('id')).order_by())
+        # Absent terms are not cached: a new document may add them.
+        cache.set_many(
+            {f'search:df:{kind}:{term}': value
+             for term, value in counted.items()}, STATS_TIMEOUT)
+        frequencies.update(counted)
+    return frequencies
+
+
+def scored_postings(kind, terms):
+    """Postings of the terms annotated with their BM25 score, or None
+    when no term occurs in the index."""
+    frequencies = get_document_frequencies(kind, terms)
+    if not frequencies:
+        return None
+    count, avg_length = get_stats(kind)
+    count = max(count, max(frequencies.values()))
+    idf = Case(*[
+        When(term=term, then=Value(math.log(
+            1 + (count - frequency + 0.5) / (frequency + 0.5))))
+        for term, frequency in frequencies.items()
+    ], output_field=FloatField())
+    frequency = Cast('frequency', FloatField())
+    norm = BM25_K1 * (
+        1 - BM25_B + BM25_B * Cast('length', FloatField()) / avg_length)
+    return SearchPosting.objects.filter(
+        kind=kind, term__in=frequencies,
+    ).annotate(
+        score=idf * frequency * (BM25_K1 + 1) / (frequency + norm),
+    )
+
+
+def search(kind, query, limit=None):
+    """Ids of the best documents matching the query, the most relevant
+    first; at most limit or SEARCH_MAX_RESULTS of them."""
+    postings = scored_postings(kind, set(analyze(query)))
+    if postings is None:
+        return []
+    limit = limit or settings.SEARCH_MAX_RESULTS
+    return list(postings.values('object_id').annotate(
+        rank=Sum('score')).order_by('-rank', 'object_id').values_list(
+            'object_id', flat=True)[:limit])
+
+
+def rank(queryset, kind, query):
+    """Objects of the queryset matching the query, the most relevant
+    first. Unlike search() it has no cap, so filters and pagination of
+    the queryset see every match."""
+    postings = scored_postings(kind, set(analyze(query)))
+    if postings is None:
+        return queryset.none()
+    ranks = postings.filter(object_id=OuterRef('pk')).values(
+        'object_id').annotate(rank=Sum('score')).values('rank')
+    return queryset.filter(
+        pk__in=postings.values('object_id'),
+    ).annotate(
+        search_rank=Subquery(ranks, output_field=FloatField()),
+    ).order_by('-search_rank', 'pk')
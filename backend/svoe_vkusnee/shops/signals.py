@@ -0,0 +1,102 @@
+from django.db.models.signals import post_delete, post_save, pre_save
+from django.dispatch import Signal, receiver
+
+from users.models import Follow, User
+
+from . import search
+from .counters import change
+from .models import FavoriteProduct, FavoriteShop, Product, Shop
+
+# Bulk writes bypass model signals, so they send their own.
+# Sent after a bulk import of catalog rows.
+catalog_imported = Signal()
+# Sent after shops are created with bulk_create, with the list of shops.
+shops_bulk_created = Signal()
+
+
+@receiver(post_save, sender=Product)
+@receiver(post_save, sender=Shop)
+def update_search_index(sender, instance, **kwargs):
+    """Keeps the search index in sync with saved products and shops."""
+    kind = 'product' if sender is Product else 'shop'
+    search.index_objects(kind, [instance])
+
+
+@receiver(post_delete, sender=Product)
+@receiver(post_delete, sender=Shop)
+def remove_from_search_index(sender, instance, **kwargs):
+    kind = 'product' if sender is Product else 'shop'
+    search.remove_objects(kind, [instance.pk])
+
+
+@receiver(shops_bulk_created)
+def index_created_shops(sender, shops, **kwargs):
+    search.index_objects('shop', shops)
+
+
+# Counters: the model, its counter and the foreign key that points to it.
+FOLLOW_COUNTERS = {
+    FavoriteShop: (Shop, 'followers_count', 'shop_id'),
+    FavoriteProduct: (Product, 'favorites_count', 'product_id'),
+    Follow: (User, 'followers_count', 'owner_id'),
+}
+
+
+@receiver(post_save, sender=FavoriteShop)
+@receiver(post_save, sender=FavoriteProduct)
+@receiver(post_save, sender=Follow)
+def count_follow(sender, instance, created, **kwargs):
+    if created:
+        model, field, foreign_key = FOLLOW_COUNTERS[sender]
+        change(model, getattr(instance, foreign_key), field, 1)
+
+
+@receiver(post_delete, sender=FavoriteShop)
+@receiver(post_delete, sender=FavoriteProduct)
+@receiver(post_delete, sender=Follow)
+def count_unfollow(sender, instance, **kwargs):
+    model, field, foreign_key = FOLLOW_COUNTERS[sender]
+    change(model, getattr(instance, foreign_key), field, -1)
+
+
+# Stored values of a shop that post_save handlers compare with the saved
+# ones: the shops count of the owner here, map tiles in the api app.
+SAVED_SHOP_FIELDS = ('owner_id', 'latitude', 'longitude')
+
+
+@receiver(pre_save, sender=Shop)
+def remember_saved_shop(sender, instance, update_fields=None, **kwargs):
+    """Loads the stored owner and location in one query as
+    instance._saved_state, None for new shops and unrelated updates."""
+    instance._saved_state = None
+    if instance.pk is not None and (
+            update_fields is None
+            or {'owner', 'coordinates', 'latitude', 'longitude'}
+            & set(update_fields)):
+        instance._saved_state = Shop.objects.filter(
+            pk=instance.pk).values(*SAVED_SHOP_FIELDS).first()
+
+
+@receiver(post_save, sender=Shop)
+def count_shop(sender, instance, created, **kwargs):
+    state = getattr(instance, '_saved_state', None)
+    before = state and state['owner_id']
+    if created:
+        change(User, instance.owner_id, 'shops_count', 1)
+    elif before is not None and before != instance.owner_id:
+        change(User, before, 'shops_count', -1)
+        change(User, instance.owner_id, 'shops_count', 1)
+
+
+@receiver(post_delete, sender=Shop)
+def count_deleted_shop(sender, instance, **kwargs):
+    change(User, instance.owner_id, 'shops_count', -1)
+
+
+@receiver(shops_bulk_created)
+def count_created_shops(sender, shops, **kwargs):
+    owners = {}
+    for shop in shops:
+        owners[shop.owner_id] = owners.get(shop.owner_id, 0) + 1
+    for owner_id, count in owners.items():
+        change(User, owner_id, 'shops_count', count)
@@ -0,0 +1,131 @@
+"""Content-addressed storage for uploaded images.
+
+A file is stored under the SHA-256 of its content, so the same logo
+uploaded for several shops is written once and its URL never changes.
+A file is deleted only when no image field of any model still refers to it.
+
+Saving and deleting a file hold a lock of its directory. A save that
+reuses an existing file touches it, and delete() keeps files touched in
+the last CONTENT_STORAGE_DELETE_GRACE seconds: the row of such an upload
+may not be committed yet, so the reference check cannot see it.
+"""
+import contextlib
+import functools
+import hashlib
+import operator
+import os
+import tempfile
+import time
+
+from django.apps import apps
+from django.conf import settings
+from django.core.files import locks
+from django.core.files.storage import FileSystemStorage
+from django.db import models
+from django.db.models import Q
+from django.utils.deconstruct import deconstructible
+
+CHUNK_SIZE = 64 * 1024
+PREFIX = 'cas'
+
+
+def content_hash(content):
+    sha = hashlib.sha256()
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    for chunk in content.chunks(CHUNK_SIZE):
+        sha.update(chunk)
+    if hasattr(content, 'seek'):
+        content.seek(0)
+    return sha.hexdigest()
+
+
+def hash_of_name(name):
+    """Content hash encoded in a stored name, None for other names."""
+    parts = name.split('/')
+    if len(parts) != 3 or parts[0] != PREFIX:
+        return None
+    return os.path.splitext(parts[2])[0]
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """Stores files as cas/<2 hex>/<sha256><extension>."""
+
+    def get_available_name(self, name, max_length=None):
+        # The final name depends only on the content, so it is never taken
+        # by another file.
+        return name
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        """Exclusive lock of the directory of the file, across processes."""
+        directory = os.path.dirname(self.path(name))
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, '.lock'), 'ab') as file:
+            locks.lock(file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(file)
+
+    def _save(self, name, content):
+        digest = content_hash(content)
+        extension = os.path.splitext(name)[1].lower()
+        name = f'{PREFIX}/{digest[:2]}/{digest}{extension}'
+        path = self.path(name)
+        with self.lock(name):
+            if os.path.exists(path):
+                # Protects the file from delete() until the new reference
+                # is committed.
+                os.utime(path)
+                return name
+            self._write(path, content)
+        return name
+
+    def _write(self, path, content):
+        temporary = tempfile.NamedTemporaryFile(
+            dir=os.path.dirname(path), prefix='.tmp-', delete=False)
+        try:
+            with temporary:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    temporary.write(chunk)
+            if self.file_permissions_mode is not None:
+                os.chmod(temporary.name, self.file_permissions_mode)
+            os.replace(temporary.name, path)
+        except BaseException:
+            if os.path.exists(temporary.name):
+                os.remove(temporary.name)
+            raise
+
+    def referenced(self, name):
+        """Whether an image field of any model refers to the file: one
+        indexed query per model."""
+        for model in apps.get_models():
+            fields = [
+                field.name for field in model._meta.concrete_fields
+                if isinstance(field, models.FileField)
+                and isinstance(field.storage, type(self))
+            ]
+            if fields and model._default_manager.filter(functools.reduce(
+                    operator.or_, (Q(**{field: name}) for field in fields))
+            ).exists():
+                return True
+        return False
+
+    def delete(self, name):
+        """Deletes the file once nothing refers to it."""
+        if not name:
+            return
+        with self.lock(name):
+            try:
+                age = time.time() - os.path.getmtime(self.path(name))
+            except FileNotFoundError:
+                return
+            if (age < settings.CONTENT_STORAGE_DELETE_GRACE
+                    or self.referenced(name)):
+                return
+            super().delete(name)
+
+
+content_storage = ContentAddressedStorage()
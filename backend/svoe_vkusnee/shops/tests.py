@@ -1,3 +1,394 @@
-from django.test import TestCase
+import csv
+import hashlib
+import io
+import os
+import shutil
+import tempfile
 
-# Create your tests here.
+from django.core.cache import cache
+from django.core.files.base import ContentFile
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from users.models import Follow, User
+
+from . import counters, geo, search, storage
+from .importers import CatalogImporter, read_rows
+from .models import (Category, FavoriteProduct, FavoriteShop, Messenger,
+                     Product, SearchPosting, Shop, ShopMessenger,
+                     ShopProduct, Subcategory)
+from .paginators import EstimatedCountPaginator
+from .signals import catalog_imported, shops_bulk_created
+from .storage import content_storage
+
+
+class SearchTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+
+    def test_analyze_normalizes_russian_words(self):
+        self.assertEqual(search.analyze('Мёд'), search.analyze('меда'))
+        self.assertEqual(
+            search.analyze('Свежее МОЛОКО'), search.analyze('свежего молока'))
+
+    def test_search_ranks_and_follows_changes(self):
+        honey = Product.objects.create(
+            name='Мёд липовый', description='Липовый мёд с пасеки')
+        tea = Product.objects.create(
+            name='Чай', description='Травяной чай с мёдом')
+        Product.objects.create(name='Молоко', description='Коровье')
+        self.assertEqual(search.search('product', 'мед'), [honey.id, tea.id])
+
+        tea.description = 'Травяной чай'
+        tea.save()
+        self.assertEqual(search.search('product', 'меду'), [honey.id])
+
+        honey.delete()
+        self.assertEqual(search.search('product', 'мед'), [])
+        self.assertFalse(SearchPosting.objects.filter(
+            object_id=honey.id, kind='product').exists())
+
+    def test_rebuild_index(self):
+        Shop.objects.create(name='Пасека', presented='ярмарка в Твери')
+        SearchPosting.objects.all().delete()
+        self.assertEqual(search.rebuild_index('shop'), 1)
+        self.assertEqual(len(search.search('shop', 'ярмарки')), 1)
+
+
+class GeoTest(TestCase):
+
+    def test_geohash(self):
+        self.assertEqual(geo.encode(57.64911, 10.40744), 'u4pruydqq')
+        self.assertEqual(len(geo.neighbours('u4pruyd')), 9)
+
+    def test_shop_location_follows_coordinates(self):
+        shop = Shop.objects.create(name='Ферма', coordinates='55.75, 37.61')
+        self.assertEqual((shop.latitude, shop.longitude), (55.75, 37.61))
+        self.assertEqual(shop.geohash, geo.encode(55.75, 37.61))
+        shop.coordinates = 'где-то в поле'
+        shop.save(update_fields=['coordinates'])
+        shop.refresh_from_db()
+        self.assertIsNone(shop.latitude)
+        self.assertEqual(shop.geohash, '')
+
+    def test_find_nearby(self):
+        points = {
+            'Кремль': (55.7520, 37.6175),
+            'Арбат': (55.7494, 37.5911),
+            'Химки': (55.8970, 37.4297),
+            'Тверь': (56.8587, 35.9176),
+        }
+        ids = {
+            Shop.objects.create(
+                name=name, coordinates=f'{lat} {lon}').id: name
+            for name, (lat, lon) in points.items()
+        }
+        Shop.objects.create(name='Без адреса')
+        found = geo.find_nearby(Shop.objects.all(), 55.7539, 37.6208, k=3)
+        self.assertEqual(
+            [ids[id] for id, distance in found], ['Кремль', 'Арбат', 'Химки'])
+        found = geo.find_nearby(Shop.objects.all(), 55.7539, 37.6208, 5)
+        self.assertEqual(
+            [ids[id] for id, distance in found], ['Кремль', 'Арбат'])
+
+
+class CatalogImportTest(TestCase):
+
+    def import_file(self, kind, content, suffix='.csv'):
+        with tempfile.NamedTemporaryFile(
+                'w', suffix=suffix, delete=False, encoding='utf-8') as file:
+            file.write(content)
+        self.addCleanup(os.remove, file.name)
+        out, err = io.StringIO(), io.StringIO()
+        call_command(
+            'import_catalog', kind, file.name, '--batch-size=2',
+            stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def test_import_and_upsert(self):
+        self.import_file('categories', 'name,slug\nМолочное,milk\n')
+        self.import_file(
+            'subcategories',
+            '{"name": "Сыры", "slug": "cheese", "category": "milk"}\n'
+            '{"name": "Масло", "slug": "butter", "category": "milk"}\n',
+            suffix='.jsonl')
+        out, err = self.import_file(
+            'products',
+            'id,name,description,subcategory\n'
+            '10,Гауда,Выдержанный сыр,cheese\n'
+            ',Сливочное,Масло 82%,butter\n'
+            ',Плавленый,,nowhere\n')
+        self.assertIn('2 rows imported', out)
+        self.assertIn("unknown slug 'nowhere'", err)
+        self.assertEqual(
+            Product.objects.get(id=10).subcategory.category.slug, 'milk')
+        self.assertEqual(search.search('product', 'сыры'), [10])
+
+        self.import_file('categories', 'name,slug\nМолоко,milk\n')
+        self.assertEqual(Category.objects.get().name, 'Молоко')
+        self.import_file(
+            'products', 'id,name,subcategory\n10,Эдам,cheese\n')
+        self.assertEqual(Product.objects.get(id=10).name, 'Эдам')
+        self.assertEqual(Product.objects.count(), 2)
+        self.assertEqual(Subcategory.objects.count(), 2)
+
+    def test_bad_lines_are_reported_and_skipped(self):
+        received = []
+
+        def receiver(sender, kind, **kwargs):
+            received.append(kind)
+        catalog_imported.connect(receiver)
+        self.addCleanup(catalog_imported.disconnect, receiver)
+        out, err = self.import_file(
+            'categories',
+            '{"name": "Мёд", "slug": "honey"}\n'
+            '\n'
+            '{"name": "Сыр", "slug": "cheese"}\n'
+            '{"name": "Хлеб", "slug": \n'
+            '["Чай"]\n'
+            '{"name": "Молоко", "slug": "milk"}\n',
+            suffix='.jsonl')
+        self.assertIn('3 rows imported', out)
+        self.assertIn('line 4: invalid JSON', err)
+        self.assertIn('line 5: a JSON object expected', err)
+        self.assertEqual(received, ['categories'])
+        huge = 'x' * (csv.field_size_limit() + 1)
+        out, err = self.import_file(
+            'categories', f'name,slug\nМёд,honey\n\n{huge},bread\nЧай,tea\n')
+        self.assertIn('2 rows imported', out)
+        self.assertIn('line 4: invalid CSV', err)
+
+    def test_read_rows_from_binary_file(self):
+        rows = read_rows(io.BytesIO('name,slug\nМёд,honey\n'.encode()), 'csv')
+        rows = list(rows)
+        self.assertEqual(rows, [(2, {'name': 'Мёд', 'slug': 'honey'})])
+        importer = CatalogImporter('categories').run(rows)
+        self.assertEqual(importer.imported, 1)
+        self.assertEqual(Category.objects.get().slug, 'honey')
+
+
+class ContentAddressedStorageTest(TestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = self.settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+
+    def test_same_content_is_stored_once(self):
+        first = Shop.objects.create(name='Первый', owner=self.owner)
+        second = Shop.objects.create(name='Второй', owner=self.owner)
+        first.logo.save('logo.PNG', ContentFile(b'logo'))
+        second.logo.save('other.png', ContentFile(b'logo'))
+        second.photo.save('photo.png', ContentFile(b'logo'))
+        self.assertEqual(first.logo.name, second.logo.name)
+        self.assertEqual(first.logo.name, second.photo.name)
+        self.assertRegex(
+            first.logo.name, r'^cas/[0-9a-f]{2}/[0-9a-f]{64}\.png$')
+        self.assertEqual(storage.hash_of_name(first.logo.name),
+                         hashlib.sha256(b'logo').hexdigest())
+
+    @override_settings(CONTENT_STORAGE_DELETE_GRACE=0)
+    def test_file_is_deleted_with_last_reference(self):
+        first = Shop.objects.create(name='Первый', owner=self.owner)
+        second = Shop.objects.create(name='Второй', owner=self.owner)
+        first.logo.save('logo.png', ContentFile(b'logo'))
+        second.logo.save('logo.png', ContentFile(b'logo'))
+        name = first.logo.name
+        Shop.objects.filter(pk=first.pk).update(logo='')
+        content_storage.delete(name)
+        self.assertTrue(content_storage.exists(name))
+        Shop.objects.filter(pk=second.pk).update(logo='')
+        # Category, Product, Messenger and Shop: one query each.
+        with self.assertNumQueries(4):
+            content_storage.delete(name)
+        self.assertFalse(content_storage.exists(name))
+
+    def test_reused_file_outlives_uncommitted_reference(self):
+        shop = Shop.objects.create(name='Первый', owner=self.owner)
+        shop.logo.save('logo.png', ContentFile(b'logo'))
+        name = shop.logo.name
+        # An upload of the same bytes whose row is not saved yet.
+        self.assertEqual(
+            content_storage.save('logo.png', ContentFile(b'logo')), name)
+        Shop.objects.filter(pk=shop.pk).update(logo='')
+        content_storage.delete(name)
+        self.assertTrue(content_storage.exists(name))
+
+
+class CountersTest(TestCase):
+
+    def setUp(self):
+        self.owner = User.objects.create_user(
+            email='owner@example.com', username='owner', password='pass')
+        self.user = User.objects.create_user(
+            email='user@example.com', username='user', password='pass')
+
+    def test_follow_and_favorites(self):
+        shop = Shop.objects.create(name='Пасека', owner=self.owner)
+        product = Product.objects.create(name='Мёд')
+        favorite = FavoriteShop.objects.create(user=self.user, shop=shop)
+        FavoriteProduct.objects.create(user=self.user, product=product)
+        follow = Follow.objects.create(user=self.user, owner=self.owner)
+        shop.refresh_from_db()
+        product.refresh_from_db()
+        self.owner.refresh_from_db()
+        self.assertEqual(shop.followers_count, 1)
+        self.assertEqual(product.favorites_count, 1)
+        self.assertEqual(self.owner.followers_count, 1)
+
+        favorite.delete()
+        follow.delete()
+        shop.refresh_from_db()
+        self.owner.refresh_from_db()
+        self.assertEqual(shop.followers_count, 0)
+        self.assertEqual(self.owner.followers_count, 0)
+
+    def test_stale_instance_does_not_overwrite_counter(self):
+        shop = Shop.objects.create(name='Пасека', owner=self.owner)
+        FavoriteShop.objects.create(user=self.user, shop=shop)
+        shop.name = 'Пасека у реки'
+        shop.save()
+        shop.refresh_from_db()
+        self.assertEqual(shop.followers_count, 1)
+
+    def test_partially_loaded_instance_is_saved_without_loading(self):
+        user = User.objects.only('id', 'is_active').get(pk=self.user.pk)
+        user.set_password('new-pass')
+        # UPDATE and the lookup of the user's tokens to invalidate.
+        with self.assertNumQueries(2):
+            user.save()
+        user = User.objects.get(pk=self.user.pk)
+        self.assertTrue(user.check_password('new-pass'))
+        self.assertEqual(user.email, 'user@example.com')
+
+    def test_shops_count(self):
+        shop = Shop.objects.create(name='Пасека', owner=self.owner)
+        bulk = Shop.objects.bulk_create([
+            Shop(name='Ферма', owner=self.owner),
+            Shop(name='Сыроварня', owner=self.user),
+        ])
+        shops_bulk_created.send(sender=Shop, shops=bulk, shop_products=[])
+        self.owner.refresh_from_db()
+        self.assertEqual(self.owner.shops_count, 2)
+
+        shop.owner = self.user
+        shop.save()
+        self.owner.refresh_from_db()
+        self.user.refresh_from_db()
+        self.assertEqual(self.owner.shops_count, 1)
+        self.assertEqual(self.user.shops_count, 2)
+
+        shop.delete()
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.shops_count, 1)
+
+    def test_shop_save_reads_stored_values_once(self):
+        shop = Shop.objects.create(name='Пасека', owner=self.owner)
+        shop.owner = self.user
+        shop.coordinates = '55.7520, 37.6175'
+        with CaptureQueriesContext(connection) as queries:
+            shop.save()
+        selects = [query['sql'] for query in queries.captured_queries
+                   if query['sql'].startswith('SELECT')
+                   and 'FROM "shops_shop"' in query['sql']]
+        self.assertEqual(len(selects), 1)
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.shops_count, 1)
+
+    def test_reconcile_fixes_drift(self):
+        shop = Shop.objects.create(name='Пасека', owner=self.owner)
+        FavoriteShop.objects.create(user=self.user, shop=shop)
+        Shop.objects.filter(pk=shop.pk).update(followers_count=5)
+        User.objects.filter(pk=self.owner.pk).update(shops_count=0)
+        self.assertEqual(counters.reconcile(dry_run=True)[
+            'shops.Shop.followers_count'], 1)
+        fixed = counters.reconcile()
+        self.assertEqual(fixed['shops.Shop.followers_count'], 1)
+        self.assertEqual(fixed['users.User.shops_count'], 1)
+        shop.refresh_from_db()
+        self.owner.refresh_from_db()
+        self.assertEqual(shop.followers_count, 1)
+        self.assertEqual(self.owner.shops_count, 1)
+        self.assertFalse(any(counters.reconcile(dry_run=True).values()))
+
+
+class ShopAdminTest(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.admin = User.objects.create_superuser(
+            email='admin@example.com', username='admin', password='pass')
+        self.client.force_login(self.admin)
+        self.messenger = Messenger.objects.create(name='Telegram')
+
+    def create_shop(self, name, products):
+        owner = User.objects.create_user(
+            email=f'{name}@example.com', username=name, password='pass')
+        shop = Shop.objects.create(name=name, owner=owner)
+        for i in range(products):
+            product = Product.objects.create(name=f'{name} {i}')
+            ShopProduct.objects.create(shop=shop, product=product)
+            FavoriteShop.objects.create(
+                user=User.objects.create_user(
+                    email=f'{name}{i}@example.com', username=f'{name}{i}',
+                    password='pass'),
+                shop=shop)
+        ShopMessenger.objects.create(
+            shop=shop, messenger=self.messenger, search_information=name)
+        return shop
+
+    def count_queries(self, url):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_estimated_count_of_empty_changelist(self):
+        paginator = EstimatedCountPaginator(
+            ShopProduct.objects.filter(pk__in=[]), 100)
+        with self.assertNumQueries(0):
+            self.assertEqual(paginator.count, 0)
+
+    def test_change_form_queries_do_not_grow_with_rows(self):
+        small = self.create_shop('small', 1)
+        large = self.create_shop('large', 6)
+        # Warm up the content type cache.
+        self.count_queries(
+            reverse('admin:shops_shop_change', args=(small.pk,)))
+        self.assertEqual(
+            self.count_queries(
+                reverse('admin:shops_shop_change', args=(small.pk,))),
+            self.count_queries(
+                reverse('admin:shops_shop_change', args=(large.pk,))),
+        )
+
+    def test_changelist_queries_do_not_grow_with_rows(self):
+        self.create_shop('first', 1)
+        url = reverse('admin:shops_shop_changelist')
+        one = self.count_queries(url)
+        for i in range(5):
+            self.create_shop(f'shop{i}', 1)
+        self.assertEqual(self.count_queries(url), one)
+        self.assertEqual(
+            self.count_queries(reverse('admin:shops_favoriteshop_changelist')),
+            self.count_queries(reverse('admin:shops_shopproduct_changelist')),
+        )
+
+    def test_search_uses_index(self):
+        Shop.objects.create(name='Пасека', presented='ярмарка в Твери')
+        Shop.objects.create(name='Ферма', city='Тверь')
+        response = self.client.get(
+            reverse('admin:shops_shop_changelist'), {'q': 'ярмарки'})
+        self.assertContains(response, 'Пасека')
+        self.assertNotContains(response, 'Ферма')
+        response = self.client.get(
+            reverse('admin:shops_shop_changelist'), {'q': 'Тверь'})
+        self.assertContains(response, 'Ферма')
@@ -0,0 +1,22 @@
+"""SQLite backend with per-connection tuning.
+
+DATABASES[...]['PRAGMAS'] are applied to every new connection.
+DATABASES[...]['TRANSACTION_MODE'] = 'IMMEDIATE' takes the write lock when a
+transaction starts: a deferred transaction that reads and then writes fails
+with "database is locked" at once, without waiting for the busy timeout,
+when another writer committed in between.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict.get('PRAGMAS', {}).items():
+            connection.execute(f'PRAGMA {name} = {value}')
+        return connection
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict.get('TRANSACTION_MODE')
+        self.cursor().execute(f'BEGIN {mode}' if mode else 'BEGIN')
@@ -0,0 +1,110 @@
+"""Routing of reads to replicas with read-your-writes.
+
+ReplicaMiddleware decides per request whether reads may go to a replica:
+only for safe methods and only if the client has not written in the last
+REPLICA_STICKY_SECONDS. It picks one replica for the whole request, so
+counts and pages are read at the same replication lag. The choice lives
+in a context variable, so management commands, background threads and
+everything outside a request keep reading from the primary. Login sends
+no credentials yet, so the token it issues is marked with
+stick_to_primary.
+"""
+import contextvars
+import hashlib
+import random
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.decorators import sync_and_async_middleware
+
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+_replica = contextvars.ContextVar('replica', default=None)
+
+
+class PrimaryReplicaRouter:
+    """Writes and migrations go to the primary, reads to the replica
+    chosen for the current request, if any."""
+
+    def db_for_read(self, model, **hints):
+        return _replica.get() or 'default'
+
+    def db_for_write(self, model, **hints):
+        return 'default'
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary.
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == 'default'
+
+
+def credentials_key(credentials):
+    digest = hashlib.sha256(credentials.encode()).hexdigest()
+    return f'replicas:sticky:{digest}'
+
+
+def client_key(request):
+    """Key of the client in the cache: token or session, None if
+    anonymous."""
+    credentials = request.headers.get('Authorization') or request.COOKIES.get(
+        settings.SESSION_COOKIE_NAME)
+    if not credentials:
+        return None
+    return credentials_key(credentials)
+
+
+def stick_to_primary(credentials):
+    """Sends reads of a client that has just got these credentials to the
+    primary, as after a write."""
+    if settings.DATABASE_REPLICAS:
+        cache.set(credentials_key(credentials), True,
+                  settings.REPLICA_STICKY_SECONDS)
+
+
+@sync_and_async_middleware
+class ReplicaMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        if not settings.DATABASE_REPLICAS:
+            return self.get_response(request)
+        key = client_key(request)
+        token = _replica.set(self.choose_replica(request, key))
+        try:
+            response = self.get_response(request)
+        finally:
+            _replica.reset(token)
+        return self.process_response(request, key, response)
+
+    async def __acall__(self, request):
+        if not settings.DATABASE_REPLICAS:
+            return await self.get_response(request)
+        key = client_key(request)
+        token = _replica.set(self.choose_replica(request, key))
+        try:
+            response = await self.get_response(request)
+        finally:
+            _replica.reset(token)
+        return self.process_response(request, key, response)
+
+    def choose_replica(self, request, key):
+        """Replica for all reads of the request, None for the primary."""
+        if request.method not in SAFE_METHODS or (key and cache.get(key)):
+            return None
+        return random.choice(settings.DATABASE_REPLICAS)
+
+    def process_response(self, request, key, response):
+        if (request.method not in SAFE_METHODS and key
+                and response.status_code < 400):
+            cache.set(key, True, settings.REPLICA_STICKY_SECONDS)
+        return response
@@ -52,7 +52,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'svoe_vkusnee.timing.TimingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'svoe_vkusnee.replicas.ReplicaMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -85,12 +87,150 @@ WSGI_APPLICATION = 'svoe_vkusnee.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/4.1/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# DB_ENGINE selects the profile: sqlite (default) or postgresql.
+
+DB_ENGINE = os.getenv('DB_ENGINE', 'sqlite')
+
+if DB_ENGINE == 'postgresql':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'svoe_vkusnee'),
+            'USER': os.getenv('POSTGRES_USER', 'postgres'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', 'localhost'),
+            'PORT': os.getenv('DB_PORT', '5432'),
+            # Each worker thread keeps its connection between requests and
+            # checks it before reuse instead of reconnecting every time.
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            # Behind pgbouncer in transaction mode named server-side
+            # cursors do not survive between transactions.
+            'DISABLE_SERVER_SIDE_CURSORS': bool(os.getenv('DB_PGBOUNCER')),
+            'OPTIONS': {
+                'connect_timeout': int(os.getenv('DB_CONNECT_TIMEOUT', 5)),
+            },
+        }
     }
-}
+else:
+    DATABASES = {
+        'default': {
+            # The sqlite3 backend plus per-connection PRAGMAS.
+            'ENGINE': 'svoe_vkusnee.backends.sqlite3',
+            'NAME': os.getenv(
+                'SQLITE_PATH', os.path.join(BASE_DIR, 'db.sqlite3')),
+            'CONN_MAX_AGE': int(os.getenv('DB_CONN_MAX_AGE', 600)),
+            'CONN_HEALTH_CHECKS': True,
+            'OPTIONS': {
+                # Seconds a writer waits for the lock before "database is
+                # locked".
+                'timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', 20)),
+            },
+            # WAL lets readers run alongside the single writer, NORMAL
+            # syncs only at checkpoints, which is safe in WAL mode.
+            'PRAGMAS': {
+                'journal_mode': 'wal',
+                'synchronous': 'normal',
+                'mmap_size': int(
+                    os.getenv('SQLITE_MMAP_SIZE', 256 * 1024 * 1024)),
+                'cache_size': -64 * 1024,
+                'temp_store': 'memory',
+            } if os.getenv('SQLITE_TUNED', '1') == '1' else {},
+            'TRANSACTION_MODE': (
+                'IMMEDIATE' if os.getenv('SQLITE_TUNED', '1') == '1'
+                else None),
+        }
+    }
+
+# Read replicas: comma-separated hosts for postgresql or files for sqlite.
+# GET requests read from a replica picked per request, writes and the reads
+# of a user for REPLICA_STICKY_SECONDS after a write go to the primary. A copy
+# of db.sqlite3 stands in for a lagging replica locally.
+DATABASE_REPLICAS = []
+for number, location in enumerate(filter(None, os.getenv(
+        'DB_REPLICAS', '').split(','))):
+    alias = f'replica{number}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST' if DB_ENGINE == 'postgresql' else 'NAME': location.strip(),
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+
+DATABASE_ROUTERS = ['svoe_vkusnee.replicas.PrimaryReplicaRouter']
+
+REPLICA_STICKY_SECONDS = int(os.getenv('REPLICA_STICKY_SECONDS', 10))
+
+# Request timing (svoe_vkusnee/timing.py): share of requests that get SQL
+# and serializer timings in a Server-Timing header, the threshold of the
+# slow request log and whether slow requests log query plans.
+TIMING_SAMPLE_RATE = float(os.getenv('TIMING_SAMPLE_RATE', 0.1))
+SLOW_REQUEST_MS = int(os.getenv('SLOW_REQUEST_MS', 500))
+SLOW_REQUEST_EXPLAIN = os.getenv('SLOW_REQUEST_EXPLAIN', '0') == '1'
+
+
+# Cache
+# https://docs.djangoproject.com/en/4.1/topics/cache/
+# With several workers the cache must be shared, otherwise catalog
+# versions bumped in one process are not seen by the others.
+
+if os.getenv('REDIS_URL'):
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': os.getenv('REDIS_URL'),
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+CATALOG_CACHE_TIMEOUT = int(os.getenv('CATALOG_CACHE_TIMEOUT', 60 * 60))
+
+PAGINATION_COUNT_CACHE_TIMEOUT = int(
+    os.getenv('PAGINATION_COUNT_CACHE_TIMEOUT', 60))
+
+# Ids returned by shops.search.search(); the ?search= filter of the API
+# ranks the whole filtered queryset and has no cap.
+SEARCH_MAX_RESULTS = int(os.getenv('SEARCH_MAX_RESULTS', 500))
+
+SHOP_TILE_CACHE_TIMEOUT = int(
+    os.getenv('SHOP_TILE_CACHE_TIMEOUT', 24 * 60 * 60))
+
+# Token authentication cache: tokens kept in each process, seconds a
+# process trusts its copy (bounds how long a revoked token still works
+# in other processes) and seconds in the shared cache.
+AUTH_TOKEN_CACHE_SIZE = int(os.getenv('AUTH_TOKEN_CACHE_SIZE', 10000))
+AUTH_TOKEN_LOCAL_TTL = int(os.getenv('AUTH_TOKEN_LOCAL_TTL', 30))
+AUTH_TOKEN_CACHE_TIMEOUT = int(os.getenv('AUTH_TOKEN_CACHE_TIMEOUT', 5 * 60))
+
+# Seconds after which a worker rebuilds its in-memory basket index.
+BASKET_INDEX_TTL = int(os.getenv('BASKET_INDEX_TTL', 5 * 60))
+
+# Image uploads: size cap in bytes, pixel cap checked from the header,
+# the largest side after re-encoding and the number of threads that
+# re-encode images (0 - in the request thread).
+IMAGE_UPLOAD_MAX_SIZE = int(
+    os.getenv('IMAGE_UPLOAD_MAX_SIZE', 10 * 1024 * 1024))
+IMAGE_MAX_PIXELS = int(os.getenv('IMAGE_MAX_PIXELS', 40_000_000))
+IMAGE_MAX_SIDE = int(os.getenv('IMAGE_MAX_SIDE', 2048))
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+
+# A stored image reused by an upload is not deleted for this many seconds,
+# which must exceed the time until the row that refers to it is committed.
+CONTENT_STORAGE_DELETE_GRACE = int(
+    os.getenv('CONTENT_STORAGE_DELETE_GRACE', 10 * 60))
+
+# Thumbnails are built on demand and kept on disk within a size budget.
+THUMBNAIL_ROOT = os.getenv(
+    'THUMBNAIL_ROOT', os.path.join(BASE_DIR, 'media', 'thumbnails'))
+THUMBNAIL_CACHE_SIZE = int(
+    os.getenv('THUMBNAIL_CACHE_SIZE', 512 * 1024 * 1024))
+THUMBNAIL_MAX_SIDE = int(os.getenv('THUMBNAIL_MAX_SIDE', 1024))
+THUMBNAIL_MAX_AGE = int(os.getenv('THUMBNAIL_MAX_AGE', 24 * 60 * 60))
 
 
 # Password validation
@@ -113,7 +253,7 @@ AUTH_PASSWORD_VALIDATORS = [
 
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
     ],
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',
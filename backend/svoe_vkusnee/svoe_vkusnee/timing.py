@@ -0,0 +1,252 @@
+"""Per-request timing: SQL, serialization and rendering.
+
+TimingMiddleware instruments a TIMING_SAMPLE_RATE share of requests. For
+them it counts queries and their time through a database execute
+wrapper and times the rendering of template responses. Views report
+serialization: TimingMixin on DRF views adds the time of the handler
+outside SQL, the async views wrap their serializers in timed(). All of
+it goes into a Server-Timing header:
+
+    Server-Timing: sql;dur=12.41;desc="7 queries", serialize;dur=3.02,
+        render;dur=0.88, total;dur=18.70
+
+Requests slower than SLOW_REQUEST_MS are logged as JSON
+with the most repeated SQL statements and, with SLOW_REQUEST_EXPLAIN,
+query plans of the slowest ones. Requests that are not sampled cost one
+random() call; if they are slow, only their total time is logged.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import random
+import time
+from collections import defaultdict
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger(__name__)
+
+TOP_STATEMENTS = 5
+SQL_PREVIEW_LENGTH = 500
+
+_recorder = contextvars.ContextVar('timing_recorder', default=None)
+
+
+class Statement:
+    """Executions of one SQL text with different parameters."""
+
+    __slots__ = ('count', 'seconds', 'alias', 'params')
+
+    def __init__(self, alias, params):
+        self.count, self.seconds = 0, 0.0
+        self.alias, self.params = alias, params
+
+
+class Recorder:
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.timings = defaultdict(float)
+        self.statements = {}
+
+    def add(self, name, seconds):
+        self.timings[name] += seconds
+
+    def add_query(self, sql, params, alias, seconds):
+        self.queries += 1
+        self.timings['sql'] += seconds
+        statement = self.statements.get(sql)
+        if statement is None:
+            statement = self.statements[sql] = Statement(alias, params)
+        statement.count += 1
+        statement.seconds += seconds
+
+    def header(self, total):
+        metrics = [
+            f'sql;dur={self.timings["sql"] * 1000:.2f};'
+            f'desc="{self.queries} queries"'
+        ]
+        for name in ('serialize', 'render'):
+            if name in self.timings:
+                metrics.append(f'{name};dur={self.timings[name] * 1000:.2f}')
+        metrics.append(f'total;dur={total * 1000:.2f}')
+        return ', '.join(metrics)
+
+    def duplicates(self):
+        repeated = sorted(
+            (item for item in self.statements.items() if item[1].count > 1),
+            key=lambda item: item[1].count, reverse=True)
+        return [
+            {'sql': sql[:SQL_PREVIEW_LENGTH], 'count': statement.count,
+             'ms': round(statement.seconds * 1000, 2)}
+            for sql, statement in repeated[:TOP_STATEMENTS]
+        ]
+
+    def explain(self):
+        """Plans of the slowest SELECT statements."""
+        slowest = sorted(
+            (item for item in self.statements.items()
+             if item[0].lstrip().upper().startswith('SELECT')),
+            key=lambda item: item[1].seconds, reverse=True)
+        plans = []
+        for sql, statement in slowest[:TOP_STATEMENTS]:
+            connection = connections[statement.alias]
+            try:
+                with connection.cursor() as cursor:
+                    cursor.execute(
+                        f'{connection.ops.explain_query_prefix()} {sql}',
+                        statement.params)
+                    plan = [' '.join(map(str, row))
+                            for row in cursor.fetchall()]
+            except Exception as error:
+                plan = [f'{type(error).__name__}: {error}']
+            plans.append({
+                'sql': sql[:SQL_PREVIEW_LENGTH],
+                'ms': round(statement.seconds * 1000, 2),
+                'plan': plan,
+            })
+        return plans
+
+
+def record_sql(execute, sql, params, many, context):
+    """Execute wrapper installed on every connection; a no-op outside
+    sampled requests."""
+    recorder = _recorder.get()
+    if recorder is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        recorder.add_query(
+            sql, None if many else params, context['connection'].alias,
+            time.perf_counter() - started)
+
+
+def install_wrapper(connection, **kwargs):
+    if record_sql not in connection.execute_wrappers:
+        connection.execute_wrappers.append(record_sql)
+
+
+connection_created.connect(install_wrapper)
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Adds the time of the block to the current request under name."""
+    recorder = _recorder.get()
+    if recorder is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        recorder.add(name, time.perf_counter() - started)
+
+
+class TimingMixin:
+    """Reports the time of a DRF view handler outside SQL as serialize.
+
+    Besides serializers it includes filtering and pagination in Python,
+    which are small next to them.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        recorder = _recorder.get()
+        if recorder is not None:
+            self._timing_start = (
+                recorder, time.perf_counter(), recorder.timings['sql'])
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        start = getattr(self, '_timing_start', None)
+        if start is not None:
+            recorder, started, sql = start
+            recorder.add('serialize', time.perf_counter() - started
+                         - (recorder.timings['sql'] - sql))
+        return super().finalize_response(request, response, *args, **kwargs)
+
+
+@sync_and_async_middleware
+class TimingMiddleware:
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.is_async = iscoroutinefunction(get_response)
+        if self.is_async:
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if self.is_async:
+            return self.__acall__(request)
+        started, recorder, token = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            if token is not None:
+                _recorder.reset(token)
+        return self.finish(request, response, started, recorder)
+
+    async def __acall__(self, request):
+        started, recorder, token = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            if token is not None:
+                _recorder.reset(token)
+        return self.finish(request, response, started, recorder)
+
+    def start(self):
+        """Start time, and the recorder with its context token for sampled
+        requests."""
+        if random.random() >= settings.TIMING_SAMPLE_RATE:
+            return time.perf_counter(), None, None
+        for connection in connections.all():
+            install_wrapper(connection)
+        recorder = Recorder()
+        return recorder.started, recorder, _recorder.set(recorder)
+
+    def finish(self, request, response, started, recorder):
+        total = time.perf_counter() - started
+        if recorder is None:
+            if total * 1000 >= settings.SLOW_REQUEST_MS:
+                self.log(request, response, {
+                    'total_ms': round(total * 1000, 2), 'sampled': False})
+            return response
+        response['Server-Timing'] = recorder.header(total)
+        if total * 1000 >= settings.SLOW_REQUEST_MS:
+            record = {
+                'total_ms': round(total * 1000, 2),
+                'sampled': True,
+                'queries': recorder.queries,
+                **{f'{name}_ms': round(recorder.timings[name] * 1000, 2)
+                   for name in ('sql', 'serialize', 'render')},
+                'duplicates': recorder.duplicates(),
+            }
+            if settings.SLOW_REQUEST_EXPLAIN:
+                record['explain'] = recorder.explain()
+            self.log(request, response, record)
+        return response
+
+    def process_template_response(self, request, response):
+        recorder = _recorder.get()
+        if recorder is not None:
+            started = time.perf_counter()
+            response.add_post_render_callback(lambda rendered: recorder.add(
+                'render', time.perf_counter() - started))
+        return response
+
+    def log(self, request, response, record):
+        logger.warning('slow request %s', json.dumps({
+            'method': request.method,
+            'path': request.get_full_path(),
+            'status': response.status_code,
+            **record,
+        }, ensure_ascii=False))
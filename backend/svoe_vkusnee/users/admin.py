@@ -15,6 +15,9 @@ class UserAdmin(admin.ModelAdmin):
 @admin.register(Follow)
 class FollowAdmin(admin.ModelAdmin):
     list_display = ('user', 'owner')
+    list_select_related = ('user', 'owner')
+    search_fields = ('^user__email', '^owner__email')
+    autocomplete_fields = ('user', 'owner')
     empty_value_display = '-пусто-'
 
 
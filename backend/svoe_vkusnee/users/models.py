@@ -2,12 +2,15 @@ from django.db import models
 from django.contrib.auth.models import AbstractUser
 from django.db.models import CheckConstraint, F, Q, UniqueConstraint
 
+from shops.counters import CountersMixin
 
-class User(AbstractUser):
+
+class User(CountersMixin, AbstractUser):
     """Users of project SvoeVkusnee """
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ('username', 'first_name', 'last_name', )
+    COUNTER_FIELDS = ('followers_count', 'shops_count')
     first_name = models.CharField(
         max_length=150,
     )
@@ -28,6 +31,18 @@ class User(AbstractUser):
     phone_number = models.CharField(
         max_length=20,
     )
+    followers_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        db_index=True,
+        help_text='number of subscribers',
+    )
+    shops_count = models.PositiveIntegerField(
+        default=0,
+        editable=False,
+        db_index=True,
+        help_text='number of own shops',
+    )
 
     class Meta:
         verbose_name = 'user'